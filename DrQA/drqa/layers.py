@@ -19,16 +19,18 @@ import cuda_functional as MF
 class StackedBRNN(nn.Module):
     def __init__(self, input_size, hidden_size, num_layers,
                  dropout_rate=0, dropout_output=False, rnn_type=nn.LSTM,
-                 concat_layers=False, padding=False):
+                 concat_layers=False, merge_mode='concat'):
         super(StackedBRNN, self).__init__()
-        self.padding = padding
         self.dropout_output = dropout_output
         self.dropout_rate = dropout_rate
         self.num_layers = num_layers
         self.concat_layers = concat_layers
         self.rnns = nn.ModuleList()
         for i in range(num_layers):
-            input_size = input_size if i == 0 else 2 * hidden_size
+            # with merge_mode 'sum' or 'mean', the two directions are added
+            # up and the next layer reads hidden_size features
+            input_size = input_size if i == 0 else \
+                (2 * hidden_size if merge_mode == 'concat' else hidden_size)
             #self.rnns.append(rnn_type(input_size, hidden_size,
             #                          num_layers=1,
             #                          bidirectional=True))
@@ -36,27 +38,24 @@ class StackedBRNN(nn.Module):
                                       dropout=dropout_rate,
                                       rnn_dropout=dropout_rate,
                                       use_tanh=1,
-                                      bidirectional=True))
+                                      bidirectional=True,
+                                      batch_first=True,
+                                      merge_mode=merge_mode))
 
     def forward(self, x, x_mask):
         """Can choose to either handle or ignore variable length sequences.
-        Always handle padding in eval.
+        SRU handles per-example lengths inside the kernel, so padding is
+        always handled.
         """
-        # No padding necessary.
-        if x_mask.data.sum() == 0:
+        # No padding necessary. (The check depends on the data, so ONNX
+        # export always traces the padded path, which covers both.)
+        if not torch.onnx.is_in_onnx_export() and x_mask.data.sum() == 0:
             return self._forward_unpadded(x, x_mask)
-        # Pad if we care or if its during eval.
-        #if self.padding or not self.training:
-        #    return self._forward_padded(x, x_mask)
-        # We don't care.
-        return self._forward_unpadded(x, x_mask)
+        return self._forward_padded(x, x_mask)
 
     def _forward_unpadded(self, x, x_mask):
         """Faster encoding that ignores any padding."""
-        # Transpose batch and sequence dims
-        x = x.transpose(0, 1)
-
-        # Encode all layers
+        # Encode all layers (SRU reads batch * len * h directly)
         outputs = [x]
         for i in range(self.num_layers):
             rnn_input = outputs[-1]
@@ -76,54 +75,26 @@ class StackedBRNN(nn.Module):
         else:
             output = outputs[-1]
 
-        # Transpose back
-        output = output.transpose(0, 1)
-
         # Dropout on output layer
         if self.dropout_output and self.dropout_rate > 0:
             output = F.dropout(output,
                                p=self.dropout_rate,
                                training=self.training)
-        return output.contiguous()
+        return output
 
     def _forward_padded(self, x, x_mask):
-        """Slower (significantly), but more precise,
-        encoding that handles padding."""
-        # Compute sorted sequence lengths
-        lengths = x_mask.data.eq(0).long().sum(1)
-        _, idx_sort = torch.sort(lengths, dim=0, descending=True)
-        _, idx_unsort = torch.sort(idx_sort, dim=0)
-
-        lengths = list(lengths[idx_sort])
-        idx_sort = Variable(idx_sort)
-        idx_unsort = Variable(idx_unsort)
-
-        # Sort x
-        x = x.index_select(0, idx_sort)
-
-        # Transpose batch and sequence dims
-        x = x.transpose(0, 1)
+        """Encoding that handles padding: each example stops at its own
+        length and the backward direction starts at its last token."""
+        # Compute sequence lengths
+        lengths = x_mask.eq(0).long().sum(1)
 
-        # Pack it up
-        rnn_input = nn.utils.rnn.pack_padded_sequence(x, lengths)
-
-        # Encode all layers
-        outputs = [rnn_input]
+        # Encode all layers (SRU reads batch * len * h directly)
+        outputs = [x]
         for i in range(self.num_layers):
             rnn_input = outputs[-1]
-
-            # Apply dropout to input
-            if self.dropout_rate > 0:
-                dropout_input = F.dropout(rnn_input.data,
-                                          p=self.dropout_rate,
-                                          training=self.training)
-                rnn_input = nn.utils.rnn.PackedSequence(dropout_input,
-                                                        rnn_input.batch_sizes)
-            outputs.append(self.rnns[i](rnn_input)[0])
-
-        # Unpack everything
-        for i, o in enumerate(outputs[1:], 1):
-            outputs[i] = nn.utils.rnn.pad_packed_sequence(o)[0]
+            # Forward (dropout is applied inside SRUCell)
+            rnn_output = self.rnns[i](rnn_input, lengths=lengths)[0]
+            outputs.append(rnn_output)
 
         # Concat hidden layers or take final
         if self.concat_layers:
@@ -131,10 +102,6 @@ class StackedBRNN(nn.Module):
         else:
             output = outputs[-1]
 
-        # Transpose and unsort
-        output = output.transpose(0, 1)
-        output = output.index_select(0, idx_unsort)
-
         # Dropout on output layer
         if self.dropout_output and self.dropout_rate > 0:
             output = F.dropout(output,
@@ -178,7 +145,7 @@ class SeqAttnMatch(nn.Module):
 
         # Mask padding
         y_mask = y_mask.unsqueeze(1).expand(scores.size())
-        scores.data.masked_fill_(y_mask.data, -float('inf'))
+        scores = scores.masked_fill(y_mask, -float('inf'))
 
         # Normalize with softmax
         alpha_flat = F.softmax(scores.view(-1, y.size(1)))
@@ -210,7 +177,7 @@ class BilinearSeqAttn(nn.Module):
         """
         Wy = self.linear(y) if self.linear is not None else y
         xWy = x.bmm(Wy.unsqueeze(2)).squeeze(2)
-        xWy.data.masked_fill_(x_mask.data, -float('inf'))
+        xWy = xWy.masked_fill(x_mask, -float('inf'))
         if self.training:
             # In training we output log-softmax for NLL
             alpha = F.log_softmax(xWy)
@@ -235,7 +202,7 @@ class LinearSeqAttn(nn.Module):
         """
         x_flat = x.view(-1, x.size(-1))
         scores = self.linear(x_flat).view(x.size(0), x.size(1))
-        scores.data.masked_fill_(x_mask.data, -float('inf'))
+        scores = scores.masked_fill(x_mask, -float('inf'))
         alpha = F.softmax(scores)
         return alpha
 
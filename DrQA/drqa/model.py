@@ -108,7 +108,8 @@ class DocReaderModel(object):
             inputs = [Variable(e, volatile=True) for e in ex[:7]]
 
         # Run forward
-        score_s, score_e = self.network(*inputs)
+        with torch.no_grad():
+            score_s, score_e = self.network(*inputs)
 
         # Transfer to CPU/normal tensors for numpy ops
         score_s = score_s.data.cpu()
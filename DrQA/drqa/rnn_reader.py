@@ -77,7 +77,7 @@ class RnnDocReader(nn.Module):
             dropout_output=opt['dropout_rnn_output'],
             concat_layers=opt['concat_rnn_layers'],
             rnn_type=self.RNN_TYPES[opt['rnn_type']],
-            padding=opt['rnn_padding'],
+            merge_mode=opt.get('rnn_merge', 'concat'),
         )
 
         # RNN question encoder
@@ -89,12 +89,13 @@ class RnnDocReader(nn.Module):
             dropout_output=opt['dropout_rnn_output'],
             concat_layers=opt['concat_rnn_layers'],
             rnn_type=self.RNN_TYPES[opt['rnn_type']],
-            padding=opt['rnn_padding'],
+            merge_mode=opt.get('rnn_merge', 'concat'),
         )
 
         # Output sizes of rnn encoders
-        doc_hidden_size = 2 * opt['hidden_size']
-        question_hidden_size = 2 * opt['hidden_size']
+        n_dir = 2 if opt.get('rnn_merge', 'concat') == 'concat' else 1
+        doc_hidden_size = n_dir * opt['hidden_size']
+        question_hidden_size = n_dir * opt['hidden_size']
         if opt['concat_rnn_layers']:
             doc_hidden_size *= opt['doc_layers']
             question_hidden_size *= opt['question_layers']
@@ -61,7 +61,8 @@ parser.add_argument('-tp', '--tune_partial', type=int, default=1000,
 parser.add_argument('--fix_embeddings', action='store_true',
                     help='if true, `tune_partial` will be ignored.')
 parser.add_argument('--rnn_padding', action='store_true',
-                    help='perform rnn padding (much slower but more accurate).')
+                    help='deprecated, has no effect: SRU always stops each '
+                         'example at its own length.')
 # model
 parser.add_argument('--question_merge', default='self_attn')
 parser.add_argument('--doc_layers', type=int, default=5)
@@ -90,6 +91,10 @@ parser.add_argument('--dropout_rnn_output', type=str2bool, nargs='?',
 parser.add_argument('--max_len', type=int, default=15)
 parser.add_argument('--rnn_type', default='lstm',
                     help='supported types: rnn, gru, lstm')
+parser.add_argument('--rnn_merge', default='concat',
+                    help='how the two directions of each rnn layer are combined: '
+                         'concat, sum or mean (sum and mean halve the input of '
+                         'the next layer).')
 
 args = parser.parse_args()
 
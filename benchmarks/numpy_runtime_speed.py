@@ -0,0 +1,83 @@
+""" Times sru.numpy_runtime against the PyTorch CPU path (SRU in eval mode,
+    under no_grad) on the same weights and input, e.g.
+
+        python benchmarks/numpy_runtime_speed.py --len 256 --batch 16 --d 512
+"""
+import argparse
+import importlib.util
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import cuda_functional as MF
+
+# loaded from its file, so that the benchmark runs from a checkout
+_spec = importlib.util.spec_from_file_location('numpy_runtime',
+    os.path.join(ROOT, 'sru', 'numpy_runtime.py'))
+numpy_runtime = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(numpy_runtime)
+
+
+def best_time(fn, repeat):
+    fn()    # warm up (compiles the CPU kernels on first use)
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter()-start)
+    return best
+
+
+def main(args):
+    torch.manual_seed(0)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    MF.set_cpu_backend(args.backend)
+    model = MF.SRU(args.d, args.d, args.depth, bidirectional=args.bidirectional,
+        light=args.light).eval()
+    state = { k: v.numpy() for k, v in model.state_dict().items() }
+    runtime = numpy_runtime.SRU.from_state_dict(state, bidirectional=args.bidirectional,
+        light=args.light)
+    x = torch.randn(args.len, args.batch, args.d)
+    x_np = x.numpy()
+
+    def run_torch():
+        with torch.no_grad():
+            return model(x)
+
+    out_torch = run_torch()[0].numpy()
+    out_np = runtime(x_np)[0]
+    err = np.abs(out_torch-out_np).max()
+
+    t_torch = best_time(run_torch, args.repeat)
+    t_np = best_time(lambda: runtime(x_np), args.repeat)
+    tokens = args.len*args.batch
+    sys.stdout.write("L={} B={} D={} depth={}{}  max diff {:.1e}\n".format(
+        args.len, args.batch, args.d, args.depth,
+        ' bidirectional' if args.bidirectional else '', err))
+    sys.stdout.write("torch ({}): {:8.2f} ms  {:10.0f} tokens/s\n".format(
+        args.backend, t_torch*1000, tokens/t_torch))
+    sys.stdout.write("numpy:        {:8.2f} ms  {:10.0f} tokens/s\n".format(
+        t_np*1000, tokens/t_np))
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(sys.argv[0])
+    argparser.add_argument("--len", type=int, default=256)
+    argparser.add_argument("--batch", type=int, default=16)
+    argparser.add_argument("--d", type=int, default=512)
+    argparser.add_argument("--depth", type=int, default=2)
+    argparser.add_argument("--bidirectional", action='store_true')
+    argparser.add_argument("--light", action='store_true')
+    argparser.add_argument("--backend", type=str, default="ext",
+        help="CPU backend of the torch path: ext (OpenMP kernels) or torch")
+    argparser.add_argument("--threads", type=int, default=0,
+        help="torch intra-op threads (0: the default)")
+    argparser.add_argument("--repeat", type=int, default=5)
+    args = argparser.parse_args()
+    main(args)
@@ -7,6 +7,8 @@ import random
 import numpy as np
 import torch
 
+import cuda_functional as MF
+
 def clean_str(string, TREC=False):
     """
     Tokenization/string cleaning for all datasets except for SST.
@@ -148,9 +150,20 @@ def create_one_batch(x, y, map2id, oov='<oov>'):
     assert x.size(0) == length*batch_size
     return x.view(batch_size, length).t().contiguous().cuda(), torch.LongTensor(y).cuda()
 
+def create_one_packed_batch(x, y, map2id, oov='<oov>', pad_token='<pad>'):
+    ''' packs the sequences one after the other into a few streams instead of
+        padding them (see MF.pack_streams); x is the tuple
+        (ids, reset, lengths, spans)
+    '''
+    oov_id = map2id[oov]
+    x = [ torch.LongTensor([ map2id.get(w, oov_id) for w in (seq or [pad_token]) ])
+            for seq in x ]
+    x = tuple(t.cuda() for t in MF.pack_streams(x))
+    return x, torch.LongTensor(y).cuda()
+
 
 # shuffle training examples and create mini-batches
-def create_batches(x, y, batch_size, map2id, perm=None, sort=False):
+def create_batches(x, y, batch_size, map2id, perm=None, sort=False, pack=False):
 
     lst = perm or range(len(x))
 
@@ -167,8 +180,12 @@ def create_batches(x, y, batch_size, map2id, perm=None, sort=False):
     size = batch_size
     nbatch = (len(x)-1) // size + 1
     for i in range(nbatch):
-        bx, by = create_one_batch(x[i*size:(i+1)*size], y[i*size:(i+1)*size], map2id)
-        sum_len += len(bx)
+        if pack:
+            bx, by = create_one_packed_batch(x[i*size:(i+1)*size], y[i*size:(i+1)*size], map2id)
+            sum_len += len(bx[0])
+        else:
+            bx, by = create_one_batch(x[i*size:(i+1)*size], y[i*size:(i+1)*size], map2id)
+            sum_len += len(bx)
         batches_x.append(bx)
         batches_y.append(by)
 
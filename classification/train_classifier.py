@@ -43,11 +43,16 @@ class Model(nn.Module):
                 args.depth,
                 dropout = args.dropout,
                 use_tanh = 1,
+                # packed streams hold several sentences per column
+                output = 'all' if args.pack else 'last',
+                light = args.light,
             )
             d_out = args.d
         self.out = nn.Linear(d_out, nclasses)
 
     def forward(self, input):
+        if self.args.pack:
+            input, reset, lengths, spans = input
         if self.args.cnn:
             input = input.t()
         emb = self.emb_layer(input)
@@ -55,13 +60,26 @@ class Model(nn.Module):
 
         if self.args.cnn:
             output = self.encoder(emb)
-        else:
+        elif self.args.lstm:
             output, hidden = self.encoder(emb)
             output = output[-1]
+        elif self.args.pack:
+            # the last step of every sentence in the streams
+            output, hidden = self.encoder(emb, lengths=lengths, reset=reset)
+            output = MF.gather_last(output, spans)
+        else:
+            # the SRU encoder only returns the last step
+            output, hidden = self.encoder(emb)
 
         output = self.drop(output)
         return self.out(output)
 
+def to_var(x, volatile=False):
+    # packed batches are tuples (ids, reset, lengths, spans) of tensors
+    if isinstance(x, tuple):
+        return x
+    return Variable(x, volatile=volatile)
+
 def eval_model(niter, model, valid_x, valid_y):
     model.eval()
     N = len(valid_x)
@@ -70,10 +88,11 @@ def eval_model(niter, model, valid_x, valid_y):
     cnt = 0
     total_loss = 0.0
     for x, y in zip(valid_x, valid_y):
-        x, y = Variable(x, volatile=True), Variable(y)
-        output = model(x)
+        x, y = to_var(x, volatile=True), Variable(y)
+        with torch.no_grad():
+            output = model(x)
         loss = criterion(output, y)
-        total_loss += loss.data[0]*x.size(1)
+        total_loss += loss.data[0]*y.size(0)
         pred = output.data.max(1)[1]
         correct += pred.eq(y.data).cpu().sum()
         cnt += y.numel()
@@ -92,23 +111,27 @@ def train_model(epoch, model, optimizer,
     criterion = nn.CrossEntropyLoss()
 
     cnt = 0
+    start_time = time.time()
     for x, y in zip(train_x, train_y):
         niter += 1
         cnt += 1
         model.zero_grad()
-        x, y = Variable(x), Variable(y)
+        x, y = to_var(x), Variable(y)
         output = model(x)
         loss = criterion(output, y)
         loss.backward()
         optimizer.step()
+    train_time = time.time()-start_time
 
     valid_err = eval_model(niter, model, valid_x, valid_y)
 
-    sys.stdout.write("Epoch={} iter={} lr={:.6f} train_loss={:.6f} valid_err={:.6f}\n".format(
+    sys.stdout.write("Epoch={} iter={} lr={:.6f} train_loss={:.6f} valid_err={:.6f}"
+            " [{:.1f}s]\n".format(
         epoch, niter,
         optimizer.param_groups[0]['lr'],
         loss.data[0],
-        valid_err
+        valid_err,
+        train_time
     ))
 
     if valid_err < best_valid:
@@ -117,6 +140,27 @@ def train_model(epoch, model, optimizer,
     sys.stdout.write("\n")
     return best_valid, test_err
 
+def prune_model(model, train_x, train_y):
+    """ Replaces the SRU encoder with a copy that keeps args.prune hidden units
+        per layer, scored on the training set, and drops the matching inputs
+        of the output layer.
+    """
+    args = model.args
+    criterion = nn.CrossEntropyLoss()
+    def run():
+        model.eval()
+        with torch.set_grad_enabled(args.prune_score == 'gradient'):
+            for x, y in zip(train_x, train_y):
+                loss = criterion(model(to_var(x)), Variable(y))
+                if args.prune_score == 'gradient':
+                    loss.backward()
+        model.train()
+    model.encoder, keep = MF.prune_sru(model.encoder, args.prune, args.prune_score, run)
+    out = nn.Linear(keep.numel(), model.out.out_features).to(model.out.weight.device)
+    out.weight.data.copy_(model.out.weight.data[:, keep])
+    out.bias.data.copy_(model.out.bias.data)
+    model.out = out
+
 def main(args):
     if args.dataset == 'mr':
         data, label = dataloader.read_MR(args.path)
@@ -155,25 +199,31 @@ def main(args):
             test_id = args.cv
         )
 
+    if args.pack and (args.cnn or args.lstm):
+        raise Exception("--pack only applies to the SRU encoder")
+
     nclasses = max(train_y)+1
 
     train_x, train_y = dataloader.create_batches(
         train_x, train_y,
         args.batch_size,
         emb_layer.word2id,
-        sort = args.dataset == 'sst'
+        sort = args.dataset == 'sst',
+        pack = args.pack
     )
     valid_x, valid_y = dataloader.create_batches(
         valid_x, valid_y,
         args.batch_size,
         emb_layer.word2id,
-        sort = args.dataset == 'sst'
+        sort = args.dataset == 'sst',
+        pack = args.pack
     )
     test_x, test_y = dataloader.create_batches(
         test_x, test_y,
         args.batch_size,
         emb_layer.word2id,
-        sort = args.dataset == 'sst'
+        sort = args.dataset == 'sst',
+        pack = args.pack
     )
 
     model = Model(args, emb_layer, nclasses).cuda()
@@ -202,6 +252,43 @@ def main(args):
         test_err
     ))
 
+    if args.prune > 0:
+        prune_model(model, train_x, train_y)
+        sys.stdout.write("pruned to {} units, test_err: {:.6f}\n".format(
+            args.prune,
+            eval_model(0, model, test_x, test_y)
+        ))
+        # fine-tune the pruned model
+        optimizer = optim.Adam(
+            filter(need_grad, model.parameters()),
+            lr = args.lr
+        )
+        best_valid = 1e+8
+        test_err = 1e+8
+        for epoch in range(args.prune_epochs):
+            best_valid, test_err = train_model(epoch, model, optimizer,
+                train_x, train_y,
+                valid_x, valid_y,
+                test_x, test_y,
+                best_valid, test_err
+            )
+        sys.stdout.write("pruned test_err after fine-tuning: {:.6f}\n".format(
+            test_err
+        ))
+
+    if args.quantize:
+        # accuracy check of the int8 SRU used for CPU serving, on the final model
+        test_x = [ tuple(t.cpu() for t in x) if args.pack else x.cpu() for x in test_x ]
+        test_y = [ y.cpu() for y in test_y ]
+        qmodel = MF.quantize_sru(model)
+        model.cpu()
+        sys.stdout.write("final test_err (fp32): {:.6f}\n".format(
+            eval_model(0, model, test_x, test_y)
+        ))
+        sys.stdout.write("final test_err (int8): {:.6f}\n".format(
+            eval_model(0, qmodel, test_x, test_y)
+        ))
+
 if __name__ == "__main__":
     argparser = argparse.ArgumentParser(sys.argv[0], conflict_handler='resolve')
     argparser.add_argument("--cnn", action='store_true', help="whether to use cnn")
@@ -217,6 +304,17 @@ if __name__ == "__main__":
     argparser.add_argument("--lr", type=float, default=0.001)
     argparser.add_argument("--lr_decay", type=float, default=0)
     argparser.add_argument("--cv", type=int, default=0)
+    argparser.add_argument("--quantize", action='store_true', help="also evaluate an int8 SRU on CPU")
+    argparser.add_argument("--light", action='store_true',
+        help="use the light SRU, whose highway gate shares the forget gate projection")
+    argparser.add_argument("--prune", type=int, default=0,
+        help="after training, prune the SRU to this many hidden units and fine-tune it")
+    argparser.add_argument("--prune_score", type=str, default="magnitude",
+        help="how hidden units are scored for pruning: magnitude, activation or gradient")
+    argparser.add_argument("--prune_epochs", type=int, default=10,
+        help="number of fine-tuning epochs after pruning")
+    argparser.add_argument("--pack", action='store_true',
+        help="pack the sentences of a batch into a few streams instead of padding them")
 
     args = argparser.parse_args()
     print (args)
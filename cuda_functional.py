@@ -1,17 +1,18 @@
 #from builtins import bytes
+import os
+import threading
 import time
+import warnings
 
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.autograd import Function, Variable
-from cupy.cuda import function
-from pynvrtc.compiler import Program
+from torch import Tensor
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
 from collections import namedtuple
+from typing import List, Optional, Tuple, Union
 
 
-tmp_ = torch.rand(1,1).cuda()
-
 SRU_CODE = """
 extern "C" {
 
@@ -27,85 +28,143 @@ extern "C" {
 
     __global__ void sru_fwd(const float * __restrict__ u, const float * __restrict__ x,
                             const float * __restrict__ bias, const float * __restrict__ init,
-                            const float * __restrict__ mask_h,
+                            const float * __restrict__ mask_h, const int * __restrict__ lengths,
+                            const unsigned char * __restrict__ reset,
                             const int len, const int batch, const int d, const int k,
                             float * __restrict__ h, float * __restrict__ c,
-                            const int activation_type)
+                            float * __restrict__ last, const int last_only,
+                            const int activation_type, const int light, const int nb,
+                            const int batch_first)
     {
-        assert ((k == 3) || (x == NULL));
+        // light: the highway gate shares u1 with the forget gate, so u has
+        // kx = 2 parts (plus x, if it differs from the input) instead of 3.
+        // bias is (2, nb, d): example b uses the biases of set b%nb (nb > 1
+        // runs several models with the same weight shapes in one launch)
+        const int kx = light ? 2 : 3;
+
+        assert ((k == kx) || (x == NULL));
 
         int ncols = batch*d;
         int col = blockIdx.x * blockDim.x + threadIdx.x;
         if (col >= ncols) return;
 
-        int ncols_u = ncols*k;
-        int ncols_x = (k == 3) ? ncols : ncols_u;
+        // with batch_first, h, c and x are (batch, len, d) and u is
+        // (batch, len, d, k): the steps of a column are d apart
+        const int pos = batch_first ? ((col/(d))*len*(d) + col%(d)) : col;
+        const int stride = batch_first ? (d) : ncols;
+
+        int ncols_u = stride*k;
+        int ncols_x = (k == kx) ? stride : ncols_u;
 
-        const float bias1 = *(bias + (col%d));
-        const float bias2 = *(bias + (col%d) + d);
+        const float bias1 = *(bias + (col%(nb*d)));
+        const float bias2 = *(bias + (col%(nb*d)) + nb*d);
         const float mask = (mask_h == NULL) ? 1.0 : (*(mask_h + col));
+        const int len_ = (lengths == NULL) ? len : (*(lengths + col/d));
         float cur = *(init + col);
-
-        const float *up = u + (col*k);
-        const float *xp = (k == 3) ? (x + col) : (up + 3);
-        float *cp = c + col;
-        float *hp = h + col;
-
-        for (int row = 0; row < len; ++row)
+        // reset is (len, batch), or (batch, len) with batch_first: c restarts
+        // from init at the steps where it is set (the first step of each of
+        // the sequences packed into the column)
+        const int rpos = batch_first ? (col/d)*len : col/d;
+        const int rstride = batch_first ? 1 : batch;
+
+        // c may be NULL (inference), in which case only h and last are written.
+        // If last_only is set, h is (batch, d) and only gets the output of
+        // the last valid step.
+        const float *up = u + (pos*k);
+        const float *xp = (k == kx) ? (x + pos) : (up + kx);
+        if (last_only && (len_ == 0)) *(h + col) = 0.f;
+
+        for (int row = 0; row < len_; ++row)
         {
+            if ((reset != NULL) && reset[rpos + row*rstride]) cur = *(init + col);
             float g1 = sigmoidf((*(up+1))+bias1);
-            float g2 = sigmoidf((*(up+2))+bias2);
             cur = (cur-(*up))*g1 + (*up);
-            *cp = cur;
-            float val = (activation_type == 1) ? tanh(cur) : (
-                (activation_type == 2) ? reluf(cur) : cur
-            );
-            *hp = (val*mask-(*xp))*g2 + (*xp);
+            if (c != NULL) *(c + pos + row*stride) = cur;
+            if (!last_only || (row == len_-1))
+            {
+                float g2 = sigmoidf((*(up+kx-1))+bias2);
+                float val = (activation_type == 1) ? tanh(cur) : (
+                    (activation_type == 2) ? reluf(cur) : cur
+                );
+                *(h + (last_only ? col : pos + row*stride)) = (val*mask-(*xp))*g2 + (*xp);
+            }
             up += ncols_u;
             xp += ncols_x;
-            cp += ncols;
-            hp += ncols;
         }
+
+        // padding: h is zero and c keeps the last state, so that c[len-1]
+        // is the final state of every sequence
+        for (int row = len_; row < len; ++row)
+        {
+            if (c != NULL) *(c + pos + row*stride) = cur;
+            if (!last_only) *(h + pos + row*stride) = 0.f;
+        }
+
+        if (last != NULL) *(last + col) = cur;
     }
 
     __global__ void sru_bwd(const float * __restrict__ u, const float * __restrict__ x,
                             const float * __restrict__ bias, const float * __restrict__ init,
-                            const float * __restrict__ mask_h, const float * __restrict__ c,
+                            const float * __restrict__ mask_h, const int * __restrict__ lengths,
+                            const unsigned char * __restrict__ reset,
+                            const float * __restrict__ c,
                             const float * __restrict__ grad_h, const float * __restrict__ grad_last,
+                            const float * __restrict__ grad_c,
                             const int len, const int batch, const int d, const int k,
                             float * __restrict__ grad_u, float * __restrict__ grad_x,
                             float * __restrict__ grad_bias, float * __restrict__ grad_init,
-                            int activation_type)
+                            int activation_type, const int light, const int nb,
+                            const int batch_first)
     {
-        assert((k == 3) || (x == NULL));
-        assert((k == 3) || (grad_x == NULL));
+        const int kx = light ? 2 : 3;
+
+        assert((k == kx) || (x == NULL));
+        assert((k == kx) || (grad_x == NULL));
 
         int ncols = batch*d;
         int col = blockIdx.x * blockDim.x + threadIdx.x;
         if (col >= ncols) return;
 
-        int ncols_u = ncols*k;
-        int ncols_x = (k == 3) ? ncols : ncols_u;
+        // with batch_first, h, c and x are (batch, len, d) and u is
+        // (batch, len, d, k): the steps of a column are d apart
+        const int pos = batch_first ? ((col/(d))*len*(d) + col%(d)) : col;
+        const int stride = batch_first ? (d) : ncols;
+
+        int ncols_u = stride*k;
+        int ncols_x = (k == kx) ? stride : ncols_u;
 
-        const float bias1 = *(bias + (col%d));
-        const float bias2 = *(bias + (col%d) + d);
+        const float bias1 = *(bias + (col%(nb*d)));
+        const float bias2 = *(bias + (col%(nb*d)) + nb*d);
         const float mask = (mask_h == NULL) ? 1.0 : (*(mask_h + col));
+        const int len_ = (lengths == NULL) ? len : (*(lengths + col/d));
         float gbias1 = 0;
         float gbias2 = 0;
         float cur = *(grad_last + col);
+        // gradient of the states that restart from init (see sru_fwd)
+        float ginit = 0;
+        const int rpos = batch_first ? (col/d)*len : col/d;
+        const int rstride = batch_first ? 1 : batch;
+
+        // padding gets no gradient
+        for (int row = len_; row < len; ++row)
+        {
+            float *gup = grad_u + (pos*k) + row*ncols_u;
+            for (int i = 0; i < k; ++i) *(gup+i) = 0.f;
+            if (k == kx) *(grad_x + pos + row*stride) = 0.f;
+        }
 
-        const float *up = u + (col*k) + (len-1)*ncols_u;
-        const float *xp = (k == 3) ? (x + col + (len-1)*ncols) : (up + 3);
-        const float *cp = c + col + (len-1)*ncols;
+        const float *up = u + (pos*k) + (len_-1)*ncols_u;
+        const float *xp = (k == kx) ? (x + pos + (len_-1)*stride) : (up + kx);
+        const float *cp = c + pos + (len_-1)*stride;
 
-        const float *ghp = grad_h + col + (len-1)*ncols;
-        float *gup = grad_u + (col*k) + (len-1)*ncols_u;
-        float *gxp = (k == 3) ? (grad_x + col + (len-1)*ncols) : (gup + 3);
+        const float *ghp = grad_h + pos + (len_-1)*stride;
+        float *gup = grad_u + (pos*k) + (len_-1)*ncols_u;
+        float *gxp = (k == kx) ? (grad_x + pos + (len_-1)*stride) : (gup + kx);
 
-        for (int row = len-1; row >= 0; --row)
+        for (int row = len_-1; row >= 0; --row)
         {
             const float g1 = sigmoidf((*(up+1))+bias1);
-            const float g2 = sigmoidf((*(up+2))+bias2);
+            const float g2 = sigmoidf((*(up+kx-1))+bias2);
 
             const float c_val = (activation_type == 1) ? tanh(*cp) : (
                 (activation_type == 2) ? reluf(*cp) : (*cp)
@@ -113,7 +172,8 @@ extern "C" {
 
             const float x_val = *xp;
             const float u_val = *up;
-            const float prev_c_val = (row>0) ? (*(cp-ncols)) : (*(init+col));
+            const bool rs = (reset != NULL) && reset[rpos + row*rstride];
+            const float prev_c_val = (row>0 && !rs) ? (*(cp-stride)) : (*(init+col));
 
             const float gh_val = *ghp;
 
@@ -125,13 +185,15 @@ extern "C" {
 
             // grad wrt g2, u2 and bias2
             float gg2 = gh_val*(c_val*mask-x_val)*(g2*(1-g2));
-            *(gup+2) = gg2;
+            if (!light) *(gup+2) = gg2;
             gbias2 += gg2;
 
             // grad wrt c
             const float tmp = (activation_type == 1) ? (g2*(1-c_val*c_val)) : (
                 ((activation_type == 0) || (c_val > 0)) ? g2 : 0.f
             );
+            // gradient that reaches c directly (states gathered per sequence)
+            if (grad_c != NULL) cur += *(grad_c + (cp - c));
             const float gc = gh_val*mask*tmp + cur;
 
             // grad wrt u0
@@ -139,102 +201,171 @@ extern "C" {
 
             // grad wrt g1, u1, and bias1
             float gg1 = gc*(prev_c_val-u_val)*(g1*(1-g1));
-            *(gup+1) = gg1;
+            *(gup+1) = light ? (gg1+gg2) : gg1;
             gbias1 += gg1;
 
             // grad wrt c'
             cur = gc*g1;
+            if (rs) {
+                ginit += cur;
+                cur = 0.f;
+            }
 
             up -= ncols_u;
             xp -= ncols_x;
-            cp -= ncols;
+            cp -= stride;
             gup -= ncols_u;
             gxp -= ncols_x;
-            ghp -= ncols;
+            ghp -= stride;
         }
 
-        *(grad_bias + col) = gbias1;
-        *(grad_bias + col + ncols) = gbias2;
-        *(grad_init +col) = cur;
+        // grad_bias is (2, nb, d) and zeroed by the caller: the columns that
+        // share a bias add up their gradients
+        atomicAdd(grad_bias + (col%(nb*d)), gbias1);
+        atomicAdd(grad_bias + (col%(nb*d)) + nb*d, gbias2);
+        *(grad_init +col) = cur + ginit;
     }
 
     __global__ void sru_bi_fwd(const float * __restrict__ u, const float * __restrict__ x,
                             const float * __restrict__ bias, const float * __restrict__ init,
-                            const float * __restrict__ mask_h,
+                            const float * __restrict__ mask_h, const int * __restrict__ lengths,
+                            const unsigned char * __restrict__ reset,
                             const int len, const int batch, const int d, const int k,
                             float * __restrict__ h, float * __restrict__ c,
-                            const int activation_type)
+                            float * __restrict__ last, const int last_only,
+                            const int activation_type, const int light, const int nb,
+                            const int batch_first, const int merge)
     {
-        assert ((k == 3) || (x == NULL));
-        assert ((k == 3) || (k == 4));
+        const int kx = light ? 2 : 3;
+
+        assert ((k == kx) || (x == NULL));
+        assert ((k == kx) || (k == kx+1));
 
         int ncols = batch*d*2;
         int col = blockIdx.x * blockDim.x + threadIdx.x;
         if (col >= ncols) return;
 
-        int ncols_u = ncols*k;
-        int ncols_x = (k == 3) ? ncols : ncols_u;
+        // with batch_first, h, c and x are (batch, len, d*2) and u is
+        // (batch, len, d*2, k): the steps of a column are d*2 apart
+        const int pos = batch_first ? ((col/(d*2))*len*(d*2) + col%(d*2)) : col;
+        const int stride = batch_first ? (d*2) : ncols;
+        // merge (1: sum, 2: mean): h, x and their gradients are (len, batch, d),
+        // both directions of unit j read x_j and add their output into h_j
+        const int hd = merge ? d : d*2;
+        const int hcol = (col/(d*2))*hd + col%hd;
+        const int hpos = batch_first ? ((col/(d*2))*len*hd + col%hd) : hcol;
+        const int hstride = batch_first ? hd : batch*hd;
+        const float hscale = (merge == 2) ? 0.5f : 1.f;
+
+        int ncols_u = stride*k;
+        int ncols_x = (k == kx) ? hstride : ncols_u;
         const float mask = (mask_h == NULL) ? 1.0 : (*(mask_h + col));
         float cur = *(init + col);
 
         const int d2 = d*2;
         const bool flip = (col%d2) >= d;
-
-        const float bias1 = *(bias + (col%d2));
-        const float bias2 = *(bias + (col%d2) + d2);
-        const float *up = u + (col*k);
-        const float *xp = (k == 3) ? (x + col) : (up + 3);
-        float *cp = c + col;
-        float *hp = h + col;
+        const int len_ = (lengths == NULL) ? len : (*(lengths + col/d2));
+
+        const float bias1 = *(bias + (col%(nb*d2)));
+        const float bias2 = *(bias + (col%(nb*d2)) + nb*d2);
+        // c may be NULL (inference), in which case only h and last are written.
+        // If last_only is set, h is (batch, d*2) and only gets the output at
+        // the last valid step of the sequence, in both directions.
+        const float *up = u + (pos*k);
+        const float *xp = (k == kx) ? (x + hpos) : (up + kx);
+        int row = 0;
+        // (with merge, h is zeroed by the caller)
+        if (last_only && (len_ == 0) && !merge) *(h + col) = 0.f;
 
         if (flip) {
-            up += (len-1)*ncols_u;
-            xp += (len-1)*ncols_x;
-            cp += (len-1)*ncols;
-            hp += (len-1)*ncols;
+            up += (len_-1)*ncols_u;
+            xp += (len_-1)*ncols_x;
+            row = len_-1;
         }
 
         int ncols_u_ = flip ? -ncols_u : ncols_u;
         int ncols_x_ = flip ? -ncols_x : ncols_x;
-        int ncols_ = flip ? -ncols : ncols;
+        int step = flip ? -1 : 1;
 
-        for (int cnt = 0; cnt < len; ++cnt)
+        const float init_val = cur;
+        // reset is (len, batch), or (batch, len) with batch_first, and set at
+        // the first step of every sequence packed into the column: c restarts
+        // from init there, and in the backward direction at the last step of
+        // every sequence but the last one
+        const int rpos = batch_first ? (col/d2)*len : col/d2;
+        const int rstride = batch_first ? 1 : batch;
+
+        for (int cnt = 0; cnt < len_; ++cnt)
         {
+            const int rrow = flip ? row+1 : row;
+            if ((reset != NULL) && (rrow < len_) && reset[rpos + rrow*rstride]) cur = init_val;
             float g1 = sigmoidf((*(up+1))+bias1);
-            float g2 = sigmoidf((*(up+2))+bias2);
             cur = (cur-(*up))*g1 + (*up);
-            *cp = cur;
-            float val = (activation_type == 1) ? tanh(cur) : (
-                (activation_type == 2) ? reluf(cur) : cur
-            );
-            *hp = (val*mask-(*xp))*g2 + (*xp);
+            if (c != NULL) *(c + pos + row*stride) = cur;
+            if (!last_only || (row == len_-1))
+            {
+                float g2 = sigmoidf((*(up+kx-1))+bias2);
+                float val = (activation_type == 1) ? tanh(cur) : (
+                    (activation_type == 2) ? reluf(cur) : cur
+                );
+                float *hp = h + (last_only ? hcol : hpos + row*hstride);
+                const float h_val = (val*mask-(*xp))*g2 + (*xp);
+                if (merge) atomicAdd(hp, h_val*hscale);
+                else *hp = h_val;
+            }
             up += ncols_u_;
             xp += ncols_x_;
-            cp += ncols_;
-            hp += ncols_;
+            row += step;
         }
 
+        // padding: h is zero; c keeps the last state in the forward direction
+        // and the initial state in the backward direction
+        for (int row = len_; row < len; ++row)
+        {
+            if (c != NULL) *(c + pos + row*stride) = flip ? init_val : cur;
+            if (!last_only && !merge) *(h + hpos + row*hstride) = 0.f;
+        }
+
+        if (last != NULL) *(last + col) = cur;
     }
 
     __global__ void sru_bi_bwd(const float * __restrict__ u, const float * __restrict__ x,
                             const float * __restrict__ bias, const float * __restrict__ init,
-                            const float * __restrict__ mask_h, const float * __restrict__ c,
+                            const float * __restrict__ mask_h, const int * __restrict__ lengths,
+                            const unsigned char * __restrict__ reset,
+                            const float * __restrict__ c,
                             const float * __restrict__ grad_h, const float * __restrict__ grad_last,
+                            const float * __restrict__ grad_c,
                             const int len, const int batch, const int d, const int k,
                             float * __restrict__ grad_u, float * __restrict__ grad_x,
                             float * __restrict__ grad_bias, float * __restrict__ grad_init,
-                            int activation_type)
+                            int activation_type, const int light, const int nb,
+                            const int batch_first, const int merge)
     {
-        assert((k == 3) || (x == NULL));
-        assert((k == 3) || (grad_x == NULL));
-        assert((k == 3) || (k == 4));
+        const int kx = light ? 2 : 3;
+
+        assert((k == kx) || (x == NULL));
+        assert((k == kx) || (grad_x == NULL));
+        assert((k == kx) || (k == kx+1));
 
         int ncols = batch*d*2;
         int col = blockIdx.x * blockDim.x + threadIdx.x;
         if (col >= ncols) return;
 
-        int ncols_u = ncols*k;
-        int ncols_x = (k == 3) ? ncols : ncols_u;
+        // with batch_first, h, c and x are (batch, len, d*2) and u is
+        // (batch, len, d*2, k): the steps of a column are d*2 apart
+        const int pos = batch_first ? ((col/(d*2))*len*(d*2) + col%(d*2)) : col;
+        const int stride = batch_first ? (d*2) : ncols;
+        // merge (1: sum, 2: mean): h, x and their gradients are (len, batch, d),
+        // both directions of unit j read x_j and add their output into h_j
+        const int hd = merge ? d : d*2;
+        const int hcol = (col/(d*2))*hd + col%hd;
+        const int hpos = batch_first ? ((col/(d*2))*len*hd + col%hd) : hcol;
+        const int hstride = batch_first ? hd : batch*hd;
+        const float hscale = (merge == 2) ? 0.5f : 1.f;
+
+        int ncols_u = stride*k;
+        int ncols_x = (k == kx) ? hstride : ncols_u;
 
         const float mask = (mask_h == NULL) ? 1.0 : (*(mask_h + col));
         float gbias1 = 0;
@@ -243,58 +374,78 @@ extern "C" {
 
         const int d2 = d*2;
         const bool flip = ((col%d2) >= d);
+        const int len_ = (lengths == NULL) ? len : (*(lengths + col/d2));
+        // gradient of the states that restart from init (see sru_bi_fwd)
+        float ginit = 0;
+        const int rpos = batch_first ? (col/d2)*len : col/d2;
+        const int rstride = batch_first ? 1 : batch;
+
+        // padding gets no gradient
+        for (int row = len_; row < len; ++row)
+        {
+            float *gup = grad_u + (pos*k) + row*ncols_u;
+            for (int i = 0; i < k; ++i) *(gup+i) = 0.f;
+            if ((k == kx) && !merge) *(grad_x + hpos + row*hstride) = 0.f;
+        }
 
-        const float bias1 = *(bias + (col%d2));
-        const float bias2 = *(bias + (col%d2) + d2);
-        const float *up = u + (col*k);
-        const float *xp = (k == 3) ? (x + col) : (up + 3);
-        const float *cp = c + col;
-        const float *ghp = grad_h + col;
-        float *gup = grad_u + (col*k);
-        float *gxp = (k == 3) ? (grad_x + col) : (gup + 3);
+        const float bias1 = *(bias + (col%(nb*d2)));
+        const float bias2 = *(bias + (col%(nb*d2)) + nb*d2);
+        const float *up = u + (pos*k);
+        const float *xp = (k == kx) ? (x + hpos) : (up + kx);
+        const float *cp = c + pos;
+        const float *ghp = grad_h + hpos;
+        float *gup = grad_u + (pos*k);
+        float *gxp = (k == kx) ? (grad_x + hpos) : (gup + kx);
 
         if (!flip) {
-            up += (len-1)*ncols_u;
-            xp += (len-1)*ncols_x;
-            cp += (len-1)*ncols;
-            ghp += (len-1)*ncols;
-            gup += (len-1)*ncols_u;
-            gxp += (len-1)*ncols_x;
+            up += (len_-1)*ncols_u;
+            xp += (len_-1)*ncols_x;
+            cp += (len_-1)*stride;
+            ghp += (len_-1)*hstride;
+            gup += (len_-1)*ncols_u;
+            gxp += (len_-1)*ncols_x;
         }
 
         int ncols_u_ = flip ? -ncols_u : ncols_u;
         int ncols_x_ = flip ? -ncols_x : ncols_x;
-        int ncols_ = flip ? -ncols : ncols;
+        int ncols_ = flip ? -stride : stride;
+        int ncols_h_ = flip ? -hstride : hstride;
 
-        for (int cnt = 0; cnt < len; ++cnt)
+        for (int cnt = 0; cnt < len_; ++cnt)
         {
             const float g1 = sigmoidf((*(up+1))+bias1);
-            const float g2 = sigmoidf((*(up+2))+bias2);
+            const float g2 = sigmoidf((*(up+kx-1))+bias2);
 
             const float c_val = (activation_type == 1) ? tanh(*cp) : (
                 (activation_type == 2) ? reluf(*cp) : (*cp)
             );
             const float x_val = *xp;
             const float u_val = *up;
-            const float prev_c_val = (cnt<len-1) ? (*(cp-ncols_)) : (*(init+col));
+            const int rrow = flip ? cnt+1 : len_-1-cnt;
+            const bool rs = (reset != NULL) && (rrow < len_) && reset[rpos + rrow*rstride];
+            const float prev_c_val = (cnt<len_-1 && !rs) ? (*(cp-ncols_)) : (*(init+col));
 
-            const float gh_val = *ghp;
+            const float gh_val = (*ghp)*hscale;
 
             // h = c*g2 + x*(1-g2) = (c-x)*g2 + x
             // c = c'*g1 + g0*(1-g1) = (c'-g0)*g1 + g0
 
-            // grad wrt x
-            *gxp = gh_val*(1-g2);
+            // grad wrt x (shared by both directions with merge, and zeroed
+            // by the caller)
+            if (merge && (k == kx)) atomicAdd(gxp, gh_val*(1-g2));
+            else *gxp = gh_val*(1-g2);
 
             // grad wrt g2, u2 and bias2
             float gg2 = gh_val*(c_val*mask-x_val)*(g2*(1-g2));
-            *(gup+2) = gg2;
+            if (!light) *(gup+2) = gg2;
             gbias2 += gg2;
 
             // grad wrt c
             const float tmp = (activation_type == 1) ? (g2*(1-c_val*c_val)) : (
                 ((activation_type == 0) || (c_val > 0)) ? g2 : 0.f
             );
+            // gradient that reaches c directly (states gathered per sequence)
+            if (grad_c != NULL) cur += *(grad_c + (cp - c));
             const float gc = gh_val*mask*tmp + cur;
 
             // grad wrt u0
@@ -302,168 +453,1683 @@ extern "C" {
 
             // grad wrt g1, u1, and bias1
             float gg1 = gc*(prev_c_val-u_val)*(g1*(1-g1));
-            *(gup+1) = gg1;
+            *(gup+1) = light ? (gg1+gg2) : gg1;
             gbias1 += gg1;
 
             // grad wrt c'
             cur = gc*g1;
+            if (rs) {
+                ginit += cur;
+                cur = 0.f;
+            }
 
             up -= ncols_u_;
             xp -= ncols_x_;
             cp -= ncols_;
             gup -= ncols_u_;
             gxp -= ncols_x_;
-            ghp -= ncols_;
+            ghp -= ncols_h_;
         }
 
-        *(grad_bias + col) = gbias1;
-        *(grad_bias + col + ncols) = gbias2;
-        *(grad_init +col) = cur;
+        // grad_bias is (2, nb, 2, d) and zeroed by the caller
+        atomicAdd(grad_bias + (col%(nb*d2)), gbias1);
+        atomicAdd(grad_bias + (col%(nb*d2)) + nb*d2, gbias2);
+        *(grad_init +col) = cur + ginit;
     }
 }
 """
 
-SRU_PROG = Program(SRU_CODE.encode('utf-8'), 'sru_prog.cu'.encode('utf-8'))
-SRU_PTX = SRU_PROG.compile()
-SRU_MOD = function.Module()
-SRU_MOD.load(bytes(SRU_PTX.encode()))
-SRU_FWD_FUNC = SRU_MOD.get_function('sru_fwd')
-SRU_BWD_FUNC = SRU_MOD.get_function('sru_bwd')
-SRU_BiFWD_FUNC = SRU_MOD.get_function('sru_bi_fwd')
-SRU_BiBWD_FUNC = SRU_MOD.get_function('sru_bi_bwd')
-
 Stream = namedtuple('Stream', ['ptr'])
-SRU_STREAM = Stream(ptr=torch.cuda.current_stream().cuda_stream)
-
-class SRU_Compute(Function):
 
-    def __init__(self, activation_type, d_out, bidirectional=False):
-        super(SRU_Compute, self).__init__()
-        self.activation_type = activation_type
-        self.d_out = d_out
-        self.bidirectional = bidirectional
-
-    def forward(self, u, x, bias, init=None, mask_h=None):
-        bidir = 2 if self.bidirectional else 1
-        length = x.size(0) if x.dim() == 3 else 1
-        batch = x.size(-2)
-        d = self.d_out
+################################################################################
+# CUDA backend
+#
+# cupy and pynvrtc are only imported, and SRU_CODE only compiled, on the first
+# SRU_Compute call on a CUDA tensor. The PTX is shared, the module is loaded
+# once per device. Kernels are launched on the current stream of the caller,
+# so that concurrent calls on different streams do not serialize.
+################################################################################
+
+SRU_PTX = None
+# held while kernels are compiled or loaded, so that threads which run SRU for
+# the first time at the same moment do it only once
+_SRU_LOAD_LOCK = threading.RLock()
+
+class SRUCudaKernels(object):
+    def __init__(self, device):
+        global SRU_PTX
+        from cupy.cuda import function
+        from pynvrtc.compiler import Program
+
+        with _SRU_LOAD_LOCK:
+            if SRU_PTX is None:
+                prog = Program(SRU_CODE.encode('utf-8'), 'sru_prog.cu'.encode('utf-8'))
+                SRU_PTX = prog.compile()
+
+        with torch.cuda.device(device):
+            self.module = function.Module()
+            self.module.load(bytes(SRU_PTX.encode()))
+            self.fwd_func = self.module.get_function('sru_fwd')
+            self.bwd_func = self.module.get_function('sru_bwd')
+            self.bi_fwd_func = self.module.get_function('sru_bi_fwd')
+            self.bi_bwd_func = self.module.get_function('sru_bi_bwd')
+
+    @staticmethod
+    def _stream(t):
+        return Stream(ptr=torch.cuda.current_stream(t.device).cuda_stream)
+
+    # The kernels are float only: half and bfloat16 inputs are converted
+    # before the launch and the outputs converted back.
+
+    def forward(self, u, x, bias, init, mask_h, d, activation_type, bidirectional,
+                lengths=None, last_only=False, light=False, batch_first=False, merge=0,
+                reset=None):
+        bidir = 2 if bidirectional else 1
+        _, batch = _sru_len_batch(x, batch_first)
+        dtype = u.dtype
+        u, x = u.float(), x.float()
+        size = (x.size(0), x.size(1), d*bidir) if x.dim() == 3 else (batch, d*bidir)
+        h_size = _sru_merged_size(size, d, merge)
+        c = x.new_empty(size)
+        h = x.new_empty((batch, h_size[-1]) if last_only else h_size)
+        self._launch_forward(u, x, bias, init, mask_h, d, activation_type,
+            bidirectional, lengths, h, c, None, last_only, light, batch_first, merge,
+            reset)
+        return h.to(dtype), c
+
+    def infer(self, u, x, bias, init, mask_h, d, activation_type, bidirectional,
+              lengths=None, out=None, last=None, last_only=False, light=False,
+              batch_first=False, merge=0, reset=None):
+        bidir = 2 if bidirectional else 1
+        _, batch = _sru_len_batch(x, batch_first)
+        dtype = u.dtype
+        u, x = u.float(), x.float()
+        size = (x.size(0), x.size(1), d*bidir) if x.dim() == 3 and not last_only \
+            else (batch, d*bidir)
+        size = _sru_merged_size(size, d, merge)
+        if out is None or out.dtype != x.dtype:
+            h = x.new_empty(size)
+        else:
+            h = out
+        if last is None:
+            last = x.new_empty(batch, d*bidir)
+        self._launch_forward(u, x, bias, init, mask_h, d, activation_type,
+            bidirectional, lengths, h, None, last, last_only, light, batch_first, merge,
+            reset)
+        if out is not None and out is not h:
+            return out.copy_(h), last
+        return h.to(dtype), last
+
+    def _launch_forward(self, u, x, bias, init, mask_h, d, activation_type,
+                        bidirectional, lengths, h, c, last, last_only=False,
+                        light=False, batch_first=False, merge=0, reset=None):
+        bidir = 2 if bidirectional else 1
+        length, batch = _sru_len_batch(x, batch_first)
         k = u.size(-1) // d
-        k_ = k//2 if self.bidirectional else k
+        k_ = k//2 if bidirectional else k
+        kx = _sru_gate_parts(light)
         ncols = batch*d*bidir
         thread_per_block = min(512, ncols)
         num_block = (ncols-1)//thread_per_block+1
+        if merge:
+            # both directions add their output into h
+            h.zero_()
+
+        FUNC = self.fwd_func if not bidirectional else self.bi_fwd_func
+        with torch.cuda.device(u.device):
+            FUNC(args=[
+                u.contiguous().data_ptr(),
+                x.contiguous().data_ptr() if k_ == kx else 0,
+                bias.data_ptr(),
+                init.contiguous().data_ptr(),
+                mask_h.data_ptr() if mask_h is not None else 0,
+                lengths.data_ptr() if lengths is not None else 0,
+                reset.data_ptr() if reset is not None else 0,
+                length,
+                batch,
+                d,
+                k_,
+                h.data_ptr(),
+                c.data_ptr() if c is not None else 0,
+                last.data_ptr() if last is not None else 0,
+                1 if last_only else 0,
+                activation_type,
+                1 if light else 0,
+                bias.numel() // (2*d*bidir),
+                1 if batch_first else 0] + ([merge] if bidirectional else []),
+                block = (thread_per_block,1,1), grid = (num_block,1,1),
+                stream=self._stream(u)
+            )
 
-        init_ = x.new(ncols).zero_() if init is None else init
-        size = (length, batch, d*bidir) if x.dim() == 3 else (batch, d*bidir)
-        c = x.new(*size)
-        h = x.new(*size)
-
-        FUNC = SRU_FWD_FUNC if not self.bidirectional else SRU_BiFWD_FUNC
-        FUNC(args=[
-            u.contiguous().data_ptr(),
-            x.contiguous().data_ptr() if k_ == 3 else 0,
-            bias.data_ptr(),
-            init_.contiguous().data_ptr(),
-            mask_h.data_ptr() if mask_h is not None else 0,
-            length,
-            batch,
-            d,
-            k_,
-            h.data_ptr(),
-            c.data_ptr(),
-            self.activation_type],
-            block = (thread_per_block,1,1), grid = (num_block,1,1),
-            stream=SRU_STREAM
-        )
-
-        self.save_for_backward(u, x, bias, init, mask_h)
-        self.intermediate = c
-        if x.dim() == 2:
-            last_hidden = c
-        elif self.bidirectional:
-            last_hidden = torch.cat((c[-1,:,:d], c[0,:,d:]), dim=1)
-        else:
-            last_hidden = c[-1]
-        return h, last_hidden
-
-    def backward(self, grad_h, grad_last):
-        bidir = 2 if self.bidirectional else 1
-        u, x, bias, init, mask_h = self.saved_tensors
-        c = self.intermediate
-        length = x.size(0) if x.dim() == 3 else 1
-        batch = x.size(-2)
-        d = self.d_out
+    def backward(self, u, x, bias, init, mask_h, c, grad_h, grad_last,
+                 d, activation_type, bidirectional, lengths=None, light=False,
+                 batch_first=False, merge=0, reset=None, grad_c=None):
+        dtype = u.dtype
+        u, x, grad_h = u.float(), x.float(), grad_h.float()
+        bidir = 2 if bidirectional else 1
+        length, batch = _sru_len_batch(x, batch_first)
         k = u.size(-1) // d
-        k_ = k//2 if self.bidirectional else k
+        k_ = k//2 if bidirectional else k
+        kx = _sru_gate_parts(light)
         ncols = batch*d*bidir
         thread_per_block = min(512, ncols)
         num_block = (ncols-1)//thread_per_block+1
 
-        init_ = x.new(ncols).zero_() if init is None else init
-        grad_u = u.new(*u.size())
-        grad_bias = x.new(2, batch, d*bidir)
-        grad_init = x.new(batch, d*bidir)
+        grad_u = u.new_empty(u.size())
+        # the kernels add the gradients of all columns into their bias
+        grad_bias = x.new_zeros(bias.numel())
+        grad_init = x.new_empty(batch, d*bidir)
 
         # For DEBUG
         #size = (length, batch, x.size(-1)) if x.dim() == 3 else (batch, x.size(-1))
-        #grad_x = x.new(*x.size()) if k_ == 3 else x.new(*size).zero_()
+        #grad_x = x.new(*x.size()) if k_ == kx else x.new(*size).zero_()
 
         # Normal use
-        grad_x = x.new(*x.size()) if k_ == 3 else None
-
-        FUNC = SRU_BWD_FUNC if not self.bidirectional else SRU_BiBWD_FUNC
-        FUNC(args=[
-            u.contiguous().data_ptr(),
-            x.contiguous().data_ptr() if k_ == 3 else 0,
-            bias.data_ptr(),
-            init_.contiguous().data_ptr(),
-            mask_h.data_ptr() if mask_h is not None else 0,
-            c.data_ptr(),
-            grad_h.contiguous().data_ptr(),
-            grad_last.contiguous().data_ptr(),
-            length,
-            batch,
-            d,
-            k_,
-            grad_u.data_ptr(),
-            grad_x.data_ptr() if k_ == 3 else 0,
-            grad_bias.data_ptr(),
-            grad_init.data_ptr(),
-            self.activation_type],
-            block = (thread_per_block,1,1), grid = (num_block,1,1),
-            stream=SRU_STREAM
+        grad_x = x.new_empty(x.size()) if k_ == kx else None
+        if merge and grad_x is not None:
+            # both directions add their gradient into the shared x
+            grad_x.zero_()
+
+        FUNC = self.bwd_func if not bidirectional else self.bi_bwd_func
+        with torch.cuda.device(u.device):
+            FUNC(args=[
+                u.contiguous().data_ptr(),
+                x.contiguous().data_ptr() if k_ == kx else 0,
+                bias.data_ptr(),
+                init.contiguous().data_ptr(),
+                mask_h.data_ptr() if mask_h is not None else 0,
+                lengths.data_ptr() if lengths is not None else 0,
+                reset.data_ptr() if reset is not None else 0,
+                c.data_ptr(),
+                grad_h.contiguous().data_ptr(),
+                grad_last.contiguous().data_ptr(),
+                grad_c.float().contiguous().data_ptr() if grad_c is not None else 0,
+                length,
+                batch,
+                d,
+                k_,
+                grad_u.data_ptr(),
+                grad_x.data_ptr() if k_ == kx else 0,
+                grad_bias.data_ptr(),
+                grad_init.data_ptr(),
+                activation_type,
+                1 if light else 0,
+                bias.numel() // (2*d*bidir),
+                1 if batch_first else 0] + ([merge] if bidirectional else []),
+                block = (thread_per_block,1,1), grid = (num_block,1,1),
+                stream=self._stream(u)
+            )
+        grad_x = grad_x.to(dtype) if grad_x is not None else None
+        return grad_u.to(dtype), grad_x, grad_bias, grad_init
+
+
+################################################################################
+# CPU backend
+#
+# Mirrors sru_fwd / sru_bwd (and their bidirectional variants) with the same
+# memory layout: u is (len, batch, bidir, d, k) and h, c, x are
+# (len, batch, bidir, d). Gates are computed for the whole sequence at once,
+# only the elementwise recurrence over time is left as a loop.
+#
+# The forward functions are annotated so that TorchScript can compile them:
+# scripted SRU modules run this implementation (see sru_compute).
+################################################################################
+
+def _sru_acc_dtype(dtype: torch.dtype) -> torch.dtype:
+    """ Type the recurrence accumulates in: float32 for half and bfloat16
+        inputs, the input type otherwise.
+    """
+    if dtype == torch.float16 or dtype == torch.bfloat16:
+        return torch.float32
+    return dtype
+
+def _sru_gate_parts(light: bool) -> int:
+    """ Number of parts of u besides the projected x: u0, u1 and u2, or only
+        u0 and u1 in the light variant, where both gates are computed from u1.
+        u has one more part when x is projected too.
+    """
+    return 2 if light else 3
+
+def _sru_len_batch(x: Tensor, batch_first: bool = False) -> Tuple[int, int]:
+    """ (len, batch) of the input x of the recurrence: (len, batch, n),
+        (batch, len, n) with batch_first, or a single step (batch, n).
+    """
+    if x.dim() == 2:
+        return 1, x.size(0)
+    if batch_first:
+        return x.size(1), x.size(0)
+    return x.size(0), x.size(1)
+
+def _sru_merged_size(size: List[int], d: int, merge: int) -> List[int]:
+    """ Size of h for a cell state of the given size: with merge (1: sum,
+        2: mean), the two directions share their d features.
+    """
+    size = list(size)
+    if merge > 0:
+        size[-1] = d
+    return size
+
+def _sru_activation(c: Tensor, activation_type: int) -> Tensor:
+    if activation_type == 1:
+        return c.tanh()
+    elif activation_type == 2:
+        return c.clamp(min=0)
+    return c
+
+def _sru_length_mask(lengths: Tensor, length: int, like: Tensor) -> Tensor:
+    """ (len, batch, 1, 1) mask that is 1 on the valid steps of each column. """
+    steps = torch.arange(length, device=like.device).long().view(-1, 1)
+    valid = steps < lengths.to(like.device).long().view(1, -1)
+    return valid.to(like.dtype).view(length, -1, 1, 1)
+
+def _sru_last_row(lengths: Optional[Tensor], length: int, batch: int,
+                  device: torch.device) -> Tensor:
+    """ Index of the last valid step of each example (0 when it is empty). """
+    if lengths is None:
+        return torch.full((batch,), length-1, dtype=torch.long, device=device)
+    return (lengths.long()-1).clamp(min=0).to(device)
+
+def _sru_reset_mask(reset: Tensor, length: int, bidir: int,
+                    valid: Optional[Tensor], like: Tensor) -> Tensor:
+    """ (len, batch, bidir, 1) mask of the steps at which c restarts from
+        init: the steps where reset is set in the forward direction, and the
+        steps before them in the backward direction. Resets on padding are
+        ignored.
+    """
+    r = reset.to(like.dtype).reshape(length, -1, 1, 1)
+    if valid is not None:
+        r = r*valid
+    if bidir == 2:
+        r = torch.cat([r, torch.cat([r[1:], torch.zeros_like(r[:1])], 0)], 2)
+    return r
+
+def _sru_cpu_gates(u: Tensor, x: Tensor, bias: Tensor, length: int, batch: int,
+                   d: int, k: int, bidir: int,
+                   light: bool = False) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+    kx = _sru_gate_parts(light)
+    u_ = u.contiguous().view(length, batch, bidir, d, k)
+    # (with merge, the two directions share x: its third dim is 1)
+    x_ = u_[..., kx] if k == kx+1 else x.contiguous().view(length, batch, -1, d)
+    # bias may hold nb sets of biases, (2, nb, bidir, d): example b uses set
+    # b % nb (e.g. the members of an SRUEnsemble)
+    nb = bias.numel() // (2*bidir*d)
+    bias_ = bias.view(2, 1, nb, bidir, d)
+    size = [length, batch//nb, nb, bidir, d]
+    g1 = torch.sigmoid(u_[..., 1].reshape(size) + bias_[0]).view(length, batch, bidir, d)
+    g2 = torch.sigmoid(u_[..., kx-1].reshape(size) + bias_[1]).view(length, batch, bidir, d)
+    return u_, x_, g1, g2
+
+def _sru_cpu_recurrence(a: Tensor, b: Tensor, init: Tensor,
+                        reverse: bool = False) -> Tuple[Tensor, Tensor]:
+    """ Computes s_t = s_{t-1}*a_t + b_t over dim 0 (or over reversed
+        time if reverse is set), starting from s = init.
+    """
+    out = torch.empty_like(b)
+    length = a.size(0)
+    cur = init
+    for i in range(length):
+        t = length-1-i if reverse else i
+        cur = torch.addcmul(b[t], cur, a[t])
+        out[t] = cur
+    return out, cur
+
+def _sru_cpu_scan(a: Tensor, b: Tensor, init: Tensor,
+                  reverse: bool = False) -> Tuple[Tensor, Tensor]:
+    """ Same result as _sru_cpu_recurrence, computed with a Hillis-Steele
+        scan over time: log2(len) vectorized steps instead of len sequential
+        ones, at the cost of O(len*log(len)) work.
+    """
+    length = a.size(0)
+    if reverse:
+        a, b = a.flip([0]), b.flip([0])
+    a = a.clone()
+    b = b.clone()
+    b[0] = torch.addcmul(b[0], init, a[0])
+    offset = 1
+    while offset < length:
+        # (a2, b2) o (a1, b1) = (a2*a1, a2*b1 + b2)
+        b[offset:] = torch.addcmul(b[offset:], a[offset:], b[:-offset])
+        if offset*2 < length:
+            a[offset:] = a[offset:]*a[:-offset]
+        offset *= 2
+    if reverse:
+        b = b.flip([0])
+        return b, b[0]
+    return b, b[-1]
+
+@torch.jit.unused
+def _sru_export_recurrence(a: Tensor, b: Tensor, init: Tensor,
+                           reverse: bool = False) -> Tuple[Tensor, Tensor]:
+    """ Same result as _sru_cpu_recurrence, written with torch's scan
+        operator so that the ONNX exporter emits it as a Scan node instead
+        of unrolling the loop over time.
+    """
+    from torch._higher_order_ops.scan import scan
+    def step(cur, ab):
+        cur = torch.addcmul(ab[1], cur, ab[0])
+        return cur, cur.clone()
+    last, out = scan(step, init.contiguous(), (a, b), reverse=reverse)
+    return out, last
+
+def sru_cpu_forward(u: Tensor, x: Tensor, bias: Tensor, init: Tensor,
+                    mask_h: Optional[Tensor], d: int, activation_type: int,
+                    bidirectional: bool, lengths: Optional[Tensor] = None,
+                    scan: bool = False, last_only: bool = False,
+                    light: bool = False, batch_first: bool = False,
+                    merge: int = 0, reset: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+    """ CPU version of sru_fwd / sru_bi_fwd. Returns (h, c).
+        If scan is set, the recurrence is computed with a parallel scan over
+        time instead of a sequential loop. If last_only is set, h is
+        (batch, d*bidir) and holds the output at the last valid step only.
+        Half and bfloat16 inputs are computed in float32; h is returned in
+        the type of u and c in float32. During ONNX export the recurrence
+        becomes a Scan over time. With batch_first, u, x, h and c are
+        (batch, len, ...). With merge (1: sum, 2: mean), h and x have d
+        features, shared by both directions. reset (len, batch), or
+        (batch, len) with batch_first, marks the steps at which c restarts
+        from init, the first steps of the sequences packed into each column.
+    """
+    batch_first = batch_first and x.dim() == 3
+    if batch_first:
+        # computed in (len, batch) order
+        u = u.view(x.size(0), x.size(1), -1).transpose(0, 1)
+        x = x.transpose(0, 1)
+        if reset is not None:
+            reset = reset.transpose(0, 1)
+    bidir = 2 if bidirectional else 1
+    length = x.size(0) if x.dim() == 3 else 1
+    batch = x.size(-2)
+    k = u.size(-1) // d // bidir
+    dtype = u.dtype
+    acc = _sru_acc_dtype(dtype)
+    u, x = u.to(acc), x.to(acc)
+    u_, x_, g1, g2 = _sru_cpu_gates(u, x, bias, length, batch, d, k, bidir, light)
+
+    # c = (c'-u0)*g1 + u0 = c'*g1 + u0*(1-g1)
+    u0 = u_[..., 0]
+    a = g1
+    b = u0 - u0*g1
+    valid: Optional[Tensor] = None
+    if lengths is not None:
+        # c passes through padding unchanged: the forward direction keeps its
+        # last state, the backward direction starts at its last valid step
+        valid = _sru_length_mask(lengths, length, g1)
+    init_ = init.contiguous().view(batch, bidir, d)
+    if reset is not None:
+        # c_t = init*g1_t + u0_t*(1-g1_t) where a new sequence starts
+        r = _sru_reset_mask(reset, length, bidir, valid, g1)
+        b = b + a*r*init_
+        a = a*(1-r)
+    if valid is not None:
+        a = a*valid + (1-valid)
+        b = b*valid
+    exporting = False
+    if not torch.jit.is_scripting():
+        exporting = torch.onnx.is_in_onnx_export()
+    c = torch.empty_like(b)
+    for i in range(bidir):
+        if exporting:
+            c_i, _ = _sru_export_recurrence(a[:, :, i], b[:, :, i], init_[:, i], i == 1)
+        elif scan:
+            c_i, _ = _sru_cpu_scan(a[:, :, i], b[:, :, i], init_[:, i], i == 1)
+        else:
+            c_i, _ = _sru_cpu_recurrence(a[:, :, i], b[:, :, i], init_[:, i], i == 1)
+        c[:, :, i] = c_i
+
+    size = [length, batch, d*bidir] if x.dim() == 3 else [batch, d*bidir]
+    last_only = last_only and x.dim() == 3
+    c_h, x_h, g2_h = c, x_, g2
+    if last_only:
+        rows = _sru_last_row(lengths, length, batch, c.device)
+        cols = torch.arange(batch, device=c.device)
+        c_h, x_h, g2_h = c[rows, cols], x_[rows, cols], g2[rows, cols]
+
+    val = _sru_activation(c_h, activation_type)
+    if mask_h is not None:
+        val = val*mask_h.view(batch, bidir, d)
+    h = (val-x_h)*g2_h + x_h
+    if lengths is not None and last_only:
+        h = h*(lengths > 0).to(h.device, h.dtype).view(batch, 1, 1)
+    elif valid is not None:
+        h = h*valid
+    if merge == 1:
+        h = h.sum(-2)
+    elif merge == 2:
+        h = h.mean(-2)
+
+    h_size = _sru_merged_size([batch, d*bidir] if last_only else size, d, merge)
+    h = h.contiguous().view(h_size).to(dtype)
+    c = c.view(size)
+    if batch_first:
+        c = c.transpose(0, 1).contiguous()
+        if not last_only:
+            h = h.transpose(0, 1).contiguous()
+    return h, c
+
+def sru_cpu_backward(u, x, bias, init, mask_h, c, grad_h, grad_last,
+                     d, activation_type, bidirectional, lengths=None, scan=False,
+                     light=False, batch_first=False, merge=0, reset=None, grad_c=None):
+    """ CPU version of sru_bwd / sru_bi_bwd. grad_c optionally gives the
+        gradient of every cell state, in the layout of c.
+        Returns (grad_u, grad_x, grad_bias, grad_init).
+    """
+    batch_first = batch_first and x.dim() == 3
+    u_size = u.size()
+    if batch_first:
+        u = u.view(x.size(0), x.size(1), -1).transpose(0, 1)
+        x, c, grad_h = [ t.transpose(0, 1) for t in (x, c, grad_h) ]
+        if reset is not None:
+            reset = reset.transpose(0, 1)
+        if grad_c is not None:
+            grad_c = grad_c.transpose(0, 1)
+    bidir = 2 if bidirectional else 1
+    length = x.size(0) if x.dim() == 3 else 1
+    batch = x.size(-2)
+    k = u.size(-1) // d // bidir
+    dtype = u.dtype
+    acc = _sru_acc_dtype(dtype)
+    u, x, grad_h = u.to(acc), x.to(acc), grad_h.to(acc)
+    u_, x_, g1, g2 = _sru_cpu_gates(u, x, bias, length, batch, d, k, bidir, light)
+
+    c_ = c.contiguous().view(length, batch, bidir, d)
+    gh = grad_h.contiguous().view(length, batch, -1, d)
+    if merge == 2:
+        gh = gh*0.5
+    mask = 1.0 if mask_h is None else mask_h.view(batch, bidir, d)
+    init_ = init.contiguous().view(batch, bidir, d)
+    g1_ = g1
+    valid = None
+    if lengths is not None:
+        # padding passes gradients through unchanged and receives none
+        valid = _sru_length_mask(lengths, length, g1)
+        gh = gh*valid
+        g1_ = g1*valid + (1-valid)
+    r = None
+    if reset is not None:
+        # no gradient flows into the state before a reset, it goes to init
+        r = _sru_reset_mask(reset, length, bidir, valid, g1)
+        g1_ = g1_*(1-r)
+
+    # h = (c-x)*g2 + x
+    c_val = _sru_activation(c_, activation_type)
+    grad_x = gh*(1-g2)
+    gg2 = gh*(c_val*mask-x_)*(g2*(1-g2))
+
+    # grad wrt c, accumulated backwards through c = c'*g1 + u0*(1-g1):
+    #   gc_t = gh_t*mask*act'(c_t)*g2_t + gc_{t+1}*g1_{t+1}
+    if activation_type == 1:
+        tmp = g2*(1-c_val*c_val)
+    elif activation_type == 2:
+        tmp = g2*(c_val > 0).type_as(g2)
+    else:
+        tmp = g2
+    a = gh*mask*tmp
+    if grad_c is not None:
+        grad_c_ = grad_c.to(acc).contiguous().view(length, batch, bidir, d)
+        a = a + (grad_c_*valid if valid is not None else grad_c_)
+    recurrence = _sru_cpu_scan if scan else _sru_cpu_recurrence
+    gc = a.new(*a.size())
+    prev_c = c_.new(*c_.size())
+    grad_init = a.new(batch, bidir, d)
+    grad_last_ = grad_last.contiguous().view(batch, bidir, d)
+    for i in range(bidir):
+        # g1 of the step that follows t, in the direction's own order
+        g1_next = g1[:, :, i].new(*g1[:, :, i].size())
+        if i == 0:
+            g1_next[:-1] = g1_[1:, :, 0]
+            g1_next[-1] = 1
+            prev_c[1:, :, 0] = c_[:-1, :, 0]
+            prev_c[0, :, 0] = init_[:, 0]
+        else:
+            g1_next[1:] = g1_[:-1, :, 1]
+            g1_next[0] = 1
+            prev_c[:-1, :, 1] = c_[1:, :, 1]
+            prev_c[-1, :, 1] = init_[:, 1]
+        gc[:, :, i], _ = recurrence(
+            g1_next, a[:, :, i], grad_last_[:, i], reverse=(i == 0)
         )
-        return grad_u, grad_x, grad_bias.sum(1).view(-1), grad_init, None
+        first = 0 if i == 0 else -1
+        grad_init[:, i] = gc[first, :, i]*g1_[first, :, i]
+    if r is not None:
+        prev_c = prev_c + r*(init_-prev_c)
+        grad_init = grad_init + (gc*g1*r).sum(0)
+
+    u0 = u_[..., 0]
+    grad_u0 = gc*(1-g1)
+    gg1 = gc*(prev_c-u0)*(g1*(1-g1))
+    if lengths is not None:
+        grad_u0 = grad_u0*valid
+        gg1 = gg1*valid
+    # in the light variant u1 feeds both gates
+    grad_u_lst = [grad_u0, gg1+gg2] if light else [grad_u0, gg1, gg2]
+    kx = _sru_gate_parts(light)
+    if k == kx+1:
+        grad_u_lst.append(grad_x)
+    grad_u = torch.stack(grad_u_lst, dim=-1).view(*u.size()).to(dtype)
+    if merge > 0 and k == kx:
+        grad_x = grad_x.sum(2)
+    grad_x = grad_x.contiguous().view(*x.size()).to(dtype) if k == kx else None
+    nb = bias.numel() // (2*bidir*d)
+    size = [length*batch//nb, nb, bidir, d]
+    grad_bias = torch.stack([gg1.reshape(size).sum(0), gg2.reshape(size).sum(0)]).view(-1)
+    if batch_first:
+        grad_u = grad_u.transpose(0, 1).reshape(u_size)
+        if grad_x is not None:
+            grad_x = grad_x.transpose(0, 1).contiguous()
+    return grad_u, grad_x, grad_bias, grad_init.view(batch, d*bidir)
+
+def sru_cpu_infer(u, x, bias, init, mask_h, d, activation_type, bidirectional,
+                  lengths=None, out=None, last=None, scan=False, last_only=False,
+                  light=False, batch_first=False, merge=0, reset=None):
+    """ Forward pass for inference. Returns (h, last) and writes them into
+        out / last when given.
+    """
+    h, c = sru_cpu_forward(u, x, bias, init, mask_h, d, activation_type,
+        bidirectional, lengths, scan, last_only, light, batch_first, merge, reset)
+    last_ = sru_last_state(c, d, bidirectional, batch_first)
+    if out is not None:
+        h = out.copy_(h.view_as(out))
+    if last is not None:
+        last_ = last.copy_(last_)
+    return h, last_
+
+def sru_last_state(c: Tensor, d: int, bidirectional: bool,
+                   batch_first: bool = False) -> Tensor:
+    """ Final state of every column: the last step of the forward direction
+        and the first step of the backward direction.
+    """
+    if c.dim() == 2:
+        return c
+    if batch_first:
+        c = c.transpose(0, 1)
+    if bidirectional:
+        return torch.cat((c[-1,:,:d], c[0,:,d:]), dim=1)
+    return c[-1]
+
+
+################################################################################
+# Compiled CPU backend
+#
+# Same recurrence as SRU_CODE, compiled with torch.utils.cpp_extension on first
+# use. Columns are split into blocks of (batch, direction, SRU_CPU_BLOCK units)
+# that run on separate OpenMP threads; within a block the time loop is outer
+# and the unit loop is vectorized. The gates and the activation of c are
+# computed for all steps at once by ATen, whose exp and tanh are vectorized,
+# so that the time loops only do multiply-adds: the forward pass runs the
+# recurrence, then the output of every step.
+################################################################################
+
+SRU_CPU_CODE = """
+#include <torch/extension.h>
+#include <ATen/OpMathType.h>
+#include <algorithm>
+#include <cmath>
+#include <vector>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+#define SRU_CPU_BLOCK 64
+
+// sigmoid(u_part + bias[which]) at every step, in the layout of c:
+// (len, batch, bidir*d), or (batch, len, bidir*d) with batch_first. Computed
+// by ATen, whose vectorized exp runs outside the time loop of the kernels.
+static torch::Tensor sru_gate(const torch::Tensor &u, const torch::Tensor &bias,
+                              int64_t part, int64_t which, int64_t len, int64_t batch,
+                              int64_t d, int64_t k, int64_t bidir, bool batch_first)
+{
+    // bias is (2, nb, bidir, d), example b uses set b%nb
+    const int64_t nb = bias.numel() / (2*bidir*d);
+    auto b = bias.view({2, nb, bidir, d}).select(0, which);
+    torch::Tensor g;
+    if (batch_first) {
+        g = u.view({batch/nb, nb, len, bidir, d, k}).select(5, part);
+        b = b.view({nb, 1, bidir, d});
+    } else {
+        g = u.view({len, batch/nb, nb, bidir, d, k}).select(5, part);
+    }
+    g = at::sigmoid(g.to(bias.scalar_type()) + b);
+    return batch_first ? g.reshape({batch, len, bidir*d}) : g.reshape({len, batch, bidir*d});
+}
+
+static torch::Tensor sru_activation(const torch::Tensor &c, int64_t activation_type)
+{
+    return (activation_type == 1) ? at::tanh(c) : (
+        (activation_type == 2) ? at::relu(c) : c
+    );
+}
+
+// c = (c'-u0)*g1 + u0 over time, with g1 computed beforehand (see sru_gate),
+// so that the time loop only does multiply-adds. c (len, batch, d*bidir) is
+// written at every step, and last, if not NULL, gets the final state.
+template <typename scalar_t, typename acc_t = at::opmath_type<scalar_t>>
+static void sru_cpu_rec_kernel(const scalar_t * __restrict__ u, const acc_t * __restrict__ g1,
+                               const acc_t * __restrict__ init, const int * __restrict__ lengths,
+                               const bool * __restrict__ reset,
+                               const int64_t len, const int64_t batch, const int64_t d,
+                               const int64_t k, const int64_t bidir, const bool batch_first,
+                               acc_t * __restrict__ c, acc_t * __restrict__ last)
+{
+    const int64_t ncols = batch*d*bidir;
+    // with batch_first, c is (batch, len, d*bidir) and u is
+    // (batch, len, d*bidir, k): the steps of a column are d*bidir apart
+    const int64_t stride = batch_first ? d*bidir : ncols;
+    const int64_t ncols_u = stride*k;
+    const int64_t nblk = (d-1)/SRU_CPU_BLOCK+1;
+
+    #pragma omp parallel for schedule(static)
+    for (int64_t task = 0; task < batch*bidir*nblk; ++task)
+    {
+        const int64_t slab = task/nblk;
+        const int64_t dir = slab % bidir;
+        const int64_t j0 = (task%nblk)*SRU_CPU_BLOCK;
+        const int64_t n = std::min<int64_t>(SRU_CPU_BLOCK, d-j0);
+        const int64_t col0 = slab*d + j0;
+        // offset of the first step of the block in c and u
+        const int64_t pos0 = batch_first ? col0 + (slab/bidir)*(len-1)*bidir*d : col0;
+        const int64_t len_ = (lengths == NULL) ? len : lengths[slab/bidir];
+
+        // reset is (len, batch), or (batch, len) with batch_first, and set at
+        // the first step of every sequence packed into the column: c restarts
+        // from init there, and in the backward direction at the last step of
+        // every sequence but the last one
+        const int64_t rpos = batch_first ? (slab/bidir)*len : slab/bidir;
+        const int64_t rstride = batch_first ? 1 : batch;
+
+        acc_t cur[SRU_CPU_BLOCK];
+        std::copy(init + col0, init + col0 + n, cur);
+
+        for (int64_t cnt = 0; cnt < len_; ++cnt)
+        {
+            const int64_t row = (dir == 1) ? (len_-1-cnt) : cnt;
+            const scalar_t *up = u + row*ncols_u + pos0*k;
+            const acc_t *g1p = g1 + row*stride + pos0;
+            acc_t *cp = c + row*stride + pos0;
+            const int64_t rrow = (dir == 1) ? row+1 : row;
+            if ((reset != NULL) && (rrow < len_) && reset[rpos + rrow*rstride]) {
+                std::copy(init + col0, init + col0 + n, cur);
+            }
+            #pragma omp simd
+            for (int64_t j = 0; j < n; ++j)
+            {
+                const acc_t u0 = up[j*k];
+                cur[j] = (cur[j]-u0)*g1p[j] + u0;
+                cp[j] = cur[j];
+            }
+        }
+
+        // padding: c keeps the last state in the forward direction and the
+        // initial state in the backward direction
+        for (int64_t row = len_; row < len; ++row)
+        {
+            for (int64_t j = 0; j < n; ++j) {
+                c[row*stride+pos0+j] = (dir == 1) ? init[col0+j] : cur[j];
+            }
+        }
+
+        if (last != NULL) {
+            std::copy(cur, cur+n, last + col0);
+        }
+    }
+}
+
+// h = (act(c)*mask - x)*g2 + x from the activated states act (in the layout
+// of c) and g2 (see sru_gate); steps past the length of a column are zero.
+// If last_only is set, h is (batch, d*bidir) and only gets the output at the
+// last valid step of every sequence.
+template <typename scalar_t, typename acc_t = at::opmath_type<scalar_t>>
+static void sru_cpu_out_kernel(const scalar_t * __restrict__ u, const scalar_t * __restrict__ x,
+                               const acc_t * __restrict__ g2, const acc_t * __restrict__ act,
+                               const acc_t * __restrict__ mask_h, const int * __restrict__ lengths,
+                               const int64_t len, const int64_t batch, const int64_t d,
+                               const int64_t k, const int64_t bidir,
+                               scalar_t * __restrict__ h, const bool last_only,
+                               const bool light, const bool batch_first, const int merge)
+{
+    const int64_t ncols = batch*d*bidir;
+    const int64_t stride = batch_first ? d*bidir : ncols;
+    // merge (1: sum, 2: mean): h, x and their gradients are (len, batch, d),
+    // both directions of unit j read x_j and add their output into h_j
+    const int64_t hd = merge ? d : d*bidir;
+    const int64_t hstride = batch_first ? hd : batch*hd;
+    const acc_t hscale = (merge == 2) ? acc_t(0.5) : acc_t(1);
+    const int64_t ncols_u = stride*k;
+    const int64_t kx = light ? 2 : 3;
+    const int64_t ncols_x = (k == kx) ? hstride : ncols_u;
+    const int64_t xk = (k == kx) ? 1 : k;
+    const int64_t nblk = (d-1)/SRU_CPU_BLOCK+1;
+
+    // with merge, the two directions of a block run one after the other in
+    // the same task, as they write the same part of h
+    const int64_t group = merge ? bidir : 1;
+    #pragma omp parallel for schedule(static)
+    for (int64_t g = 0; g < batch*bidir*nblk/group; ++g)
+    for (int64_t task = g*group; task < (g+1)*group; ++task)
+    {
+        const int64_t slab = merge ? (task/bidir/nblk)*bidir + task%bidir : task/nblk;
+        const int64_t dir = slab % bidir;
+        const int64_t j0 = (merge ? (task/bidir)%nblk : task%nblk)*SRU_CPU_BLOCK;
+        const int64_t n = std::min<int64_t>(SRU_CPU_BLOCK, d-j0);
+        const int64_t col0 = slab*d + j0;
+        // offset of the first step of the block in c and u, and in h and x
+        const int64_t pos0 = batch_first ? col0 + (slab/bidir)*(len-1)*bidir*d : col0;
+        const int64_t hcol0 = merge ? (slab/bidir)*d + j0 : col0;
+        const int64_t hpos0 = batch_first ? hcol0 + (slab/bidir)*(len-1)*hd : hcol0;
+        // the second direction adds to the output of the first one
+        const bool add = merge && (dir == 1);
+        const int64_t len_ = (lengths == NULL) ? len : lengths[slab/bidir];
+
+        acc_t mask[SRU_CPU_BLOCK];
+        for (int64_t j = 0; j < n; ++j) {
+            mask[j] = (mask_h == NULL) ? acc_t(1) : mask_h[col0+j];
+        }
+
+        if (last_only && (len_ == 0) && !add) {
+            std::fill(h + hcol0, h + hcol0 + n, scalar_t(0));
+        }
+
+        for (int64_t row = last_only ? std::max<int64_t>(len_-1, 0) : 0; row < len_; ++row)
+        {
+            const scalar_t *up = u + row*ncols_u + pos0*k;
+            const scalar_t *xp = (k == kx) ? (x + row*ncols_x + hpos0) : (up + kx);
+            const acc_t *g2p = g2 + row*stride + pos0;
+            const acc_t *ap = act + row*stride + pos0;
+            scalar_t *hp = last_only ? (h + hcol0) : (h + row*hstride + hpos0);
+            acc_t hv[SRU_CPU_BLOCK];
+            #pragma omp simd
+            for (int64_t j = 0; j < n; ++j)
+            {
+                const acc_t x_val = xp[j*xk];
+                hv[j] = ((ap[j]*mask[j]-x_val)*g2p[j] + x_val)*hscale;
+            }
+            if (add) {
+                for (int64_t j = 0; j < n; ++j) hp[j] = scalar_t(acc_t(hp[j]) + hv[j]);
+            } else {
+                for (int64_t j = 0; j < n; ++j) hp[j] = scalar_t(hv[j]);
+            }
+        }
+
+        // padding: h is zero
+        if (!last_only && !add) {
+            for (int64_t row = len_; row < len; ++row) {
+                std::fill(h + row*hstride + hpos0, h + row*hstride + hpos0 + n, scalar_t(0));
+            }
+        }
+    }
+}
+
+// g1, g2 and act, the activated states, are computed beforehand (see
+// sru_gate), in the layout of c
+template <typename scalar_t, typename acc_t = at::opmath_type<scalar_t>>
+static void sru_cpu_bwd_kernel(const scalar_t * __restrict__ u, const scalar_t * __restrict__ x,
+                               const acc_t * __restrict__ bias, const acc_t * __restrict__ init,
+                               const acc_t * __restrict__ mask_h, const int * __restrict__ lengths,
+                               const bool * __restrict__ reset,
+                               const acc_t * __restrict__ c,
+                               const acc_t * __restrict__ g1, const acc_t * __restrict__ g2,
+                               const acc_t * __restrict__ act,
+                               const scalar_t * __restrict__ grad_h, const acc_t * __restrict__ grad_last,
+                               const acc_t * __restrict__ grad_c,
+                               const int64_t len, const int64_t batch, const int64_t d,
+                               const int64_t k, const int64_t bidir,
+                               scalar_t * __restrict__ grad_u, scalar_t * __restrict__ grad_x,
+                               acc_t * __restrict__ grad_bias, acc_t * __restrict__ grad_init,
+                               const int activation_type, const bool light,
+                               const int64_t nb, const bool batch_first,
+                               const int merge)
+{
+    const int64_t ncols = batch*d*bidir;
+    // with batch_first, h, c and x are (batch, len, d*bidir) and u is
+    // (batch, len, d*bidir, k): the steps of a column are d*bidir apart
+    const int64_t stride = batch_first ? d*bidir : ncols;
+    // merge (1: sum, 2: mean): h, x and their gradients are (len, batch, d),
+    // both directions of unit j read x_j and add their output into h_j
+    const int64_t hd = merge ? d : d*bidir;
+    const int64_t hstride = batch_first ? hd : batch*hd;
+    const acc_t hscale = (merge == 2) ? acc_t(0.5) : acc_t(1);
+    const int64_t ncols_u = stride*k;
+    const int64_t kx = light ? 2 : 3;
+    const int64_t ncols_x = (k == kx) ? hstride : ncols_u;
+    const int64_t xk = (k == kx) ? 1 : k;
+    const int64_t nblk = (d-1)/SRU_CPU_BLOCK+1;
+
+    // with merge, the two directions of a block run one after the other in
+    // the same task, as they write the same part of h
+    const int64_t group = merge ? bidir : 1;
+    #pragma omp parallel for schedule(static)
+    for (int64_t g = 0; g < batch*bidir*nblk/group; ++g)
+    for (int64_t task = g*group; task < (g+1)*group; ++task)
+    {
+        const int64_t slab = merge ? (task/bidir/nblk)*bidir + task%bidir : task/nblk;
+        const int64_t dir = slab % bidir;
+        const int64_t j0 = (merge ? (task/bidir)%nblk : task%nblk)*SRU_CPU_BLOCK;
+        const int64_t n = std::min<int64_t>(SRU_CPU_BLOCK, d-j0);
+        const int64_t col0 = slab*d + j0;
+        // offset of the first step of the block in c and u, and in h and x
+        const int64_t pos0 = batch_first ? col0 + (slab/bidir)*(len-1)*bidir*d : col0;
+        const int64_t hcol0 = merge ? (slab/bidir)*d + j0 : col0;
+        const int64_t hpos0 = batch_first ? hcol0 + (slab/bidir)*(len-1)*hd : hcol0;
+        // the second direction adds to the output of the first one
+        const bool add = merge && (dir == 1);
+        const int64_t len_ = (lengths == NULL) ? len : lengths[slab/bidir];
+        // bias is (2, nb, bidir, d), example b uses set b%nb
+        const acc_t *b1 = bias + ((slab/bidir)%nb*bidir + dir)*d + j0;
+        const acc_t *b2 = b1 + nb*bidir*d;
+
+        // padding gets no gradient
+        for (int64_t row = len_; row < len; ++row)
+        {
+            scalar_t *gup = grad_u + row*ncols_u + pos0*k;
+            for (int64_t j = 0; j < n*k; ++j) gup[j] = scalar_t(0);
+            if ((k == kx) && !add) {
+                scalar_t *gxp = grad_x + row*ncols_x + hpos0;
+                for (int64_t j = 0; j < n; ++j) gxp[j] = scalar_t(0);
+            }
+        }
+
+        // gradient of the states that restart from init (see the forward)
+        const int64_t rpos = batch_first ? (slab/bidir)*len : slab/bidir;
+        const int64_t rstride = batch_first ? 1 : batch;
+        acc_t ginit[SRU_CPU_BLOCK];
+
+        acc_t cur[SRU_CPU_BLOCK];
+        acc_t mask[SRU_CPU_BLOCK];
+        acc_t gbias1[SRU_CPU_BLOCK];
+        acc_t gbias2[SRU_CPU_BLOCK];
+        for (int64_t j = 0; j < n; ++j) {
+            cur[j] = grad_last[col0+j];
+            mask[j] = (mask_h == NULL) ? acc_t(1) : mask_h[col0+j];
+            gbias1[j] = 0;
+            gbias2[j] = 0;
+            ginit[j] = 0;
+        }
+
+        for (int64_t cnt = 0; cnt < len_; ++cnt)
+        {
+            // walk the direction's own time order backwards
+            const int64_t row = (dir == 1) ? cnt : (len_-1-cnt);
+            const int64_t prev_row = (dir == 1) ? row+1 : row-1;
+            const int64_t rrow = (dir == 1) ? row+1 : row;
+            const bool rs = (reset != NULL) && (rrow < len_) && reset[rpos + rrow*rstride];
+            const bool has_prev = (cnt < len_-1) && !rs;
+            const scalar_t *up = u + row*ncols_u + pos0*k;
+            const scalar_t *xp = (k == kx) ? (x + row*ncols_x + hpos0) : (up + kx);
+            const acc_t *g1p = g1 + row*stride + pos0;
+            const acc_t *g2p = g2 + row*stride + pos0;
+            const acc_t *ap = act + row*stride + pos0;
+            const acc_t *pcp = has_prev ? (c + prev_row*stride + pos0) : (init + col0);
+            const scalar_t *ghp = grad_h + row*hstride + hpos0;
+            scalar_t *gup = grad_u + row*ncols_u + pos0*k;
+            scalar_t *gxp = (k == kx) ? (grad_x + row*ncols_x + hpos0) : (gup + kx);
+            acc_t gxv[SRU_CPU_BLOCK];
+            // gradient that reaches c directly (states gathered per sequence)
+            if (grad_c != NULL) {
+                const acc_t *gcp = grad_c + row*stride + pos0;
+                for (int64_t j = 0; j < n; ++j) cur[j] += gcp[j];
+            }
+
+            #pragma omp simd
+            for (int64_t j = 0; j < n; ++j)
+            {
+                const acc_t g1 = g1p[j];
+                const acc_t g2 = g2p[j];
+                const acc_t c_val = ap[j];
+                const acc_t x_val = xp[j*xk];
+                const acc_t u_val = up[j*k];
+                const acc_t gh_val = acc_t(ghp[j])*hscale;
+
+                // h = (c-x)*g2 + x; with merge, x is shared by both directions
+                gxv[j] = gh_val*(1-g2);
+                const acc_t gg2 = gh_val*(c_val*mask[j]-x_val)*(g2*(1-g2));
+                if (!light) gup[j*k+2] = scalar_t(gg2);
+                gbias2[j] += gg2;
+
+                // c = (c'-u0)*g1 + u0
+                const acc_t tmp = (activation_type == 1) ? (g2*(1-c_val*c_val)) : (
+                    ((activation_type == 0) || (c_val > 0)) ? g2 : acc_t(0)
+                );
+                const acc_t gc = gh_val*mask[j]*tmp + cur[j];
+                gup[j*k] = scalar_t(gc*(1-g1));
+                const acc_t gg1 = gc*(pcp[j]-u_val)*(g1*(1-g1));
+                gup[j*k+1] = scalar_t(light ? gg1+gg2 : gg1);
+                gbias1[j] += gg1;
+                cur[j] = gc*g1;
+            }
+            if (add && (k == kx)) {
+                for (int64_t j = 0; j < n; ++j) gxp[j] = scalar_t(acc_t(gxp[j]) + gxv[j]);
+            } else {
+                for (int64_t j = 0; j < n; ++j) gxp[j*xk] = scalar_t(gxv[j]);
+            }
+            if (rs) {
+                for (int64_t j = 0; j < n; ++j) {
+                    ginit[j] += cur[j];
+                    cur[j] = 0;
+                }
+            }
+        }
+
+        // grad_bias is (2, nb, bidir, d) and zeroed by the caller: the
+        // blocks of the examples that share a bias add up their gradients
+        acc_t *gb1 = grad_bias + (b1-bias);
+        acc_t *gb2 = grad_bias + (b2-bias);
+        for (int64_t j = 0; j < n; ++j) {
+            #pragma omp atomic
+            gb1[j] += gbias1[j];
+            #pragma omp atomic
+            gb2[j] += gbias2[j];
+            grad_init[col0+j] = cur[j] + ginit[j];
+        }
+    }
+}
+
+// forward: writes h and c into the given buffers, and the final state into
+// last if it is defined
+static void sru_forward_impl(torch::Tensor u, torch::Tensor x, torch::Tensor bias,
+                             torch::Tensor init, torch::Tensor mask_h, torch::Tensor lengths,
+                             torch::Tensor reset, torch::Tensor h, torch::Tensor c,
+                             torch::Tensor last, int64_t d, int64_t activation_type,
+                             bool bidirectional, bool last_only, bool light, bool batch_first,
+                             int64_t merge)
+{
+    const int64_t bidir = bidirectional ? 2 : 1;
+    batch_first = batch_first && (x.dim() == 3);
+    const int64_t len = (x.dim() == 3) ? x.size(batch_first ? 1 : 0) : 1;
+    const int64_t batch = batch_first ? x.size(0) : x.size(-2);
+    const int64_t k = u.size(-1) / d / bidir;
+    const int64_t kx = light ? 2 : 3;
+    TORCH_CHECK((k == kx) || (k == kx+1), "SRU expects k == ", kx, " or k == ", kx+1);
+    const int64_t nb = bias.numel() / (2*bidir*d);
+    TORCH_CHECK(batch % nb == 0, "batch size must be a multiple of the number of bias sets");
+    TORCH_CHECK(h.is_contiguous() && c.is_contiguous(), "output buffers must be contiguous");
+    u = u.contiguous();
+    x = x.contiguous();
+    init = init.contiguous();
+    const auto g1 = sru_gate(u, bias, 1, 0, len, batch, d, k, bidir, batch_first);
+    const auto g2 = sru_gate(u, bias, kx-1, 1, len, batch, d, k, bidir, batch_first);
+
+    AT_DISPATCH_FLOATING_TYPES_AND2(at::kHalf, at::kBFloat16, u.scalar_type(), "sru_cpu_fwd", ([&] {
+        using acc_t = at::opmath_type<scalar_t>;
+        sru_cpu_rec_kernel<scalar_t, acc_t>(
+            u.data_ptr<scalar_t>(),
+            g1.data_ptr<acc_t>(),
+            init.data_ptr<acc_t>(),
+            lengths.numel() ? lengths.data_ptr<int>() : NULL,
+            reset.numel() ? reset.data_ptr<bool>() : NULL,
+            len, batch, d, k, bidir, batch_first,
+            c.data_ptr<acc_t>(),
+            last.defined() ? last.data_ptr<acc_t>() : NULL);
+        const auto act = sru_activation(c, activation_type).contiguous();
+        sru_cpu_out_kernel<scalar_t, acc_t>(
+            u.data_ptr<scalar_t>(),
+            (k == kx) ? x.data_ptr<scalar_t>() : NULL,
+            g2.data_ptr<acc_t>(),
+            act.data_ptr<acc_t>(),
+            mask_h.numel() ? mask_h.data_ptr<acc_t>() : NULL,
+            lengths.numel() ? lengths.data_ptr<int>() : NULL,
+            len, batch, d, k, bidir,
+            h.data_ptr<scalar_t>(),
+            last_only,
+            light,
+            batch_first,
+            bidirectional ? (int)merge : 0);
+    }));
+}
+
+// writes h and c into the given buffers
+void sru_fwd(torch::Tensor u, torch::Tensor x, torch::Tensor bias,
+             torch::Tensor init, torch::Tensor mask_h, torch::Tensor lengths,
+             torch::Tensor reset, torch::Tensor h, torch::Tensor c,
+             int64_t d, int64_t activation_type, bool bidirectional,
+             bool last_only, bool light, bool batch_first,
+             int64_t merge)
+{
+    sru_forward_impl(u, x, bias, init, mask_h, lengths, reset, h, c, torch::Tensor(),
+        d, activation_type, bidirectional, last_only, light, batch_first, merge);
+}
+
+// forward that keeps nothing for backward: writes h and the final state into
+// the given buffers (c only lives for the duration of the call)
+void sru_infer(torch::Tensor u, torch::Tensor x, torch::Tensor bias,
+               torch::Tensor init, torch::Tensor mask_h, torch::Tensor lengths,
+               torch::Tensor reset, torch::Tensor h, torch::Tensor last,
+               int64_t d, int64_t activation_type, bool bidirectional,
+               bool last_only, bool light, bool batch_first,
+               int64_t merge)
+{
+    const int64_t bidir = bidirectional ? 2 : 1;
+    std::vector<int64_t> size = x.sizes().vec();
+    size.back() = d*bidir;
+    auto c = torch::empty(size, last.options());
+    TORCH_CHECK(last.is_contiguous(), "output buffers must be contiguous");
+    sru_forward_impl(u, x, bias, init, mask_h, lengths, reset, h, c, last,
+        d, activation_type, bidirectional, last_only, light, batch_first, merge);
+}
+
+// writes the gradients into the given buffers; grad_bias must be zeroed
+void sru_bwd(torch::Tensor u, torch::Tensor x, torch::Tensor bias,
+             torch::Tensor init, torch::Tensor mask_h, torch::Tensor lengths,
+             torch::Tensor reset, torch::Tensor c,
+             torch::Tensor grad_h, torch::Tensor grad_last, torch::Tensor grad_c,
+             torch::Tensor grad_u, torch::Tensor grad_x,
+             torch::Tensor grad_bias, torch::Tensor grad_init,
+             int64_t d, int64_t activation_type, bool bidirectional,
+             bool light, bool batch_first, int64_t merge)
+{
+    const int64_t bidir = bidirectional ? 2 : 1;
+    batch_first = batch_first && (x.dim() == 3);
+    const int64_t len = (x.dim() == 3) ? x.size(batch_first ? 1 : 0) : 1;
+    const int64_t batch = batch_first ? x.size(0) : x.size(-2);
+    const int64_t k = u.size(-1) / d / bidir;
+    const int64_t kx = light ? 2 : 3;
+    TORCH_CHECK((k == kx) || (k == kx+1), "SRU expects k == ", kx, " or k == ", kx+1);
+    const int64_t nb = bias.numel() / (2*bidir*d);
+    TORCH_CHECK(batch % nb == 0, "batch size must be a multiple of the number of bias sets");
+    u = u.contiguous();
+    x = x.contiguous();
+    init = init.contiguous();
+    c = c.contiguous();
+    grad_h = grad_h.contiguous();
+    grad_last = grad_last.contiguous();
+    grad_c = grad_c.contiguous();
+    TORCH_CHECK(grad_u.is_contiguous() && grad_x.is_contiguous() && grad_bias.is_contiguous()
+        && grad_init.is_contiguous(), "output buffers must be contiguous");
+    const auto g1 = sru_gate(u, bias, 1, 0, len, batch, d, k, bidir, batch_first);
+    const auto g2 = sru_gate(u, bias, kx-1, 1, len, batch, d, k, bidir, batch_first);
+    const auto act = sru_activation(c, activation_type).contiguous();
+
+    AT_DISPATCH_FLOATING_TYPES_AND2(at::kHalf, at::kBFloat16, u.scalar_type(), "sru_cpu_bwd", ([&] {
+        using acc_t = at::opmath_type<scalar_t>;
+        sru_cpu_bwd_kernel<scalar_t, acc_t>(
+            u.data_ptr<scalar_t>(),
+            (k == kx) ? x.data_ptr<scalar_t>() : NULL,
+            bias.data_ptr<acc_t>(),
+            init.data_ptr<acc_t>(),
+            mask_h.numel() ? mask_h.data_ptr<acc_t>() : NULL,
+            lengths.numel() ? lengths.data_ptr<int>() : NULL,
+            reset.numel() ? reset.data_ptr<bool>() : NULL,
+            c.data_ptr<acc_t>(),
+            g1.data_ptr<acc_t>(),
+            g2.data_ptr<acc_t>(),
+            act.data_ptr<acc_t>(),
+            grad_h.data_ptr<scalar_t>(),
+            grad_last.data_ptr<acc_t>(),
+            grad_c.numel() ? grad_c.data_ptr<acc_t>() : NULL,
+            len, batch, d, k, bidir,
+            grad_u.data_ptr<scalar_t>(),
+            (k == kx) ? grad_x.data_ptr<scalar_t>() : NULL,
+            grad_bias.data_ptr<acc_t>(),
+            grad_init.data_ptr<acc_t>(),
+            (int)activation_type,
+            light,
+            nb,
+            batch_first,
+            bidirectional ? (int)merge : 0);
+    }));
+}
+
+// OpenMP threads of the parallel regions started by the calling thread
+void sru_set_num_threads(int64_t n)
+{
+#ifdef _OPENMP
+    omp_set_num_threads((int)n);
+#endif
+}
+"""
+
+SRU_CPU_CFLAGS = ['-O3', '-fopenmp']
+# Opt-in with SRU_CPU_NATIVE=1: -ffast-math lets the compiler contract and
+# reorder the arithmetic of the simd loops, but drops NaN/inf propagation, and
+# -march=native ties the cached build to the CPU of the build host
+SRU_CPU_NATIVE_CFLAGS = ['-ffast-math', '-march=native']
+_SRU_CPU_EXT = None
+
+def load_cpu_extension(verbose=False):
+    """ Compiles (or loads from the torch extension cache) the OpenMP CPU
+        kernels.
+    """
+    global _SRU_CPU_EXT
+    if _SRU_CPU_EXT is None:
+        with _SRU_LOAD_LOCK:
+            if _SRU_CPU_EXT is None:
+                from torch.utils.cpp_extension import load_inline
+                native = os.environ.get('SRU_CPU_NATIVE', '0') == '1'
+                _SRU_CPU_EXT = load_inline(
+                    # (separate names, so both builds can share the cache)
+                    name='sru_cpu_native' if native else 'sru_cpu',
+                    cpp_sources=[SRU_CPU_CODE],
+                    functions=['sru_fwd', 'sru_bwd', 'sru_infer', 'sru_set_num_threads'],
+                    extra_cflags=SRU_CPU_CFLAGS + (SRU_CPU_NATIVE_CFLAGS if native else []),
+                    extra_ldflags=['-fopenmp'],
+                    verbose=verbose
+                )
+    return _SRU_CPU_EXT
+
+def sru_cpu_ext_forward(u, x, bias, init, mask_h, d, activation_type, bidirectional,
+                        lengths=None, last_only=False, light=False, batch_first=False,
+                        merge=0, reset=None):
+    """ Compiled version of sru_cpu_forward. """
+    ext = load_cpu_extension()
+    bidir = 2 if bidirectional else 1
+    _, batch = _sru_len_batch(x, batch_first)
+    mask_ = mask_h if mask_h is not None else u.new(0)
+    lengths_ = lengths.int().contiguous() if lengths is not None else u.new(0).int()
+    last_only = last_only and x.dim() == 3
+    size = (x.size(0), x.size(1), d*bidir) if x.dim() == 3 else (batch, d*bidir)
+    h = u.new_empty(_sru_merged_size((batch, d*bidir) if last_only else size, d, merge))
+    c = u.new_empty(size, dtype=_sru_acc_dtype(u.dtype))
+    reset_ = reset if reset is not None else u.new(0).bool()
+    ext.sru_fwd(u, x, bias, init, mask_, lengths_, reset_, h, c, d, activation_type,
+        bidirectional, last_only, light, batch_first, merge)
+    return h, c
+
+def sru_cpu_ext_infer(u, x, bias, init, mask_h, d, activation_type, bidirectional,
+                      lengths=None, out=None, last=None, last_only=False, light=False,
+                      batch_first=False, merge=0, reset=None):
+    """ Compiled forward that writes only h and the final state. """
+    ext = load_cpu_extension()
+    bidir = 2 if bidirectional else 1
+    _, batch = _sru_len_batch(x, batch_first)
+    last_only = last_only and x.dim() == 3
+    size = (x.size(0), x.size(1), d*bidir) if x.dim() == 3 and not last_only \
+        else (batch, d*bidir)
+    size = _sru_merged_size(size, d, merge)
+    h = x.new_empty(size) if out is None else out
+    if last is None:
+        last = x.new_empty(batch, d*bidir, dtype=_sru_acc_dtype(x.dtype))
+    mask_ = mask_h if mask_h is not None else u.new(0)
+    lengths_ = lengths.int().contiguous() if lengths is not None else u.new(0).int()
+    reset_ = reset if reset is not None else u.new(0).bool()
+    ext.sru_infer(u, x, bias, init, mask_, lengths_, reset_, h, last, d, activation_type,
+        bidirectional, last_only, light, batch_first, merge)
+    return h, last
+
+def sru_cpu_ext_backward(u, x, bias, init, mask_h, c, grad_h, grad_last,
+                         d, activation_type, bidirectional, lengths=None, light=False,
+                         batch_first=False, merge=0, reset=None, grad_c=None):
+    """ Compiled version of sru_cpu_backward. """
+    ext = load_cpu_extension()
+    bidir = 2 if bidirectional else 1
+    mask_ = mask_h if mask_h is not None else u.new(0)
+    lengths_ = lengths.int().contiguous() if lengths is not None else u.new(0).int()
+    k = u.size(-1) // d // bidir
+    acc = _sru_acc_dtype(u.dtype)
+    grad_u = u.new_empty(u.size())
+    grad_x = x.new_empty(x.size()) \
+        if k == _sru_gate_parts(light) else None
+    # the kernel adds the gradients of all examples into their bias
+    grad_bias = bias.new_zeros(bias.numel())
+    grad_init = u.new_empty(_sru_len_batch(x, batch_first)[1], d*bidir, dtype=acc)
+    reset_ = reset if reset is not None else u.new(0).bool()
+    grad_c_ = grad_c.to(acc) if grad_c is not None else c.new(0)
+    ext.sru_bwd(u, x, bias, init, mask_, lengths_, reset_, c, grad_h, grad_last, grad_c_,
+        grad_u, grad_x if grad_x is not None else x.new(0), grad_bias, grad_init, d,
+        activation_type, bidirectional, light, batch_first, merge)
+    return grad_u, grad_x, grad_bias, grad_init
+
+
+################################################################################
+# Backend registry
+#
+# Backends are registered per device type, in order of preference, with a
+# loader that is only called the first time SRU_Compute runs on a device (once,
+# even if several threads get there at the same time). A loader that raises
+# marks the backend as unavailable on that device and the next one is tried.
+# The backends themselves keep no state between calls.
+################################################################################
+
+class SRUBackend(object):
+    def __init__(self, name, forward, backward, infer):
+        self.name = name
+        self.forward = forward
+        self.backward = backward
+        # forward pass that keeps nothing for backward and writes only h and
+        # the final state, optionally into preallocated buffers
+        self.infer = infer
+
+_SRU_BACKEND_LOADERS = {}   # device type -> [(name, loader)]
+_SRU_BACKENDS = {}          # (name, device type, index) -> SRUBackend or None
+_SRU_BACKEND_CHOICE = {}    # device type -> name pinned by set_backend()
+
+def register_backend(name, device_type, loader):
+    """ Adds a backend for device_type. loader(device_index) returns an
+        SRUBackend; it may import toolkits and compile kernels.
+    """
+    _SRU_BACKEND_LOADERS.setdefault(device_type, []).append((name, loader))
+
+def set_backend(device_type, name=None):
+    """ Forces the backend used on device_type; None restores the default
+        order of preference.
+    """
+    if name is not None:
+        names = [ n for n, _ in _SRU_BACKEND_LOADERS.get(device_type, []) ]
+        if name not in names:
+            raise ValueError('Unknown SRU backend {} for {}, choose from {}'.format(
+                name, device_type, names))
+    _SRU_BACKEND_CHOICE[device_type] = name
+
+def set_cpu_backend(name):
+    set_backend('cpu', name)
+
+def get_backend(device_type, index=None):
+    choice = _SRU_BACKEND_CHOICE.get(device_type)
+    for name, loader in _SRU_BACKEND_LOADERS.get(device_type, []):
+        if choice is not None and name != choice:
+            continue
+        key = (name, device_type, index)
+        if key not in _SRU_BACKENDS:
+            with _SRU_LOAD_LOCK:
+                if key not in _SRU_BACKENDS:
+                    try:
+                        backend = loader(index)
+                    except Exception as e:
+                        warnings.warn('SRU backend {} is not available on {} ({})'.format(
+                            name, device_type, e))
+                        backend = None
+                    _SRU_BACKENDS[key] = backend
+        if _SRU_BACKENDS[key] is not None:
+            return _SRU_BACKENDS[key]
+    raise RuntimeError('No SRU backend available for device type {}'.format(
+        device_type))
+
+def get_tensor_backend(t):
+    if t.is_cuda:
+        return get_backend('cuda', t.get_device())
+    return get_backend('cpu')
+
+def _load_cuda_backend(index):
+    kernels = SRUCudaKernels(index)
+    return SRUBackend('cupy', kernels.forward, kernels.backward, kernels.infer)
+
+def _load_cpu_ext_backend(index):
+    load_cpu_extension()
+    return SRUBackend('ext', sru_cpu_ext_forward, sru_cpu_ext_backward,
+        sru_cpu_ext_infer)
+
+def _load_cpu_torch_backend(index):
+    return SRUBackend('torch', sru_cpu_forward, sru_cpu_backward, sru_cpu_infer)
+
+register_backend('cupy', 'cuda', _load_cuda_backend)
+register_backend('ext', 'cpu', _load_cpu_ext_backend)
+register_backend('torch', 'cpu', _load_cpu_torch_backend)
+
+
+def _lengths_tensor(lengths: Tensor, input: Tensor) -> Tensor:
+    """ Sequence lengths as a contiguous int32 tensor on the device of input. """
+    if not torch.jit.is_scripting():
+        if not torch.is_tensor(lengths):
+            lengths = torch.LongTensor(list(lengths))
+    return lengths.to(device=input.device, dtype=torch.int32).contiguous()
+
+def _reset_tensor(reset: Tensor, input: Tensor) -> Tensor:
+    """ Reset mask as a contiguous bool tensor on the device of input. """
+    return reset.to(device=input.device, dtype=torch.bool).contiguous()
+
+
+################################################################################
+# Custom ops
+#
+# sru::forward, sru::backward and sru::infer_ expose the backend registry to
+# the dispatcher, with CPU and CUDA kernels, fake implementations (shapes only)
+# and autograd, so that torch.compile can trace SRU without graph breaks.
+# Arguments follow the backend functions; dtypes are already resolved by the
+# caller (x in the type of u, bias / init / mask_h in the accumulation type).
+# With batch_first, u, x, h and c are (batch, len, ...) instead of
+# (len, batch, ...); the per-column tensors are (batch, d*bidir) either way.
+# With merge (1: sum, 2: mean), h and x have d features instead of d*bidir.
+# reset is a bool tensor in the (len, batch) order of x.
+################################################################################
+
+def _sru_op_shapes(u, x, d, bidirectional, last_only, batch_first=False, merge=0):
+    bidir = 2 if bidirectional else 1
+    _, batch = _sru_len_batch(x, batch_first)
+    state = (x.size(0), x.size(1), d*bidir) if x.dim() == 3 else (batch, d*bidir)
+    h = _sru_merged_size((batch, d*bidir) if last_only and x.dim() == 3 else state,
+        d, merge)
+    return h, (batch, d*bidir), state, _sru_acc_dtype(u.dtype)
+
+@torch.library.custom_op('sru::forward', mutates_args=(), device_types=('cpu', 'cuda'))
+def _sru_forward_op(u: Tensor, x: Tensor, bias: Tensor, init: Tensor,
+                    mask_h: Optional[Tensor], lengths: Optional[Tensor], d: int,
+                    activation_type: int, bidirectional: bool, scan: bool,
+                    recompute: bool, last_only: bool, light: bool = False,
+                    batch_first: bool = False, merge: int = 0,
+                    reset: Optional[Tensor] = None) -> Tuple[Tensor, Tensor, Tensor]:
+    """ Returns (h, last_hidden, c), with c the state of every step. """
+    if scan and not u.is_cuda:
+        h, c = sru_cpu_forward(u, x, bias, init, mask_h, d, activation_type,
+            bidirectional, lengths, scan=True, last_only=last_only, light=light,
+            batch_first=batch_first, merge=merge, reset=reset)
+    else:
+        h, c = get_tensor_backend(u).forward(u, x, bias, init, mask_h, d,
+            activation_type, bidirectional, lengths, last_only=last_only, light=light,
+            batch_first=batch_first, merge=merge, reset=reset)
+    last = sru_last_state(c, d, bidirectional, batch_first)
+    # outputs of an op may not alias each other
+    return h, (last if bidirectional and c.dim() == 3 else last.clone()), c
+
+@_sru_forward_op.register_fake
+def _(u, x, bias, init, mask_h, lengths, d, activation_type, bidirectional, scan,
+      recompute, last_only, light=False, batch_first=False, merge=0, reset=None):
+    h, last, c, acc = _sru_op_shapes(u, x, d, bidirectional, last_only, batch_first,
+        merge)
+    return u.new_empty(h), u.new_empty(last, dtype=acc), u.new_empty(c, dtype=acc)
+
+@torch.library.custom_op('sru::backward', mutates_args=(), device_types=('cpu', 'cuda'))
+def _sru_backward_op(u: Tensor, x: Tensor, bias: Tensor, init: Tensor,
+                     mask_h: Optional[Tensor], lengths: Optional[Tensor], c: Tensor,
+                     grad_h: Tensor, grad_last: Tensor, d: int, activation_type: int,
+                     bidirectional: bool, scan: bool, light: bool = False,
+                     batch_first: bool = False, merge: int = 0,
+                     reset: Optional[Tensor] = None,
+                     grad_c: Optional[Tensor] = None) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+    """ Returns (grad_u, grad_x, grad_bias, grad_init); grad_x is empty when
+        x is not used (x is projected, as the last part of u). grad_c is the
+        gradient of the states of every step, when they were used.
+    """
+    if scan and not u.is_cuda:
+        grad_u, grad_x, grad_bias, grad_init = sru_cpu_backward(u, x, bias, init,
+            mask_h, c, grad_h, grad_last, d, activation_type, bidirectional,
+            lengths, scan=True, light=light, batch_first=batch_first, merge=merge,
+            reset=reset, grad_c=grad_c)
+    else:
+        grad_u, grad_x, grad_bias, grad_init = get_tensor_backend(u).backward(u, x,
+            bias, init, mask_h, c, grad_h, grad_last, d, activation_type,
+            bidirectional, lengths, light=light, batch_first=batch_first, merge=merge,
+            reset=reset, grad_c=grad_c)
+    if grad_x is None:
+        grad_x = x.new_empty(0)
+    return grad_u, grad_x, grad_bias, grad_init
+
+@_sru_backward_op.register_fake
+def _(u, x, bias, init, mask_h, lengths, c, grad_h, grad_last, d, activation_type,
+      bidirectional, scan, light=False, batch_first=False, merge=0, reset=None,
+      grad_c=None):
+    k = u.size(-1) // d // (2 if bidirectional else 1)
+    _, last, _, acc = _sru_op_shapes(u, x, d, bidirectional, False, batch_first)
+    grad_x = torch.empty_like(x) if k == _sru_gate_parts(light) else x.new_empty(0)
+    return (torch.empty_like(u), grad_x, bias.new_empty(bias.size()),
+        u.new_empty(last, dtype=acc))
+
+def _sru_setup_context(ctx, inputs, output):
+    (u, x, bias, init, mask_h, lengths, d, activation_type, bidirectional, scan,
+        recompute, last_only, light, batch_first, merge, reset) = inputs
+    _, _, c = output
+    # gradients of unused outputs are None (most of the time c is only
+    # used by backward, see gather_state)
+    ctx.set_materialize_grads(False)
+    # with recompute, c is not kept and the forward recurrence runs again
+    ctx.save_for_backward(u, x, bias, init, mask_h, lengths, reset,
+        None if recompute else c)
+    ctx.config = (d, activation_type, bidirectional, scan, recompute, last_only, light,
+        batch_first, merge)
+
+def _sru_backward(ctx, grad_h, grad_last, grad_c):
+    u, x, bias, init, mask_h, lengths, reset, c = ctx.saved_tensors
+    (d, activation_type, bidirectional, scan, recompute, last_only, light,
+        batch_first, merge) = ctx.config
+    bidir = 2 if bidirectional else 1
+    length, batch = _sru_len_batch(x, batch_first)
+    if grad_h is None or grad_last is None:
+        h_size, last_size, _, acc = _sru_op_shapes(u, x, d, bidirectional, last_only,
+            batch_first, merge)
+        if grad_h is None:
+            grad_h = u.new_zeros(h_size)
+        if grad_last is None:
+            grad_last = u.new_zeros(last_size, dtype=acc)
+    if recompute:
+        _, _, c = _sru_forward_op(u, x, bias, init, mask_h, lengths, d,
+            activation_type, bidirectional, scan, False, False, light,
+            batch_first, merge, reset)
+    if last_only and x.dim() == 3:
+        # only the last valid step of every sequence received a gradient
+        rows = _sru_last_row(lengths, length, batch, grad_h.device)
+        cols = torch.arange(batch, device=grad_h.device)
+        grad_h_ = grad_h.new_zeros(x.size(0), x.size(1), grad_h.size(-1))
+        if batch_first:
+            grad_h_[cols, rows] = grad_h
+        else:
+            grad_h_[rows, cols] = grad_h
+        grad_h = grad_h_
+    grad_u, grad_x, grad_bias, grad_init = _sru_backward_op(u, x, bias, init,
+        mask_h, lengths, c, grad_h, grad_last, d, activation_type, bidirectional,
+        scan, light, batch_first, merge, reset, grad_c)
+    k = u.size(-1) // d // bidir
+    grad_x = grad_x if k == _sru_gate_parts(light) else None
+    return (grad_u, grad_x, grad_bias, grad_init) + (None,)*12
+
+_sru_forward_op.register_autograd(_sru_backward, setup_context=_sru_setup_context)
+
+@torch.library.custom_op('sru::infer_', mutates_args=('h', 'last'),
+                         device_types=('cpu', 'cuda'))
+def _sru_infer_op(u: Tensor, x: Tensor, bias: Tensor, init: Tensor,
+                  lengths: Optional[Tensor], h: Tensor, last: Tensor, d: int,
+                  activation_type: int, bidirectional: bool, scan: bool,
+                  last_only: bool, light: bool = False,
+                  batch_first: bool = False, merge: int = 0,
+                  reset: Optional[Tensor] = None) -> None:
+    """ Forward without autograd that writes only h and the final state. """
+    if scan and not u.is_cuda:
+        sru_cpu_infer(u, x, bias, init, None, d, activation_type, bidirectional,
+            lengths, h, last, scan=True, last_only=last_only, light=light,
+            batch_first=batch_first, merge=merge, reset=reset)
+    else:
+        get_tensor_backend(u).infer(u, x, bias, init, None, d, activation_type,
+            bidirectional, lengths, h, last, last_only=last_only, light=light,
+            batch_first=batch_first, merge=merge, reset=reset)
+
+@_sru_infer_op.register_fake
+def _(u, x, bias, init, lengths, h, last, d, activation_type, bidirectional, scan,
+      last_only, light=False, batch_first=False, merge=0, reset=None):
+    return None
+
+
+def sru_compute(u: Tensor, x: Tensor, bias: Tensor, init: Tensor,
+                mask_h: Optional[Tensor], lengths: Optional[Tensor], d: int,
+                activation_type: int, bidirectional: bool, scan: bool = False,
+                recompute: bool = False, last_only: bool = False,
+                light: bool = False, batch_first: bool = False,
+                merge: int = 0, reset: Optional[Tensor] = None,
+                spans: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+    """ Runs the recurrence on the projection u = x W. Returns (h, last_hidden).
+        With batch_first, x and h are (batch, len, ...) and u is the
+        projection of x in that order. merge (1: sum, 2: mean) adds up the
+        outputs of the two directions in the kernel. reset, a bool tensor
+        in the (len, batch) order of x, restarts c from init at the steps
+        where it is set (see pack_streams). last_hidden is then the state of
+        every column, which is only that of the sequence packed last in it;
+        with the spans of pack_streams, it is the final state of every
+        sequence instead, (n, d*dir) (see gather_state).
+        Eager mode and torch.compile call the sru::forward op; TorchScript
+        compiles the PyTorch implementation instead, so scripted modules only
+        need libtorch to run. ONNX export also traces the PyTorch
+        implementation, as the op has no ONNX counterpart.
+    """
+    acc = _sru_acc_dtype(u.dtype)
+    x = x.to(u.dtype)
+    bias = bias.to(acc)
+    init = init.to(acc)
+    if mask_h is not None:
+        mask_h = mask_h.to(acc)
+    if torch.jit.is_scripting():
+        h, c = sru_cpu_forward(u, x, bias, init, mask_h, d, activation_type,
+            bidirectional, lengths, scan, last_only, light, batch_first, merge, reset)
+        if spans is not None:
+            return h, gather_state(c, spans, bidirectional, batch_first)
+        return h, sru_last_state(c, d, bidirectional, batch_first)
+    if torch.onnx.is_in_onnx_export():
+        h, c = sru_cpu_forward(u, x, bias, init, mask_h, d, activation_type,
+            bidirectional, lengths, scan, last_only, light, batch_first, merge, reset)
+        if spans is not None:
+            return h, gather_state(c, spans, bidirectional, batch_first)
+        return h, sru_last_state(c, d, bidirectional, batch_first)
+    h, last, c = _sru_forward_op(u, x, bias, init, mask_h, lengths, d,
+        activation_type, bidirectional, scan, recompute, last_only, light,
+        batch_first, merge, reset)
+    if spans is not None:
+        # c is differentiable: the gradient of the gathered states reaches it
+        return h, gather_state(c, spans, bidirectional, batch_first)
+    return h, last
+
+
+def sru_infer(u: Tensor, x: Tensor, bias: Tensor, init: Tensor,
+              lengths: Optional[Tensor], d: int, activation_type: int,
+              bidirectional: bool, scan: bool = False, last_only: bool = False,
+              out: Optional[Tensor] = None, last: Optional[Tensor] = None,
+              light: bool = False, batch_first: bool = False,
+              merge: int = 0, reset: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+    """ Inference counterpart of sru_compute, through the sru::infer_ op.
+        h and the final state are written into out and last when given.
+    """
+    acc = _sru_acc_dtype(u.dtype)
+    x = x.to(u.dtype)
+    h_size, last_size, _, _ = _sru_op_shapes(u, x, d, bidirectional, last_only,
+        batch_first, merge)
+    h = u.new_empty(h_size) if out is None else out
+    last = u.new_empty(last_size, dtype=acc) if last is None else last
+    _sru_infer_op(u, x, bias.to(acc), init.to(acc), lengths, h, last, d,
+        activation_type, bidirectional, scan, last_only, light, batch_first, merge,
+        reset)
+    return h, last
+
+
+def sru_project(h: Tensor, weight_proj: Optional[Tensor], bidirectional: bool,
+                out: Optional[Tensor] = None) -> Tensor:
+    """ Output projection of SRUP: maps the last dimension of h from d*dir to
+        p*dir, direction by direction, with weight_proj (d*dir, p) holding
+        one (d, p) block per direction. h is returned as is when weight_proj
+        is None; otherwise the result is written into out when given.
+    """
+    if weight_proj is None:
+        return h
+    weight_proj = weight_proj.to(h.dtype)
+    if not bidirectional:
+        if out is not None:
+            return torch.matmul(h, weight_proj, out=out)
+        return torch.matmul(h, weight_proj)
+    d, p = weight_proj.size(0)//2, weight_proj.size(1)
+    size = list(h.size()[:-1])
+    h = torch.einsum('nid,idp->nip', h.reshape(-1, 2, d), weight_proj.view(2, d, p))
+    h = h.reshape(size + [2*p])
+    if out is not None:
+        return out.copy_(h)
+    return h
+
+
+class SRU_Compute(object):
+    """ Callable form of sru_compute, kept for code that builds SRU_Compute
+        objects directly.
+    """
+    def __init__(self, activation_type, d_out, bidirectional=False, scan=False,
+                 recompute=False, last_only=False, batch_first=False):
+        self.activation_type = activation_type
+        self.d_out = d_out
+        self.bidirectional = bidirectional
+        # parallel scan over time, only used by the CPU backend
+        self.scan = scan
+        # don't keep c for backward, run the forward recurrence again instead
+        self.recompute = recompute
+        # h is (batch, d*bidir): the output at the last valid step only
+        self.last_only = last_only
+        # x and h are (batch, len, ...)
+        self.batch_first = batch_first
+
+    def __call__(self, u, x, bias, init=None, mask_h=None, lengths=None):
+        bidir = 2 if self.bidirectional else 1
+        if init is None:
+            init = x.new_zeros(_sru_len_batch(x, self.batch_first)[1], self.d_out*bidir)
+        return sru_compute(u, x, bias, init, mask_h, lengths, self.d_out,
+            self.activation_type, self.bidirectional, self.scan, self.recompute,
+            self.last_only, batch_first=self.batch_first)
+
+
+_SRU_MERGE_MODES = ('concat', 'sum', 'mean')
 
 
 class SRUCell(nn.Module):
     def __init__(self, n_in, n_out, dropout=0, rnn_dropout=0,
-                bidirectional=False, use_tanh=1, use_relu=0):
+                bidirectional=False, use_tanh=1, use_relu=0, scan_threshold=0,
+                recompute=False, projection_size=0, rank=0, light=False,
+                batch_first=False, merge_mode='concat', highway_projection=None):
         super(SRUCell, self).__init__()
+        if merge_mode not in _SRU_MERGE_MODES:
+            raise ValueError("merge_mode must be one of {}, got {}".format(
+                _SRU_MERGE_MODES, merge_mode))
+        if merge_mode != 'concat' and not bidirectional:
+            raise ValueError("merge_mode requires a bidirectional SRU")
         self.n_in = n_in
         self.n_out = n_out
         self.rnn_dropout = rnn_dropout
         self.dropout = dropout
         self.bidirectional = bidirectional
         self.activation_type = 2 if use_relu else (1 if use_tanh else 0)
-
-        out_size = n_out*2 if bidirectional else n_out
-        k = 4 if n_in != out_size else 3
+        # CPU inputs at least this long use the parallel scan (0 = never)
+        self.scan_threshold = scan_threshold
+        # recompute c in backward instead of storing it
+        self.recompute = recompute
+        # if > 0, h of each direction is projected down to this size (SRUP)
+        self.projection_size = projection_size
+
+        # light: the highway gate reuses the forget gate projection u1, with
+        # its own bias, which saves a third of the input projection
+        self.light = light
+        # input and output are (batch, len, ...); the kernels read this
+        # layout directly, without a transposed copy
+        self.batch_first = batch_first
+        # how the two directions are combined: 'concat' gives n_out*2
+        # features, 'sum' and 'mean' add them up into n_out in the kernel
+        self.merge_mode = merge_mode
+        self.merge = _SRU_MERGE_MODES.index(merge_mode)
+
+        # the highway connection adds the input to h before the projection,
+        # so k depends on the hidden size, not on the projected one. x is
+        # projected (one more part in k) when n_in differs from it, or when
+        # highway_projection is set (e.g. by prune_sru, which keeps the
+        # projection of a layer whose sizes happen to match after pruning)
+        hidden_size = n_out*2 if bidirectional and self.merge == 0 else n_out
+        if highway_projection is None:
+            highway_projection = n_in != hidden_size
+        if not highway_projection and n_in != hidden_size:
+            raise ValueError("the highway connection of an SRUCell with input size "
+                "{} and hidden size {} must be projected".format(n_in, hidden_size))
+        k = _sru_gate_parts(light) + (1 if highway_projection else 0)
         self.size_per_dir = n_out*k
-        self.weight = nn.Parameter(torch.Tensor(
-            n_in,
-            self.size_per_dir*2 if bidirectional else self.size_per_dir
-        ))
+        # if > 0, weight is factored as weight_u (n_in, rank) times
+        # weight_v (rank, k*n_out*dir)
+        self.rank = rank
+        size = self.size_per_dir*2 if bidirectional else self.size_per_dir
+        if rank > 0:
+            self.register_parameter('weight', None)
+            self.weight_u = nn.Parameter(torch.Tensor(n_in, rank))
+            self.weight_v = nn.Parameter(torch.Tensor(rank, size))
+        else:
+            self.weight = nn.Parameter(torch.Tensor(n_in, size))
+            self.register_parameter('weight_u', None)
+            self.register_parameter('weight_v', None)
         self.bias = nn.Parameter(torch.Tensor(
             n_out*4 if bidirectional else n_out*2
         ))
+        if projection_size > 0:
+            # one (n_out, projection_size) block per direction, stacked
+            # (a single block when the directions are merged)
+            self.weight_proj = nn.Parameter(torch.Tensor(hidden_size, projection_size))
+        else:
+            self.register_parameter('weight_proj', None)
         self.init_weight()
 
     def init_weight(self):
         val_range = (3.0/self.n_in)**0.5
-        self.weight.data.uniform_(-val_range, val_range)
+        if self.weight is not None:
+            self.weight.data.uniform_(-val_range, val_range)
+        else:
+            # Var(weight_u @ weight_v) = rank * 1/n_in * 1/rank, the same as
+            # the variance of the full weight
+            self.weight_u.data.uniform_(-val_range, val_range)
+            val_range = (3.0/self.rank)**0.5
+            self.weight_v.data.uniform_(-val_range, val_range)
         self.bias.data.zero_()
+        if self.weight_proj is not None:
+            val_range = (3.0/self.n_out)**0.5
+            self.weight_proj.data.uniform_(-val_range, val_range)
 
     def set_bias(self, bias_val=0):
         n_out = self.n_out
@@ -472,42 +2138,266 @@ class SRUCell(nn.Module):
         else:
             self.bias.data[n_out:].zero_().add_(bias_val)
 
-    def forward(self, input, c0=None):
+    def forward(self, input: Tensor, c0: Optional[Tensor] = None,
+                scan: Optional[bool] = None, lengths: Optional[Tensor] = None,
+                last_only: bool = False, generator: Optional[torch.Generator] = None,
+                reset: Optional[Tensor] = None, spans: Optional[Tensor] = None):
+        """ input is (len, batch, n_in), (batch, len, n_in) if batch_first,
+            (batch, n_in) or a PackedSequence. lengths optionally gives the true length of each example of a
+            padded batch: steps past it output zeros and the returned c is the
+            state at the last valid step. With last_only, h is only computed
+            at that step and returned as a (batch, n_out*dir) tensor. With
+            projection_size, h is projected to projection_size*dir (c is not).
+            With merge_mode 'sum' or 'mean', h has n_out (or projection_size)
+            features instead of twice as many; c keeps both directions.
+            reset, (len, batch) or (batch, len) if batch_first, is set at
+            the first step of every sequence when several are packed one
+            after the other into each column (see pack_streams): c restarts
+            from c0 there. The returned c is then the state of every column,
+            not valid per sequence; given the spans of pack_streams, c is the
+            final state of every sequence instead, (n, n_out*dir).
+            Dropout masks are drawn from generator when given, instead of the
+            default generator shared by all threads.
+            The module can be compiled with torch.jit.script; packed input
+            and the inference fast path are then not available.
+        """
+        packed = False
+        if not torch.jit.is_scripting():
+            packed = isinstance(input, PackedSequence)
+            if packed:
+                input, lengths = pad_packed_sequence(input, batch_first=self.batch_first)
         assert input.dim() == 2 or input.dim() == 3
-        n_in, n_out = self.n_in, self.n_out
-        batch = input.size(-2)
+        assert lengths is None or input.dim() == 3
+        assert reset is None or input.dim() == 3
+        last_only = last_only and input.dim() == 3
+        n_out = self.n_out
+        bidir = 2 if self.bidirectional else 1
+        length, batch = _sru_len_batch(input, self.batch_first)
+        scan_ = scan if scan is not None else (self.scan_threshold > 0) and \
+            (input.dim() == 3) and (length >= self.scan_threshold)
         if c0 is None:
-            c0 = Variable(input.data.new(
-                batch, n_out if not self.bidirectional else n_out*2
-            ).zero_())
-
+            c0 = input.new_zeros(batch, n_out*bidir)
+        lengths_: Optional[Tensor] = None
+        if lengths is not None:
+            lengths_ = _lengths_tensor(lengths, input)
+        reset_: Optional[Tensor] = None
+        if reset is not None:
+            reset_ = _reset_tensor(reset, input)
+
+        if not torch.jit.is_scripting():
+            if self.inference_mode():
+                h, c = self.inference(input, c0, scan_, lengths_, last_only=last_only,
+                    reset=reset_, spans=spans)
+            else:
+                mask_x, mask_h = self._dropout_masks(batch, generator)
+                h, c = self._forward_masked(input, c0, mask_x, mask_h, scan_,
+                    lengths_, last_only, reset_, spans)
+            if packed and not last_only:
+                h = pack_padded_sequence(h, lengths, batch_first=self.batch_first,
+                    enforce_sorted=False)
+            return h, c
+
+        mask_x, mask_h = self._dropout_masks(batch, generator)
+        return self._forward_masked(input, c0, mask_x, mask_h, scan_, lengths_, last_only,
+            reset_, spans)
+
+    def _dropout_masks(self, batch: int, generator: Optional[torch.Generator] = None
+                       ) -> Tuple[Optional[Tensor], Optional[Tensor]]:
+        """ Draws the variational dropout masks of one forward pass: on the
+            input (batch, n_in) and on the output (batch, n_out*dir). None
+            when the dropout does not apply.
+        """
+        mask_x: Optional[Tensor] = None
+        mask_h: Optional[Tensor] = None
         if self.training and (self.rnn_dropout>0):
-            mask = self.get_dropout_mask_((batch, n_in), self.rnn_dropout)
-            x = input * mask.expand_as(input)
-        else:
-            x = input
-
-        x_2d = x if x.dim() == 2 else x.contiguous().view(-1, n_in)
-        u = x_2d.mm(self.weight)
-
+            mask_x = self.get_dropout_mask_([batch, self.n_in], float(self.rnn_dropout),
+                generator)
         if self.training and (self.dropout>0):
             bidir = 2 if self.bidirectional else 1
-            mask_h = self.get_dropout_mask_((batch, n_out*bidir), self.dropout)
-            h, c = SRU_Compute(self.activation_type, n_out, self.bidirectional)(u, input, self.bias, c0, mask_h)
+            mask_h = self.get_dropout_mask_([batch, self.n_out*bidir], float(self.dropout),
+                generator)
+        return mask_x, mask_h
+
+    def _forward_masked(self, input: Tensor, c0: Tensor, mask_x: Optional[Tensor],
+                        mask_h: Optional[Tensor], scan: bool = False,
+                        lengths: Optional[Tensor] = None,
+                        last_only: bool = False,
+                        reset: Optional[Tensor] = None,
+                        spans: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+        """ forward() with given dropout masks (see _dropout_masks), so that
+            consecutive pieces of a sequence can share them. input is a padded
+            tensor, lengths an int32 tensor and reset a bool tensor.
+        """
+        if mask_x is not None:
+            if self.batch_first and input.dim() == 3:
+                mask_x = mask_x.unsqueeze(1)
+            x = input * mask_x.expand_as(input)
         else:
-            h, c = SRU_Compute(self.activation_type, n_out, self.bidirectional)(u, input, self.bias, c0)
+            x = input
 
+        x_2d = x if x.dim() == 2 else x.contiguous().view(-1, self.n_in)
+        u = self._project_input(x_2d)
+
+        h, c = sru_compute(u, input, self.bias, c0, mask_h, lengths, self.n_out,
+            self.activation_type, self.bidirectional, scan, self.recompute, last_only,
+            self.light, self.batch_first, self.merge, reset, spans)
+        return sru_project(h, self.weight_proj, self.bidirectional and self.merge == 0), c
+
+    def inference_mode(self):
+        """ True when no gradient is needed and no dropout applies, so the
+            forward pass can skip all autograd bookkeeping. Never the case
+            during ONNX export, which needs the regular forward path.
+        """
+        if torch.onnx.is_in_onnx_export():
+            return False
+        return (not torch.is_grad_enabled()) and not (
+            self.training and (self.dropout > 0 or self.rnn_dropout > 0))
+
+    def inference(self, input, c0=None, scan=False, lengths=None, out=None, last=None,
+                  last_only=False, reset=None, spans=None):
+        """ Forward pass that stores nothing for backward and never
+            materializes the (len, batch, d) cell states: only h and the
+            final state are written, into out and last when they are given.
+            With last_only, h is (batch, n_out*dir) as in forward(). With
+            spans, the states are computed to gather the final state of
+            every sequence (out is then not used for h).
+        """
+        n_in, n_out = self.n_in, self.n_out
+        bidir = 2 if self.bidirectional else 1
+        _, batch = _sru_len_batch(input, self.batch_first)
+        projected = self.weight_proj is not None
+        with torch.no_grad():
+            x_2d = input if input.dim() == 2 else input.contiguous().view(-1, n_in)
+            u = self._project_input(x_2d)
+            c0 = u.new_zeros(batch, n_out*bidir) if c0 is None else c0
+            lengths_ = _lengths_tensor(lengths, input) if lengths is not None else None
+            reset_ = _reset_tensor(reset, input) if reset is not None else None
+            if spans is None:
+                h, last = sru_infer(u, input, self.bias, c0, lengths_, n_out,
+                    self.activation_type, self.bidirectional, scan,
+                    last_only and input.dim() == 3, None if projected else out, last,
+                    self.light, self.batch_first, self.merge, reset_)
+            else:
+                h, state = sru_compute(u, input, self.bias, c0, None, lengths_, n_out,
+                    self.activation_type, self.bidirectional, scan, False,
+                    last_only and input.dim() == 3, self.light, self.batch_first,
+                    self.merge, reset_, spans)
+                last = state if last is None else last.copy_(state)
+            if projected:
+                bidir_h = bidir if self.merge == 0 else 1
+                h = sru_project(h, self.weight_proj, bidir_h == 2, out)
+            return h, last
+
+    def step(self, input, c0=None):
+        """ Advances the cell by a single timestep, for incremental decoding.
+            input is (batch, n_in) and c0 is (batch, n_out). No autograd graph
+            is recorded and dropout is not applied. Returns (h, c).
+        """
+        assert input.dim() == 2
+        assert not self.bidirectional, "step() requires a unidirectional SRUCell"
+        n_out = self.n_out
+        k = self.size_per_dir // n_out
+        kx = _sru_gate_parts(self.light)
+        with torch.no_grad():
+            u = self._project_input(input)
+            dtype = u.dtype
+            acc = _sru_acc_dtype(dtype)
+            u = u.to(acc).view(-1, n_out, k)
+            x = u[..., kx] if k == kx+1 else input.to(acc)
+            bias = self.bias.to(acc)
+            u0 = u[..., 0]
+            g1 = torch.sigmoid(u[..., 1] + bias[:n_out])
+            g2 = torch.sigmoid(u[..., kx-1] + bias[n_out:])
+            c = (u0 - u0*g1) if c0 is None else (c0.to(acc)-u0)*g1 + u0
+            val = _sru_activation(c, self.activation_type)
+            h = (val-x)*g2 + x
+            h = sru_project(h.to(dtype), self.weight_proj, self.bidirectional)
         return h, c
 
-    def get_dropout_mask_(self, size, p):
-        w = self.weight.data
-        return Variable(w.new(*size).bernoulli_(1-p).div_(1-p))
+    def _project_input(self, x_2d: Tensor) -> Tensor:
+        """ u = x W, through the two factors when the weight is low rank. """
+        weight = self.weight
+        if weight is not None:
+            return x_2d.mm(weight)
+        weight_u, weight_v = self.weight_u, self.weight_v
+        assert weight_u is not None and weight_v is not None
+        return x_2d.mm(weight_u).mm(weight_v)
+
+    def get_dropout_mask_(self, size: List[int], p: float,
+                          generator: Optional[torch.Generator] = None) -> Tensor:
+        w = self.bias.detach()
+        return w.new_empty(size).bernoulli_(1-p, generator=generator).div_(1-p)
+
+
+def _sru_limit_threads(num_threads):
+    """ Caps the OpenMP threads of the calling thread, which the compiled CPU
+        kernels use, and ATen too when it shares their OpenMP runtime. Does
+        nothing until the compiled kernels are loaded.
+    """
+    # ATen sets the count of a thread the first time it runs there: done
+    # first, so that it does not undo the cap
+    torch.get_num_threads()
+    if _SRU_CPU_EXT is not None:
+        _SRU_CPU_EXT.sru_set_num_threads(num_threads)
+
+def _sru_run_limited(num_threads, fn, *args):
+    _sru_limit_threads(num_threads)
+    return fn(*args)
+
+class SRUPipelinePool(object):
+    """ Worker threads of the pipelined schedule (SRU(..., pipeline_chunk=n)),
+        one per layer. Every pipelined SRU makes its own, unless one is
+        passed as SRU(..., pipeline_pool=SRUPipelinePool(n)) to share it
+        between modules; with fewer workers than layers, layers wait for a
+        free worker. The threads are started by the first forward pass and
+        stop when the pool is garbage collected. Each worker runs its layer
+        with num_threads OpenMP threads (by default, those of torch divided
+        among the workers), so that concurrent layers do not oversubscribe
+        the cores. Copies (deepcopy, torch.save) start without threads.
+    """
+    def __init__(self, max_workers, num_threads=None):
+        self.max_workers = max_workers
+        self.num_threads = num_threads
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """ Runs fn(*args) on a worker, returns its Future. """
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._executor = ThreadPoolExecutor(self.max_workers,
+                        thread_name_prefix='sru-pipeline')
+        num_threads = self.num_threads
+        if num_threads is None:
+            num_threads = max(1, torch.get_num_threads()//self.max_workers)
+        return self._executor.submit(_sru_run_limited, num_threads, fn, *args)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait)
+
+    def __getstate__(self):
+        return {'max_workers': self.max_workers, 'num_threads': self.num_threads}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
 
 
 class SRU(nn.Module):
     def __init__(self, input_size, hidden_size, num_layers=2, dropout=0, rnn_dropout=0,
-                bidirectional=False, use_tanh=1, use_relu=0):
+                bidirectional=False, use_tanh=1, use_relu=0, scan_threshold=0,
+                recompute=False, checkpoint_segments=0, output='all',
+                pipeline_chunk=0, projection_size=0, rank=0, light=False,
+                batch_first=False, merge_mode='concat', pipeline_pool=None):
         super(SRU, self).__init__()
+        if output not in ('all', 'last'):
+            raise ValueError("output must be 'all' or 'last', got {}".format(output))
+        if pipeline_chunk > 0 and bidirectional:
+            raise ValueError("pipeline_chunk requires a unidirectional SRU")
         self.n_in = input_size
         self.n_out = hidden_size
         self.depth = num_layers
@@ -515,7 +2405,29 @@ class SRU(nn.Module):
         self.rnn_dropout = rnn_dropout
         self.rnn_lst = nn.ModuleList()
         self.bidirectional = bidirectional
-        self.out_size = hidden_size*2 if bidirectional else hidden_size
+        # every layer projects its output to projection_size (per direction)
+        self.projection_size = projection_size
+        self.out_size = projection_size if projection_size > 0 else hidden_size
+        self.out_size *= 2 if bidirectional and merge_mode == 'concat' else 1
+        # how the two directions of every layer are combined (see SRUCell)
+        self.merge_mode = merge_mode
+        # during training, only keep the inputs of this many layer segments
+        # and recompute the layers inside each segment in backward
+        self.checkpoint_segments = checkpoint_segments
+        # 'last': the top layer only computes the output at the last valid
+        # step, and forward() returns it as a (batch, out_size) tensor
+        self.output = output
+        # on CPU, split the sequence into chunks of this many steps and run
+        # the layers concurrently, one thread each: layer i works on chunk t
+        # while layer i+1 works on chunk t-1 (0 = layer by layer)
+        self.pipeline_chunk = pipeline_chunk
+        # threads of the pipelined schedule (see SRUPipelinePool), kept
+        # from one forward pass to the next
+        if pipeline_pool is None and pipeline_chunk > 0:
+            pipeline_pool = SRUPipelinePool(num_layers)
+        self.pipeline_pool = pipeline_pool
+        # input and output are (batch, len, ...), as in every layer
+        self.batch_first = batch_first
 
         for i in range(num_layers):
             l = SRUCell(
@@ -526,6 +2438,13 @@ class SRU(nn.Module):
                 bidirectional = bidirectional,
                 use_tanh = use_tanh,
                 use_relu = use_relu,
+                scan_threshold = scan_threshold,
+                recompute = recompute,
+                projection_size = projection_size,
+                rank = rank,
+                light = light,
+                batch_first = batch_first,
+                merge_mode = merge_mode,
             )
             self.rnn_lst.append(l)
 
@@ -533,28 +2452,904 @@ class SRU(nn.Module):
         for l in self.rnn_lst:
             l.set_bias(bias_val)
 
-    def forward(self, input, c0=None, return_hidden=True):
+    def forward(self, input: Tensor, c0: Optional[Tensor] = None,
+                return_hidden: bool = True, scan: Optional[bool] = None,
+                lengths: Optional[Tensor] = None,
+                generator: Optional[torch.Generator] = None,
+                reset: Optional[Tensor] = None,
+                spans: Optional[Tensor] = None) -> Union[Tensor, Tuple[Tensor, Tensor]]:
+        """ input is (len, batch, n_in), (batch, len, n_in) if batch_first,
+            or a PackedSequence, c0 is (depth, batch, n_out*dir). Dropout masks are drawn from generator
+            when given. Concurrent calls (e.g. from the threads of a server)
+            share nothing but the parameters, so one module in eval mode can
+            serve them all; on CUDA, every call runs on the current stream of
+            its thread. reset marks the first step of every sequence when
+            several are packed into each column (see pack_streams and
+            gather_last); it requires output='all', and such calls do not
+            use the pipelined schedule. The returned hidden state is then per
+            column, and only valid for the sequence packed last in it: with
+            the spans of pack_streams, it is the final state of every
+            sequence instead, (depth, n, n_out*dir) (see gather_state).
+        """
+        packed = False
+        if not torch.jit.is_scripting():
+            packed = isinstance(input, PackedSequence)
+            if packed:
+                input, lengths = pad_packed_sequence(input, batch_first=self.batch_first)
         assert input.dim() == 3 # (len, batch, n_in)
+        if reset is not None and self.output == 'last':
+            raise ValueError("reset requires output='all', gather the last step "
+                "of every sequence with gather_last")
         dir_ = 2 if self.bidirectional else 1
         if c0 is None:
-            zeros = Variable(input.data.new(
-                input.size(1), self.n_out*dir_
-            ).zero_())
-            c0 = [ zeros for i in range(self.depth) ]
+            zeros = input.new_zeros(_sru_len_batch(input, self.batch_first)[1],
+                self.n_out*dir_)
+            c0_ = [ zeros for i in range(self.depth) ]
         else:
             assert c0.dim() == 3    # (depth, batch, n_out*dir_)
-            c0 = [ x.squeeze(0) for x in c0.chunk(self.depth, 0) ]
+            c0_ = [ x.squeeze(0) for x in c0.chunk(self.depth, 0) ]
+
+        if torch.jit.is_scripting():
+            prevx, lstc = self._forward_layers(0, self.depth, input, c0_, scan, lengths,
+                generator, reset, spans)
+            hidden = torch.stack(lstc)
+        elif reset is None and spans is None and self._use_pipeline(input):
+            # (a reset would restart c from the state carried into the chunk
+            # instead of c0)
+            prevx, lstc = self._forward_pipelined(input, c0_, scan, lengths, generator)
+            hidden = torch.stack(lstc)
+        elif all(rnn.inference_mode() for rnn in self.rnn_lst):
+            prevx, hidden = self._forward_inference(input, c0_, scan, lengths, reset,
+                spans)
+        else:
+            if self.checkpoint_segments > 0 and self.training and torch.is_grad_enabled():
+                prevx, lstc = self._forward_checkpointed(input, c0_, scan, lengths,
+                    generator, reset, spans)
+            else:
+                prevx, lstc = self._forward_layers(0, self.depth, input, c0_,
+                    scan, lengths, generator, reset, spans)
+            hidden = torch.stack(lstc)
+
+        if not torch.jit.is_scripting():
+            if packed and self.output == 'all':
+                prevx = pack_padded_sequence(prevx, lengths, batch_first=self.batch_first,
+                    enforce_sorted=False)
+        if return_hidden:
+            return prevx, hidden
+        else:
+            return prevx
 
+    def _forward_inference(self, input, c0, scan, lengths, reset=None, spans=None):
+        """ Runs every layer through SRUCell.inference. Layer outputs alternate
+            between two buffers, and final states are written directly into
+            the returned (depth, batch, n_out*dir) tensor (depth, n, n_out*dir
+            with spans).
+        """
+        length, batch = _sru_len_batch(input, self.batch_first)
+        if spans is not None:
+            batch = spans.size(0)
+        if reset is not None:
+            # converted once for all the layers
+            reset = _reset_tensor(reset, input)
+        with torch.no_grad():
+            # outputs come in the type of the projection (e.g. bfloat16 under
+            # autocast) and the final states in its accumulation type
+            acc = _sru_acc_dtype(input.dtype)
+            hidden = input.new_empty(self.depth, batch,
+                self.n_out*(2 if self.bidirectional else 1), dtype=acc)
+            buffers = [ None, None ]
+            prevx = input
+            for i, rnn in enumerate(self.rnn_lst):
+                last_only = self._last_only(i)
+                scan_ = scan if scan is not None else \
+                    0 < rnn.scan_threshold <= length
+                prevx, _ = rnn.inference(prevx, c0[i], scan_, lengths,
+                    out=None if last_only else buffers[i%2], last=hidden[i],
+                    last_only=last_only, reset=reset, spans=spans)
+                if not last_only:
+                    buffers[i%2] = prevx
+        return prevx, hidden
+
+    def _forward_layers(self, start: int, end: int, prevx: Tensor, c0: List[Tensor],
+                        scan: Optional[bool], lengths: Optional[Tensor],
+                        generator: Optional[torch.Generator] = None,
+                        reset: Optional[Tensor] = None,
+                        spans: Optional[Tensor] = None
+                        ) -> Tuple[Tensor, List[Tensor]]:
+        lstc: List[Tensor] = []
+        for i, rnn in enumerate(self.rnn_lst):
+            if i >= start and i < end:
+                h, c = rnn(prevx, c0[i], scan=scan, lengths=lengths,
+                    last_only=self._last_only(i), generator=generator, reset=reset,
+                    spans=spans)
+                prevx = h
+                lstc.append(c)
+        return prevx, lstc
+
+    def _last_only(self, i: int) -> bool:
+        return self.output == 'last' and i == self.depth-1
+
+    def _use_pipeline(self, input):
+        if self.pipeline_chunk <= 0 or self.depth < 2 or input.is_cuda:
+            return False
+        if _sru_len_batch(input, self.batch_first)[0] <= self.pipeline_chunk:
+            return False
+        if self.checkpoint_segments > 0 and self.training and torch.is_grad_enabled():
+            return False
+        # autocast is thread local and would not reach the worker threads
+        return not torch.is_autocast_enabled(input.device.type)
+
+    def _forward_pipelined(self, input, c0, scan, lengths, generator=None):
+        """ Wavefront schedule over (layer, time chunk): every layer runs in
+            its own thread and goes through the chunks in order, carrying c
+            from one chunk to the next, and starts on chunk t as soon as the
+            layer below has finished it. Dropout masks are drawn once per
+            layer, so the result is the same as with _forward_layers.
+        """
+        from concurrent.futures import Future
+        # loaded here, so that the workers can cap the threads of its kernels
+        get_tensor_backend(input)
+        length, batch = _sru_len_batch(input, self.batch_first)
+        # chunks are taken along the time dimension
+        dim = 1 if self.batch_first else 0
+        starts = list(range(0, length, self.pipeline_chunk))
+        lengths_ = _lengths_tensor(lengths, input) if lengths is not None else None
+        grad_enabled = torch.is_grad_enabled()
+        # drawn here, in layer order, so that they don't depend on scheduling
+        masks = [ (None, None) if rnn.inference_mode() else
+            rnn._dropout_masks(batch, generator) for rnn in self.rnn_lst ]
+        # outputs[i][t]: input of layer i on chunk t
+        outputs = [ [ Future() for t in starts ] for i in range(self.depth+1) ]
+        for t, start in enumerate(starts):
+            outputs[0][t].set_result(input.narrow(dim, start,
+                min(self.pipeline_chunk, length-start)))
+
+        def run_layer(i):
+            rnn = self.rnn_lst[i]
+            try:
+                with torch.set_grad_enabled(grad_enabled):
+                    c = c0[i]
+                    for t, start in enumerate(starts):
+                        x = outputs[i][t].result()
+                        chunk_lengths = None
+                        if lengths_ is not None:
+                            chunk_lengths = (lengths_-start).clamp(0, x.size(dim))
+                        scan_ = scan if scan is not None else \
+                            0 < rnn.scan_threshold <= x.size(dim)
+                        if rnn.inference_mode():
+                            h, c = rnn.inference(x, c, scan_, chunk_lengths)
+                        else:
+                            h, c = rnn._forward_masked(x, c, masks[i][0],
+                                masks[i][1], scan_, chunk_lengths)
+                        outputs[i+1][t].set_result(h)
+                return c
+            except BaseException as e:
+                # unblock the layers above
+                for f in outputs[i+1]:
+                    if not f.done():
+                        f.set_exception(e)
+                raise
+
+        pool = self.pipeline_pool
+        if pool is None:
+            pool = self.pipeline_pool = SRUPipelinePool(self.depth)
+        # (layers are submitted in order: a layer that waits for the one
+        # below never holds the worker that layer needs)
+        layers = [ pool.submit(run_layer, i) for i in range(self.depth) ]
+        lstc = [ f.result() for f in layers ]
+        prevx = torch.cat([ f.result() for f in outputs[-1] ], dim)
+        if self.output == 'last':
+            rows = _sru_last_row(lengths_, length, batch, prevx.device)
+            cols = torch.arange(batch, device=prevx.device)
+            prevx = prevx[cols, rows] if self.batch_first else prevx[rows, cols]
+        return prevx, lstc
+
+    def _forward_checkpointed(self, input, c0, scan, lengths, generator=None, reset=None,
+                              spans=None):
+        """ Keeps only the input of every segment of layers and runs the
+            segment again in backward. Dropout masks are drawn once per layer
+            before the first segment, so the recomputation reuses them and
+            the result is the same as with _forward_layers.
+        """
+        from torch.utils.checkpoint import checkpoint
+        length, batch = _sru_len_batch(input, self.batch_first)
+        lengths_ = _lengths_tensor(lengths, input) if lengths is not None else None
+        reset_ = _reset_tensor(reset, input) if reset is not None else None
+        masks = [ rnn._dropout_masks(batch, generator) for rnn in self.rnn_lst ]
+        seg_size = (self.depth-1)//self.checkpoint_segments+1
+        prevx = input
+        lstc = []
+        for start in range(0, self.depth, seg_size):
+            end = min(start+seg_size, self.depth)
+            def run_segment(x, *c0_, start=start, end=end):
+                c = []
+                for i in range(start, end):
+                    rnn = self.rnn_lst[i]
+                    scan_ = scan if scan is not None else \
+                        0 < rnn.scan_threshold <= length
+                    x, c_i = rnn._forward_masked(x, c0_[i-start], masks[i][0],
+                        masks[i][1], scan_, lengths_, self._last_only(i), reset_, spans)
+                    c.append(c_i)
+                return (x,) + tuple(c)
+            outputs = checkpoint(run_segment, prevx, *c0[start:end],
+                use_reentrant=False)
+            prevx = outputs[0]
+            lstc.extend(outputs[1:])
+        return prevx, lstc
+
+    def step(self, input, c0=None):
+        """ Advances every layer by a single timestep, for incremental
+            decoding. input is (batch, n_in) and c0 is (depth, batch, n_out).
+            Runs without autograd; returns the top layer output and the new
+            (depth, batch, n_out) states.
+        """
+        assert input.dim() == 2 # (batch, n_in)
         prevx = input
         lstc = []
         for i, rnn in enumerate(self.rnn_lst):
-            h, c = rnn(prevx, c0[i])
+            h, c = rnn.step(prevx, None if c0 is None else c0[i])
             prevx = h
             lstc.append(c)
-
-        if return_hidden:
-            return prevx, torch.stack(lstc)
+        return prevx, torch.stack(lstc)
+
+
+
+
+################################################################################
+# Low-rank factorization
+#
+# The input projection is nearly all the cost of SRU. A trained SRUCell can be
+# compressed by replacing its weight with the truncated SVD W ~ U_r S_r V_r^T,
+# stored as weight_u = U_r S_r^1/2 and weight_v = S_r^1/2 V_r^T.
+################################################################################
+
+def _factorize_cell(cell, rank=None, energy=None):
+    weight = cell.weight.detach()
+    U, S, Vh = torch.linalg.svd(weight.to(_sru_acc_dtype(weight.dtype)),
+        full_matrices=False)
+    if rank is None:
+        # smallest rank that keeps this share of sum(S^2)
+        share = (S*S).cumsum(0) / (S*S).sum()
+        rank = int((share < energy).sum().item()) + 1
+    rank = min(rank, S.numel())
+    n_in, size = weight.size()
+    if rank*(n_in+size) >= n_in*size:
+        # the factors would not be smaller than the weight
+        return
+    root = S[:rank].sqrt()
+    cell.weight = None
+    cell.weight_u = nn.Parameter((U[:, :rank]*root).to(weight.dtype))
+    cell.weight_v = nn.Parameter((root.unsqueeze(1)*Vh[:rank]).to(weight.dtype))
+    cell.rank = rank
+
+def factorize_sru(module, rank=None, energy=None):
+    """ Returns a copy of module in which the weight of every SRUCell (including
+        the layers of an SRU) is replaced by a low-rank factorization, from
+        its truncated SVD. Give either the rank, or the share of the squared
+        singular values to keep (energy, e.g. 0.9), in which case each cell
+        gets the smallest rank that reaches it. Cells for which the factors
+        would not be smaller than the weight are left unchanged; cell.rank
+        gives the rank chosen for the others.
+    """
+    import copy
+    if (rank is None) == (energy is None):
+        raise ValueError("give either rank or energy")
+    module = copy.deepcopy(module)
+    cells = [ module ] if isinstance(module, SRUCell) else module.modules()
+    for cell in cells:
+        if isinstance(cell, SRUCell) and cell.weight is not None:
+            _factorize_cell(cell, rank, energy)
+    return module
+
+
+
+################################################################################
+# Structured pruning
+#
+# The recurrence is elementwise, so a hidden unit can be removed exactly: its
+# k columns in weight, its two biases, its row in weight_proj and the rows of
+# the next layer's weight that read its output. What is left is a smaller
+# dense SRU. When a layer takes x straight from its input (k == 3, or 2 when
+# light), unit j reads input feature j, so it is pruned together with unit j
+# of the layer below.
+################################################################################
+
+def _cell_weight(cell):
+    """ (n_in, k*n_out*dir) weight of cell, the product of the factors for a
+        low-rank cell.
+    """
+    if cell.weight is not None:
+        return cell.weight.detach()
+    return cell.weight_u.detach().mm(cell.weight_v.detach())
+
+def _unit_scores(module, score, run):
+    """ One (n_out*dir,) tensor of unit importances per layer of module. """
+    cells = list(module.rnn_lst)
+    if not isinstance(score, str):
+        return [ torch.as_tensor(s).detach().float().cpu().view(-1) for s in score ]
+    if score == 'magnitude':
+        # norm of the weights that compute the unit
+        scores = []
+        for cell in cells:
+            k = cell.size_per_dir // cell.n_out
+            weight = _cell_weight(cell).float()
+            scores.append(weight.view(weight.size(0), -1, k).pow(2).sum(2).sum(0).sqrt())
+        return [ s.cpu() for s in scores ]
+    if run is None:
+        raise ValueError("score '{}' needs run".format(score))
+    if score == 'activation':
+        # variance of the unit's output over all steps and examples. Every
+        # forward path of SRU (and SRUCell.forward) goes through one of
+        # the two methods that are wrapped here.
+        for cell in cells:
+            if cell.weight_proj is not None:
+                raise ValueError("activation scores need the hidden units, "
+                    "which are projected; use 'magnitude' or 'gradient'")
+        stats = {}
+        def recorded(cell, method):
+            def run_cell(*args, **kwargs):
+                h, c = method(*args, **kwargs)
+                h_ = h.detach().float().reshape(-1, h.size(-1))
+                total, sq, n = stats.get(cell, (0, 0, 0))
+                stats[cell] = (total + h_.sum(0), sq + (h_*h_).sum(0), n + h_.size(0))
+                return h, c
+            return run_cell
+        for cell in cells:
+            cell.inference = recorded(cell, cell.inference)
+            cell._forward_masked = recorded(cell, cell._forward_masked)
+        try:
+            run()
+        finally:
+            for cell in cells:
+                del cell.inference
+                del cell._forward_masked
+        if len(stats) < len(cells):
+            raise ValueError("run() did not feed any data through the SRU")
+        scores = []
+        for cell in cells:
+            total, sq, n = stats[cell]
+            scores.append((sq/n - (total/n)**2).clamp(min=0).cpu())
+        return scores
+    if score == 'gradient':
+        # first order Taylor estimate of the change of the loss when all the
+        # parameters of the unit are set to zero: (sum of weight*grad)^2
+        params = list(module.parameters())
+        for p in params:
+            p.grad = None
+        run()
+        scores = []
+        for cell in cells:
+            k = cell.size_per_dir // cell.n_out
+            w = cell.weight if cell.weight is not None else cell.weight_v
+            total = (w.detach()*w.grad).view(w.size(0), -1, k).sum(2).sum(0)
+            total = total + (cell.bias.detach()*cell.bias.grad).view(2, -1).sum(0)
+            if cell.weight_proj is not None:
+                total = total + (cell.weight_proj.detach()*cell.weight_proj.grad).sum(1)
+            scores.append(total.pow(2).float().cpu())
+        for p in params:
+            p.grad = None
+        return scores
+    raise ValueError("unknown score {}, choose from 'magnitude', 'activation' "
+        "and 'gradient'".format(score))
+
+def _prune_cell(cell, keep, in_keep):
+    """ Copy of cell with only the units keep (indices into n_out*dir, the
+        same number in each direction, sorted) that reads only the input
+        features in_keep (None: all of them).
+    """
+    bidir = 2 if cell.bidirectional else 1
+    n_out = cell.n_out
+    m = keep.numel() // bidir
+    k = cell.size_per_dir // n_out
+    kx = _sru_gate_parts(cell.light)
+    n_in = cell.n_in if in_keep is None else in_keep.numel()
+    # a projected x stays projected, even if n_in now matches the hidden size
+    new = SRUCell(n_in, m, cell.dropout, cell.rnn_dropout, cell.bidirectional,
+        use_tanh=int(cell.activation_type == 1), use_relu=int(cell.activation_type == 2),
+        scan_threshold=cell.scan_threshold, recompute=cell.recompute,
+        projection_size=cell.projection_size, rank=cell.rank, light=cell.light,
+        batch_first=cell.batch_first, highway_projection=True if k == kx+1 else None)
+    k_new = new.size_per_dir // m
+    if k == kx and k_new == kx and in_keep is not None and \
+            not torch.equal(in_keep, keep):
+        raise ValueError("a layer that reads x from its input must keep the "
+            "units of the layer below")
+
+    def columns(w):
+        # (rows, k*n_out*dir) -> (rows, dir, m, k)
+        w = w.view(w.size(0), bidir, n_out, k)
+        units = keep.view(bidir, m) % n_out
+        return torch.stack([ w[:, i, units[i]] for i in range(bidir) ], 1)
+
+    if k_new == k:
+        weight = columns(cell.weight.detach() if cell.rank == 0 else cell.weight_v.detach())
+    else:
+        # x was the input itself: it now comes out of the projection, with
+        # one-hot columns that pick input feature i*n_out+j for unit (i, j)
+        if cell.rank > 0:
+            raise ValueError("a low-rank layer that reads x from its input "
+                "cannot be pruned; factorize it after pruning instead")
+        w = columns(cell.weight.detach())
+        onehot = w.new_zeros(cell.n_in, bidir, m, 1)
+        units = torch.arange(keep.numel(), device=keep.device)
+        onehot.view(cell.n_in, -1)[keep, units] = 1
+        weight = torch.cat([ w, onehot ], 3)
+    weight = weight.reshape(weight.size(0), -1)
+    if cell.rank > 0:
+        weight_u = cell.weight_u.detach()
+        new.weight_u.data = (weight_u if in_keep is None else weight_u[in_keep]).clone()
+        new.weight_v.data = weight
+    else:
+        new.weight.data = weight if in_keep is None else weight[in_keep]
+    new.bias.data = cell.bias.detach().view(2, -1)[:, keep].reshape(-1)
+    if cell.weight_proj is not None:
+        new.weight_proj.data = cell.weight_proj.detach()[keep].clone()
+    new.train(cell.training)
+    return new.to(cell.bias.device)
+
+def prune_sru(module, size, score='magnitude', run=None):
+    """ Returns a copy of the SRU module that keeps only size hidden units per
+        direction in every layer, the most important ones by score:
+            'magnitude'   norm of the weights of the unit
+            'activation'  variance of the unit's output, measured while run()
+                          feeds data through the model that contains module
+            'gradient'    first order Taylor estimate of the loss increase
+                          when the unit is removed (sum of weight*grad over
+                          its parameters, squared), from the gradients that
+                          run() computes: it should call backward() on the
+                          loss of some batches, without an optimizer step
+        score can also be a list of (n_out*dir,) tensors, one per layer.
+        Also returns the indices of the output features that are left, to
+        prune the layer that consumes the output (None if the output size
+        does not change, with projection_size). The result is a regular SRU
+        that can be fine-tuned.
+    """
+    import copy
+    if not isinstance(module, SRU):
+        raise TypeError("prune_sru expects an SRU, got {}".format(type(module).__name__))
+    if not 0 < size <= module.n_out:
+        raise ValueError("size must be in [1, {}], got {}".format(module.n_out, size))
+    if module.merge_mode != 'concat':
+        raise ValueError("prune_sru requires merge_mode='concat', got {}".format(
+            module.merge_mode))
+    bidir = 2 if module.bidirectional else 1
+    n_out = module.n_out
+    scores = _unit_scores(module, score, run)
+    cells = list(module.rnn_lst)
+
+    # layers that read x from the output of the layer below share their units
+    groups = []
+    for i, cell in enumerate(cells):
+        k = cell.size_per_dir // cell.n_out
+        below = cells[i-1] if i > 0 else None
+        if below is not None and below.weight_proj is None and \
+                k == _sru_gate_parts(cell.light):
+            groups[-1].append(i)
         else:
-            return prevx
+            groups.append([ i ])
+    keep = [ None ]*len(cells)
+    for group in groups:
+        # scores are scaled by their mean, so that every layer of the group
+        # counts the same
+        total = sum(scores[i] / scores[i].mean().clamp(min=1e-12) for i in group)
+        total = total.view(bidir, n_out)
+        kept = torch.cat([ total[i].topk(size)[1].sort()[0] + i*n_out
+            for i in range(bidir) ])
+        for i in group:
+            keep[i] = kept
+
+    pruned = copy.deepcopy(module)
+    for i, cell in enumerate(cells):
+        in_keep = keep[i-1] if i > 0 and cells[i-1].weight_proj is None else None
+        pruned.rnn_lst[i] = _prune_cell(cell, keep[i].to(cell.bias.device),
+            None if in_keep is None else in_keep.to(cell.bias.device))
+    pruned.n_out = size
+    projection_size = module.projection_size
+    pruned.out_size = (projection_size if projection_size > 0 else size)*bidir
+    return pruned, (None if projection_size > 0 else keep[-1])
+
+
+
+################################################################################
+# ONNX export
+#
+# While torch.onnx.export traces a model, SRU runs its PyTorch implementation:
+# the input projection is exported as a MatMul and the recurrence over time as
+# an ONNX Scan (one per direction), so the model runs on any ONNX runtime.
+################################################################################
+
+def export_onnx(module, args, f=None, **kwargs):
+    """ Exports module (an SRU, an SRUCell or any model that contains them)
+        with torch.onnx.export and returns the ONNX program. The module is
+        exported in eval mode, so dropout is left out of the graph; its
+        training flag is restored afterwards. Keyword arguments (e.g.
+        dynamic_shapes, input_names) are passed on to torch.onnx.export.
+    """
+    training = module.training
+    module.eval()
+    try:
+        return torch.onnx.export(module, args, f, dynamo=True, **kwargs)
+    finally:
+        module.train(training)
+
+
+
+################################################################################
+# Dynamic int8 quantization
+#
+# For CPU serving, the input projection x_2d.mm(weight) can be replaced by an
+# int8 GEMM: the weight is quantized once with one scale per output channel,
+# the input is quantized on the fly at every call (torch dynamic quantization).
+# The elementwise recurrence runs in float32 on the regular backends.
+################################################################################
+
+class QuantizedSRUCell(nn.Module):
+    """ Inference-only SRUCell with an int8 input projection. Build it from a
+        trained cell with QuantizedSRUCell.from_float(), or convert a whole
+        model with quantize_sru().
+    """
+    def __init__(self, n_in, n_out, bidirectional=False, activation_type=1, k=3,
+                 scan_threshold=0, projection_size=0, light=False, batch_first=False,
+                 merge_mode='concat'):
+        super(QuantizedSRUCell, self).__init__()
+        import torch.ao.nn.quantized.dynamic as nnqd
+        self.n_in = n_in
+        self.n_out = n_out
+        self.bidirectional = bidirectional
+        self.activation_type = activation_type
+        self.scan_threshold = scan_threshold
+        self.light = light
+        self.batch_first = batch_first
+        self.merge_mode = merge_mode
+        self.merge = _SRU_MERGE_MODES.index(merge_mode)
+        self.size_per_dir = n_out*k
+        bidir = 2 if bidirectional else 1
+        self.proj = nnqd.Linear(n_in, self.size_per_dir*bidir, bias_=False,
+            dtype=torch.qint8)
+        self.register_buffer('bias', torch.zeros(n_out*2*bidir))
+        # the output projection (if any) stays in float32
+        self.projection_size = projection_size
+        if projection_size > 0:
+            bidir_h = bidir if self.merge == 0 else 1
+            self.register_buffer('weight_proj', torch.zeros(n_out*bidir_h, projection_size))
+        else:
+            self.weight_proj = None
+
+    @classmethod
+    def from_float(cls, cell):
+        k = cell.size_per_dir // cell.n_out
+        qcell = cls(cell.n_in, cell.n_out, cell.bidirectional, cell.activation_type,
+            k, cell.scan_threshold, cell.projection_size, cell.light, cell.batch_first,
+            cell.merge_mode)
+        if cell.weight_proj is not None:
+            qcell.weight_proj.copy_(cell.weight_proj.detach().float())
+        # (k*n_out*dir, n_in): one row, and one symmetric scale, per output channel
+        weight = cell.weight if cell.weight is not None else \
+            cell.weight_u.mm(cell.weight_v)
+        weight = weight.detach().cpu().float().t().contiguous()
+        scale = weight.abs().max(1)[0].clamp(min=1e-8) / 127.0
+        zero_point = torch.zeros(weight.size(0), dtype=torch.long)
+        qweight = torch.quantize_per_channel(weight, scale.double(), zero_point,
+            0, torch.qint8)
+        qcell.proj.set_weight_bias(qweight, None)
+        qcell.bias.copy_(cell.bias.detach().float())
+        return qcell
+
+    def forward(self, input, c0=None, scan=None, lengths=None, last_only=False,
+                generator=None, reset=None, spans=None):
+        """ Same interface as SRUCell.forward (float32 input, CPU only). """
+        packed = isinstance(input, PackedSequence)
+        if packed:
+            input, lengths = pad_packed_sequence(input, batch_first=self.batch_first)
+        assert input.dim() == 2 or input.dim() == 3
+        last_only = last_only and input.dim() == 3
+        if scan is None:
+            scan = (self.scan_threshold > 0) and (input.dim() == 3) and \
+                (_sru_len_batch(input, self.batch_first)[0] >= self.scan_threshold)
+        h, c = self.inference(input, c0, scan, lengths, last_only=last_only, reset=reset,
+            spans=spans)
+        if packed and not last_only:
+            h = pack_padded_sequence(h, lengths, batch_first=self.batch_first,
+                enforce_sorted=False)
+        return h, c
 
+    def inference_mode(self):
+        return True
 
+    def inference(self, input, c0=None, scan=False, lengths=None, out=None, last=None,
+                  last_only=False, reset=None, spans=None):
+        n_in, n_out = self.n_in, self.n_out
+        bidir = 2 if self.bidirectional else 1
+        _, batch = _sru_len_batch(input, self.batch_first)
+        with torch.no_grad():
+            x = input.float()
+            x_2d = x if x.dim() == 2 else x.contiguous().view(-1, n_in)
+            u = self.proj(x_2d)
+            c0 = x.new_zeros(batch, n_out*bidir) if c0 is None else c0
+            lengths_ = _lengths_tensor(lengths, input) if lengths is not None else None
+            reset_ = _reset_tensor(reset, input) if reset is not None else None
+            projected = self.weight_proj is not None
+            if spans is None:
+                h, last = sru_infer(u, x, self.bias, c0, lengths_, n_out,
+                    self.activation_type, self.bidirectional, scan,
+                    last_only and input.dim() == 3, None if projected else out, last,
+                    self.light, self.batch_first, self.merge, reset_)
+            else:
+                # (see SRUCell.inference)
+                h, state = sru_compute(u, x, self.bias, c0, None, lengths_, n_out,
+                    self.activation_type, self.bidirectional, scan, False,
+                    last_only and input.dim() == 3, self.light, self.batch_first,
+                    self.merge, reset_, spans)
+                last = state if last is None else last.copy_(state)
+            if projected:
+                h = sru_project(h, self.weight_proj,
+                    self.bidirectional and self.merge == 0, out)
+            return h, last
+
+    def step(self, input, c0=None):
+        """ Single timestep, as SRUCell.step(). """
+        assert input.dim() == 2
+        assert not self.bidirectional, "step() requires a unidirectional cell"
+        return self.inference(input, c0)
+
+
+def quantize_sru(module):
+    """ Returns a CPU copy of module in which every SRUCell, including the
+        layers of an SRU, is replaced by a QuantizedSRUCell. module may be an
+        SRUCell, an SRU or any model that contains them; the original is left
+        untouched.
+    """
+    import copy
+    if isinstance(module, SRUCell):
+        return QuantizedSRUCell.from_float(module)
+    module = copy.deepcopy(module).cpu()
+    def swap(parent):
+        for name, child in parent.named_children():
+            if isinstance(child, SRUCell):
+                setattr(parent, name, QuantizedSRUCell.from_float(child))
+            else:
+                swap(child)
+    swap(module)
+    return module
+
+
+################################################################################
+# Ensembles
+#
+# N SRU models with the same configuration (e.g. trained with different seeds
+# or cv folds) run as one: each layer computes the projections of all members
+# with one bmm, then runs a single recurrence over batch*N columns. The members
+# are interleaved in the batch dimension (example b of member n is column
+# b*N+n), so member n uses bias set n of the kernels (see _sru_cpu_gates).
+################################################################################
+
+class _SRUEnsembleLayer(nn.Module):
+    """ One layer of every member of an SRUEnsemble, with the weights stacked
+        along a leading member dimension.
+    """
+    def __init__(self, cells):
+        super(_SRUEnsembleLayer, self).__init__()
+        cell = cells[0]
+        self.n_in = cell.n_in
+        self.n_out = cell.n_out
+        self.bidirectional = cell.bidirectional
+        self.activation_type = cell.activation_type
+        self.light = cell.light
+        self.scan_threshold = cell.scan_threshold
+        self.merge = cell.merge
+        self.k = cell.size_per_dir // cell.n_out
+        bidir = 2 if cell.bidirectional else 1
+        weights = [ c.weight if c.weight is not None else c.weight_u.mm(c.weight_v)
+            for c in cells ]
+        # (N, n_in, k*n_out*dir)
+        self.register_buffer('weight', torch.stack([ w.detach() for w in weights ]))
+        # (2, N, n_out*dir): N bias sets, in the layout of the kernels
+        self.register_buffer('bias', torch.stack([ c.bias.detach().view(2, -1)
+            for c in cells ], 1))
+        if cell.weight_proj is not None:
+            # (N, dir, n_out, p), with dir 1 when the directions are merged
+            bidir_h = bidir if self.merge == 0 else 1
+            self.register_buffer('weight_proj', torch.stack([
+                c.weight_proj.detach().view(bidir_h, cell.n_out, -1) for c in cells ]))
+        else:
+            self.weight_proj = None
+
+    def forward(self, x, c0, lengths=None, scan=False, last_only=False):
+        """ x is (len, batch, n_in), the same input for every member, or
+            (len, batch, N, n_in). c0 is (batch, N, n_out*dir). Returns h,
+            (len, batch, N, out) or (batch, N, out) with last_only, and the
+            final states (batch, N, n_out*dir).
+        """
+        N = self.weight.size(0)
+        length, batch = x.size(0), x.size(1)
+        shared = x.dim() == 3
+        bidir_h = 2 if self.bidirectional and self.merge == 0 else 1
+        if shared:
+            x_3d = x.reshape(1, length*batch, self.n_in).expand(N, -1, -1)
+        else:
+            x_3d = x.reshape(length*batch, N, self.n_in).transpose(0, 1)
+        # (N, len*batch, k*d), permuted once into the (len, batch, N) order
+        # of the columns
+        u = torch.bmm(x_3d, self.weight)
+        u = u.transpose(0, 1).reshape(length, batch*N, -1)
+        if self.k == _sru_gate_parts(self.light):
+            x_h = x.unsqueeze(2).expand(-1, -1, N, -1) if shared else x
+            x_h = x_h.reshape(length, batch*N, self.n_in)
+        else:
+            # x is projected, only the shape of the input is read
+            x_h = u.new_empty(length, batch*N, 0)
+        lengths_ = lengths.repeat_interleave(N) if lengths is not None else None
+        h, last = sru_infer(u, x_h, self.bias.view(-1), c0.reshape(batch*N, -1),
+            lengths_, self.n_out, self.activation_type, self.bidirectional, scan,
+            last_only, light=self.light, merge=self.merge)
+        size = list(h.size()[:-2]) + [batch, N, -1]
+        if self.weight_proj is not None:
+            h = torch.einsum('mnid,nidp->mnip',
+                h.reshape(-1, N, bidir_h, self.n_out), self.weight_proj.to(h.dtype))
+        return h.reshape(size), last.view(batch, N, -1)
+
+
+class SRUEnsemble(nn.Module):
+    """ Runs N SRU models that share their configuration (e.g. trained with
+        different seeds or cv folds) at once, for inference. The weights of
+        every layer are stacked, so that a layer costs one bmm and one
+        recurrence over N*batch columns instead of N forward passes. The
+        weights are copied; low-rank layers are multiplied back into full
+        weights.
+    """
+    def __init__(self, models):
+        super(SRUEnsemble, self).__init__()
+        models = list(models)
+        if len(models) == 0:
+            raise ValueError("SRUEnsemble needs at least one model")
+        def config(m):
+            return (m.n_in, m.n_out, m.depth, m.bidirectional, m.out_size, m.output,
+                m.batch_first, [ (c.activation_type, c.light, c.size_per_dir, c.merge)
+                    for c in m.rnn_lst ])
+        if any(config(m) != config(models[0]) for m in models):
+            raise ValueError("the models of an SRUEnsemble must have the same configuration")
+        first = models[0]
+        self.n_models = len(models)
+        self.n_in = first.n_in
+        self.n_out = first.n_out
+        self.depth = first.depth
+        self.bidirectional = first.bidirectional
+        self.out_size = first.out_size
+        self.output = first.output
+        self.batch_first = first.batch_first
+        self.layers = nn.ModuleList([ _SRUEnsembleLayer([ m.rnn_lst[i] for m in models ])
+            for i in range(self.depth) ])
+
+    def forward(self, input, c0=None, lengths=None, average=False, scan=None):
+        """ input is (len, batch, n_in), fed to every member, or
+            (N, len, batch, n_in) with one input per member (e.g. the output
+            of each member's own embedding layer). c0 optionally gives the
+            initial states, (N, depth, batch, n_out*dir).
+            Returns (output, hidden). output is (N, len, batch, out_size), or
+            (N, batch, out_size) for models built with output='last'; with
+            average, it is the mean over the members instead. hidden is
+            (N, depth, batch, n_out*dir). For members built with
+            batch_first, len and batch are swapped in input and output.
+        """
+        assert input.dim() == 3 or input.dim() == 4
+        N = self.n_models
+        dir_ = 2 if self.bidirectional else 1
+        if input.dim() == 4:
+            assert input.size(0) == N
+            # (len, batch, N, n_in)
+            prevx = input.permute(2, 1, 0, 3) if self.batch_first else input.permute(1, 2, 0, 3)
+        else:
+            prevx = input.transpose(0, 1) if self.batch_first else input
+        batch = prevx.size(1)
+        lengths_ = _lengths_tensor(lengths, input) if lengths is not None else None
+        hidden = []
+        with torch.no_grad():
+            for i, layer in enumerate(self.layers):
+                if c0 is None:
+                    c0_i = prevx.new_zeros(batch, N, self.n_out*dir_)
+                else:
+                    c0_i = c0[:, i].transpose(0, 1)
+                scan_ = scan if scan is not None else \
+                    0 < layer.scan_threshold <= prevx.size(0)
+                last_only = self.output == 'last' and i == self.depth-1
+                prevx, c = layer(prevx, c0_i, lengths_, scan_, last_only)
+                hidden.append(c)
+        output = prevx.movedim(-2, 0)
+        if self.batch_first and output.dim() == 4:
+            output = output.transpose(1, 2)
+        if average:
+            output = output.mean(0)
+        return output, torch.stack(hidden).permute(2, 0, 1, 3)
+
+
+################################################################################
+# Sequence packing
+#
+# Batches of short sequences (e.g. the sentences of text classification) are
+# mostly padding. pack_streams concatenates the sequences of a batch into a
+# few columns, "streams", no longer than the longest sequence, with a reset
+# mask that makes the kernels restart the cell state from c0 at the first
+# step of every sequence. Every layer then runs densely over the tokens, and
+# gather_last picks the output at the end of every sequence.
+################################################################################
+
+def pack_streams(sequences, length=None, batch_first=False, padding_value=0):
+    """ Packs a list of tensors (len_i, *) one after the other into streams of
+        at most length steps (by default, the length of the longest one),
+        first fit, longest first. Returns (input, reset, lengths, spans):
+            input    (len, streams, *), or (streams, len, *) with batch_first
+            reset    bool, (len, streams) or (streams, len), set at the first
+                     step of every sequence, for the reset argument of SRU
+            lengths  (streams,) steps used in every stream, for its lengths
+                     argument (the rest of the stream is padding)
+            spans    (n, 3) long tensor of (stream, start, length) for every
+                     sequence, in the order of sequences, for gather_last
+    """
+    sizes = [ int(seq.size(0)) for seq in sequences ]
+    if len(sizes) == 0 or min(sizes) == 0:
+        raise ValueError("pack_streams needs non-empty sequences")
+    length = max(sizes) if length is None else length
+    if max(sizes) > length:
+        raise ValueError("a sequence of {} steps does not fit in streams of {}".format(
+            max(sizes), length))
+    used = []
+    spans = [ None ]*len(sizes)
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        s = next((s for s, n in enumerate(used) if n+sizes[i] <= length), len(used))
+        if s == len(used):
+            used.append(0)
+        spans[i] = (s, used[s], sizes[i])
+        used[s] += sizes[i]
+
+    first = sequences[0]
+    device = first.device
+    spans = torch.tensor(spans, dtype=torch.long, device=device)
+    steps = max(used)
+    size = (len(used), steps) if batch_first else (steps, len(used))
+    input = first.new_full(size + tuple(first.size()[1:]), padding_value)
+    reset = torch.zeros(size, dtype=torch.bool, device=device)
+    # (stream, row) of every step of every sequence
+    counts = spans[:, 2]
+    offsets = torch.arange(int(counts.sum()), device=device) - \
+        (counts.cumsum(0)-counts).repeat_interleave(counts)
+    streams = spans[:, 0].repeat_interleave(counts)
+    rows = spans[:, 1].repeat_interleave(counts) + offsets
+    data = torch.cat(list(sequences))
+    if batch_first:
+        input[streams, rows] = data
+        reset[spans[:, 0], spans[:, 1]] = True
+    else:
+        input[rows, streams] = data
+        reset[spans[:, 1], spans[:, 0]] = True
+    lengths = torch.tensor(used, dtype=torch.long, device=device)
+    return input, reset, lengths, spans
+
+def gather_last(output, spans, bidirectional=False, batch_first=False):
+    """ Output of every sequence packed by pack_streams at its last step,
+        (n, features) in the order of the sequences. output is the output of
+        an SRU (or SRUCell) run with the reset mask. The backward direction
+        of a bidirectional SRU ends at the first step of every sequence, so
+        with bidirectional the second half of the features is taken there
+        (the directions must not be merged).
+        The hidden state returned with the output is per column, and only
+        valid for the sequence packed last in it: pass spans to the forward
+        pass to get the final state of every sequence (see gather_state).
+    """
+    return gather_state(output, spans, bidirectional, batch_first)
+
+def gather_state(c: Tensor, spans: Tensor, bidirectional: bool = False,
+                 batch_first: bool = False) -> Tensor:
+    """ Final state of every sequence packed by pack_streams, (n, d*dir) in
+        the order of the sequences, from the states c (len, streams, d*dir)
+        of every step, as gather_last does for the outputs. SRUCell and SRU
+        return it as their hidden state when given the spans.
+    """
+    spans = spans.to(c.device)
+    stream, start, length = spans[:, 0], spans[:, 1], spans[:, 2]
+    end = start+length-1
+    last = c[stream, end] if batch_first else c[end, stream]
+    if bidirectional:
+        d = c.size(-1)//2
+        first = c[stream, start] if batch_first else c[start, stream]
+        return torch.cat([ last[:, :d], first[:, d:] ], 1)
+    return last
@@ -72,7 +72,9 @@ class Model(nn.Module):
             self.rnn = MF.SRU(self.n_d, self.n_d, self.depth,
                 dropout = args.rnn_dropout,
                 rnn_dropout = args.rnn_dropout,
-                use_tanh = 0
+                use_tanh = 0,
+                rank = args.rank,
+                light = args.light
             )
         self.output_layer = nn.Linear(self.n_d, self.n_V)
         # tie weights
@@ -80,6 +82,10 @@ class Model(nn.Module):
 
         self.init_weights()
         if not args.lstm:
+            if args.rank > 0:
+                # init_weights() assumes full n_d x n_d matrices
+                for rnn in self.rnn.rnn_lst:
+                    rnn.init_weight()
             self.rnn.set_bias(args.bias)
 
     def init_weights(self):
@@ -169,7 +175,8 @@ def eval_model(model, valid):
         x, y = Variable(x, volatile=True), Variable(y)
         hidden = (Variable(hidden[0].data), Variable(hidden[1].data)) if args.lstm \
             else Variable(hidden.data)
-        output, hidden = model(x, hidden)
+        with torch.no_grad():
+            output, hidden = model(x, hidden)
         loss = criterion(output, y)
         total_loss += loss.data[0]
     avg_loss = total_loss / valid[1].numel()
@@ -251,6 +258,12 @@ if __name__ == "__main__":
         help="intial bias of highway gates",
     )
     argparser.add_argument("--depth", type=int, default=6)
+    argparser.add_argument("--rank", type=int, default=0,
+        help="rank of the factorized SRU weights (0 = full weights)"
+    )
+    argparser.add_argument("--light", action="store_true",
+        help="use the light SRU, whose highway gate shares the forget gate projection"
+    )
     argparser.add_argument("--lr", type=float, default=1.0)
     argparser.add_argument("--lr_decay", type=float, default=0.98)
     argparser.add_argument("--lr_decay_epoch", type=int, default=175)
@@ -1,2 +1,7 @@
 from .version import __version__
-from .cuda_functional import *
+try:
+    from .cuda_functional import *
+except ImportError as e:
+    # without PyTorch, only sru.numpy_runtime can be used
+    if e.name != 'torch':
+        raise
@@ -0,0 +1,243 @@
+""" Forward inference of trained SRU models with NumPy only, for workers that
+    score batches without installing PyTorch.
+
+    Save the weights on the PyTorch side as NumPy arrays:
+
+        np.savez('sru.npz', **{k: v.cpu().numpy() for k, v in rnn.state_dict().items()})
+
+    and load them without torch:
+
+        from sru import numpy_runtime
+        rnn = numpy_runtime.SRU.from_state_dict(np.load('sru.npz'), bidirectional=False)
+        output, hidden = rnn(x)
+
+    The input projection is a single matrix product per layer and the gates
+    are computed for all timesteps at once; only the elementwise update of the
+    cell state runs as a loop over time. Results match SRU / SRUCell in eval
+    mode (no dropout).
+"""
+import numpy as np
+
+
+def _sigmoid_(x):
+    # in place; same as 1/(1+exp(-x)), without overflow for large negative x
+    x *= 0.5
+    np.tanh(x, out=x)
+    x *= 0.5
+    x += 0.5
+    return x
+
+def _activation_(c, activation_type):
+    if activation_type == 1:
+        np.tanh(c, out=c)
+    elif activation_type == 2:
+        np.maximum(c, 0, out=c)
+    return c
+
+def sru_forward(u, x, bias, init, d, activation_type, bidirectional, lengths=None,
+                light=False, merge=0, reset=None):
+    """ Runs the recurrence on the projection u = x W. u is (len, batch, dir*k*d):
+        unlike the PyTorch layout (dir, d, k), the k parts of every direction
+        are stored one after the other (see SRUCell), so that each of them is
+        contiguous. x is (len, batch, n_in), bias is (2*d*dir,) and init is
+        (batch, d*dir). lengths optionally gives the true length of each
+        example: steps past it output zeros and the final state is the one at
+        the last valid step. With light, both gates are computed from u1
+        and x, when projected, is u2. merge (1: sum, 2: mean) combines the
+        two directions into d features; x, when not projected, is then
+        (len, batch, d) and feeds both of them. reset (len, batch), set at
+        the first step of every sequence packed into a column, restarts c
+        from init there (in the backward direction, after the last step).
+        Returns h (len, batch, d*dir), or (len, batch, d) with merge, and the
+        final state (batch, d*dir).
+    """
+    bidir = 2 if bidirectional else 1
+    length, batch = u.shape[0], u.shape[1]
+    k = u.shape[-1] // d // bidir
+    kx = 2 if light else 3
+    u = u.reshape(length, batch, bidir, k, d)
+    x = u[:, :, :, kx] if k == kx+1 else x.reshape(length, batch, -1, d)
+    bias = bias.reshape(2, bidir, d)
+    g1 = _sigmoid_(u[:, :, :, 1] + bias[0])
+    g2 = _sigmoid_(u[:, :, :, kx-1] + bias[1])
+
+    # c = (c'-u0)*g1 + u0 = c'*g1 + u0*(1-g1)
+    a = g1
+    b = np.subtract(1, g1)
+    b *= u[:, :, :, 0]
+    valid = None
+    if lengths is not None:
+        # c passes through padding unchanged
+        steps = np.arange(length).reshape(-1, 1)
+        valid = (steps < np.asarray(lengths).reshape(1, -1)).astype(u.dtype)
+        valid = valid.reshape(length, batch, 1, 1)
+        a = a*valid + (1-valid)
+        b = b*valid
+    cur = np.array(init, dtype=u.dtype).reshape(batch, bidir, d)
+    if reset is not None:
+        # c = c'*a + b restarts from init where r is set:
+        # c = c'*a*(1-r) + (b + a*r*init)
+        r = np.zeros((length, batch, bidir, 1), dtype=u.dtype)
+        r[:, :, 0, 0] = reset
+        if bidirectional:
+            r[:-1, :, 1, 0] = reset[1:]
+        if valid is not None:
+            r *= valid
+        b = b + a*r*cur
+        a = a*(1-r)
+    if bidirectional:
+        # the backward direction runs over reversed time, so that both
+        # directions advance in the same loop
+        a, b = a.copy(), b.copy()
+        a[:, :, 1] = a[::-1, :, 1]
+        b[:, :, 1] = b[::-1, :, 1]
+
+    c = np.empty_like(b)
+    for t in range(length):
+        np.multiply(cur, a[t], out=c[t])
+        np.add(c[t], b[t], out=c[t])
+        cur = c[t]
+    last = cur.reshape(batch, bidir*d).copy()
+    if bidirectional:
+        c[:, :, 1] = c[::-1, :, 1].copy()
+
+    # h = (act(c)-x)*g2 + x, computed in the storage of c
+    h = _activation_(c, activation_type)
+    h -= x
+    h *= g2
+    h += x
+    if valid is not None:
+        h *= valid
+    if merge:
+        h = h.sum(axis=2) if merge == 1 else h.mean(axis=2)
+    return h.reshape(length, batch, -1), last
+
+
+class SRUCell(object):
+    """ NumPy counterpart of cuda_functional.SRUCell, for inference.
+        weight is (n_in, k*n_out*dir) and bias is (2*n_out*dir,), as in the
+        state dict of the PyTorch module; weight_proj (n_out*dir, p) is the
+        optional output projection. A low-rank cell passes weight=None and
+        its factors weight_u (n_in, rank) and weight_v (rank, k*n_out*dir).
+        light must be set for cells trained with light=True, and merge_mode
+        ('concat', 'sum' or 'mean') to the one of a bidirectional cell.
+    """
+    def __init__(self, weight, bias, bidirectional=False, activation_type=1,
+                 dtype=np.float32, weight_proj=None, weight_u=None, weight_v=None,
+                 light=False, merge_mode='concat'):
+        self.weight_u = None
+        if weight is None:
+            self.weight_u = np.ascontiguousarray(weight_u, dtype=dtype)
+            weight = weight_v
+        weight = np.asarray(weight, dtype=dtype)
+        self.bias = np.ascontiguousarray(bias, dtype=dtype).reshape(-1)
+        self.bidirectional = bidirectional
+        self.activation_type = activation_type
+        self.light = light
+        self.merge_mode = merge_mode
+        self.merge = ('concat', 'sum', 'mean').index(merge_mode) if bidirectional else 0
+        self.dtype = weight.dtype
+        bidir = 2 if bidirectional else 1
+        rows = weight.shape[0]
+        self.n_in = rows if self.weight_u is None else self.weight_u.shape[0]
+        self.n_out = self.bias.shape[0] // 2 // bidir
+        self.size_per_dir = weight.shape[1] // bidir
+        k = self.size_per_dir // self.n_out
+        kx = 2 if light else 3
+        assert k == kx or k == kx+1
+        # columns reordered from (dir, n_out, k) to (dir, k, n_out)
+        self.weight = np.ascontiguousarray(weight.reshape(rows, bidir,
+            self.n_out, k).transpose(0, 1, 3, 2).reshape(rows, -1))
+        self.weight_proj = None
+        if weight_proj is not None:
+            # (dir, n_out, p): one block per direction, a single one when
+            # the directions are merged
+            self.weight_proj = np.ascontiguousarray(weight_proj, dtype=dtype) \
+                .reshape(1 if self.merge else bidir, self.n_out, -1)
+
+    @classmethod
+    def from_state_dict(cls, state_dict, prefix='', bidirectional=False,
+                        activation_type=1, dtype=np.float32, light=False,
+                        merge_mode='concat'):
+        """ Builds the cell from the state dict of an SRUCell; the values can
+            be NumPy arrays (e.g. the result of np.load on an .npz file) or
+            CPU tensors. The state dict does not record the configuration,
+            so bidirectional, activation_type (0: identity, 1: tanh,
+            2: relu), light and merge_mode must match the trained module.
+        """
+        def get(name):
+            if prefix + name in state_dict:
+                return np.asarray(state_dict[prefix + name])
+            return None
+        return cls(get('weight'), get('bias'), bidirectional, activation_type,
+            dtype, get('weight_proj'), get('weight_u'), get('weight_v'), light,
+            merge_mode)
+
+    def __call__(self, input, c0=None, lengths=None, reset=None):
+        """ input is (len, batch, n_in) or (batch, n_in). Returns (h, c) as
+            SRUCell.forward, with c the final state. reset (len, batch) is the
+            mask of cuda_functional.pack_streams.
+        """
+        assert input.ndim == 2 or input.ndim == 3
+        single = input.ndim == 2
+        x = np.asarray(input, dtype=self.dtype)
+        if single:
+            x = x[np.newaxis]
+        length, batch = x.shape[0], x.shape[1]
+        bidir = 2 if self.bidirectional else 1
+        x_2d = x.reshape(-1, self.n_in)
+        if self.weight_u is not None:
+            x_2d = x_2d.dot(self.weight_u)
+        u = x_2d.dot(self.weight).reshape(length, batch, -1)
+        if c0 is None:
+            c0 = np.zeros((batch, self.n_out*bidir), dtype=x.dtype)
+        h, c = sru_forward(u, x, self.bias, c0, self.n_out, self.activation_type,
+            self.bidirectional, lengths, self.light, self.merge,
+            None if reset is None else np.asarray(reset))
+        if self.weight_proj is not None:
+            h = h.reshape(length*batch, self.weight_proj.shape[0], self.n_out)
+            h = np.einsum('nid,idp->nip', h, self.weight_proj).reshape(length, batch, -1)
+        return (h[0] if single else h), c
+
+
+class SRU(object):
+    """ NumPy counterpart of cuda_functional.SRU, for inference: a stack of
+        SRUCell layers.
+    """
+    def __init__(self, layers):
+        self.rnn_lst = list(layers)
+        self.depth = len(self.rnn_lst)
+        self.bidirectional = self.rnn_lst[0].bidirectional
+        self.n_in = self.rnn_lst[0].n_in
+        self.n_out = self.rnn_lst[0].n_out
+
+    @classmethod
+    def from_state_dict(cls, state_dict, prefix='', bidirectional=False,
+                        activation_type=1, dtype=np.float32, light=False,
+                        merge_mode='concat'):
+        """ Builds the stack from the state dict of an SRU, whose layers are
+            stored under rnn_lst.0, rnn_lst.1, ... Use prefix to pick the SRU
+            inside a larger model (e.g. prefix='encoder.').
+        """
+        layers = []
+        while '{}rnn_lst.{}.bias'.format(prefix, len(layers)) in state_dict:
+            layers.append(SRUCell.from_state_dict(state_dict,
+                '{}rnn_lst.{}.'.format(prefix, len(layers)), bidirectional,
+                activation_type, dtype, light, merge_mode))
+        if not layers:
+            raise KeyError('no SRU layers found under "{}rnn_lst"'.format(prefix))
+        return cls(layers)
+
+    def __call__(self, input, c0=None, lengths=None, reset=None):
+        """ input is (len, batch, n_in) and c0 is (depth, batch, n_out*dir).
+            Returns the output of the top layer and the final states of all
+            layers, as SRU.forward.
+        """
+        assert input.ndim == 3
+        prevx = input
+        lstc = []
+        for i, rnn in enumerate(self.rnn_lst):
+            h, c = rnn(prevx, None if c0 is None else c0[i], lengths, reset)
+            prevx = h
+            lstc.append(c)
+        return prevx, np.stack(lstc)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# cuda_functional.py lives at the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,108 @@
+""" The CPU backends ('ext', the OpenMP kernels, and 'torch') must agree with
+    each other, and their gradients with autograd's numerical ones.
+"""
+import pytest
+import torch
+from torch.func import functional_call
+
+import cuda_functional as MF
+
+BACKENDS = ['ext', 'torch']
+
+CONFIGS = [
+    dict(),
+    dict(bidirectional=True),
+    dict(light=True),
+    dict(bidirectional=True, merge_mode='sum'),
+    dict(bidirectional=True, merge_mode='mean', light=True),
+    dict(projection_size=3),
+    dict(bidirectional=True, projection_size=3, use_relu=1),
+    dict(use_tanh=0),
+    dict(bidirectional=True, batch_first=True),
+    dict(output='last'),
+]
+
+
+def use_backend(name):
+    MF.set_cpu_backend(name)
+    try:
+        MF.get_backend('cpu')
+    except RuntimeError:
+        MF.set_cpu_backend(None)
+        pytest.skip('the {} backend is not available'.format(name))
+
+
+def make_input(cfg, length=6, batch=4, n_in=5, with_lengths=False, with_reset=False):
+    torch.manual_seed(1)
+    x = torch.randn(length, batch, n_in, dtype=torch.double)
+    lengths = torch.tensor([length, 2, 0, length-1][:batch]) if with_lengths else None
+    reset = (torch.rand(length, batch) < 0.3) if with_reset else None
+    if cfg.get('batch_first'):
+        x = x.transpose(0, 1).contiguous()
+        reset = reset.t().contiguous() if reset is not None else None
+    return x, lengths, reset
+
+
+def run(model, x, lengths, reset):
+    x = x.clone().requires_grad_()
+    generator = torch.Generator().manual_seed(3)
+    output, hidden = model(x, lengths=lengths, reset=reset, generator=generator)
+    # weight every output differently, so that misplaced gradients show up
+    weight = torch.linspace(-1, 1, output.numel(), dtype=output.dtype).view_as(output)
+    ((output*weight).sum() + hidden.square().sum()).backward()
+    grads = [ x.grad ] + [ p.grad for p in model.parameters() ]
+    model.zero_grad()
+    return output.detach(), hidden.detach(), grads
+
+
+@pytest.mark.parametrize('cfg', CONFIGS, ids=str)
+@pytest.mark.parametrize('with_lengths', [False, True])
+@pytest.mark.parametrize('with_reset', [False, True])
+def test_backend_parity(cfg, with_lengths, with_reset):
+    if with_reset and cfg.get('output') == 'last':
+        pytest.skip("reset requires output='all'")
+    torch.manual_seed(0)
+    model = MF.SRU(5, 4, 2, dropout=0.2, rnn_dropout=0.2, **cfg).double()
+    model.set_bias(0.5)
+    x, lengths, reset = make_input(cfg, with_lengths=with_lengths, with_reset=with_reset)
+    results = []
+    try:
+        for backend in BACKENDS:
+            use_backend(backend)
+            results.append(run(model, x, lengths, reset))
+    finally:
+        MF.set_cpu_backend(None)
+    (out1, hid1, grads1), (out2, hid2, grads2) = results
+    torch.testing.assert_close(out1, out2, rtol=0, atol=1e-10)
+    torch.testing.assert_close(hid1, hid2, rtol=0, atol=1e-10)
+    for g1, g2 in zip(grads1, grads2):
+        torch.testing.assert_close(g1, g2, rtol=0, atol=1e-10)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('cfg', CONFIGS, ids=str)
+def test_gradcheck(backend, cfg):
+    torch.manual_seed(0)
+    cfg = dict(cfg)
+    last_only = cfg.pop('output', 'all') == 'last'
+    cell = MF.SRUCell(5, 3, dropout=0.2, rnn_dropout=0.2, **cfg).double()
+    cell.set_bias(0.5)
+    x, lengths, reset = make_input(cfg, length=4, batch=3, with_lengths=True,
+        with_reset=True)
+    c0 = torch.randn(3, cell.n_out*(2 if cell.bidirectional else 1), dtype=torch.double)
+    names = [ name for name, _ in cell.named_parameters() ]
+
+    def fn(x, c0, *params):
+        # the same dropout masks at every evaluation
+        generator = torch.Generator().manual_seed(3)
+        return functional_call(cell, dict(zip(names, params)), (x, c0),
+            dict(lengths=lengths, reset=reset, generator=generator,
+                last_only=last_only))
+
+    inputs = [ x.requires_grad_(), c0.requires_grad_() ] + \
+        [ p.detach().requires_grad_() for p in cell.parameters() ]
+    use_backend(backend)
+    try:
+        assert torch.autograd.gradcheck(fn, inputs)
+    finally:
+        MF.set_cpu_backend(None)
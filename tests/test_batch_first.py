@@ -0,0 +1,44 @@
+""" batch_first must give the same outputs and gradients as the time-major
+    layout, on every device with an SRU backend.
+"""
+import pytest
+import torch
+
+import cuda_functional as MF
+
+DEVICES = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+
+
+def run(model, x, lengths, batch_first):
+    x = x.clone().requires_grad_()
+    input = x.transpose(0, 1).contiguous() if batch_first else x
+    output, hidden = model(input, lengths=lengths)
+    if batch_first and model.output == 'all':
+        output = output.transpose(0, 1)
+    # weight every output differently, so that misplaced gradients show up
+    weight = torch.linspace(-1, 1, output.numel(), device=x.device).view_as(output)
+    loss = (output*weight).sum() + hidden.sum()
+    loss.backward()
+    grads = [ x.grad ] + [ p.grad for p in model.parameters() ]
+    return output.detach(), hidden.detach(), grads
+
+
+@pytest.mark.parametrize('device', DEVICES)
+@pytest.mark.parametrize('bidirectional', [False, True])
+@pytest.mark.parametrize('n_in', [8, 5])
+@pytest.mark.parametrize('with_lengths', [False, True])
+def test_batch_first_parity(device, bidirectional, n_in, with_lengths):
+    torch.manual_seed(0)
+    tm = MF.SRU(n_in, 8, 2, bidirectional=bidirectional).to(device)
+    tm.set_bias(0.5)
+    bf = MF.SRU(n_in, 8, 2, bidirectional=bidirectional, batch_first=True).to(device)
+    bf.load_state_dict(tm.state_dict())
+    x = torch.randn(7, 4, n_in, device=device)
+    lengths = torch.tensor([7, 3, 5, 1], device=device) if with_lengths else None
+
+    out1, hid1, grads1 = run(tm, x, lengths, False)
+    out2, hid2, grads2 = run(bf, x, lengths, True)
+    torch.testing.assert_close(out2, out1, rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(hid2, hid1, rtol=1e-5, atol=1e-5)
+    for g1, g2 in zip(grads1, grads2):
+        torch.testing.assert_close(g2, g1, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,70 @@
+""" recompute and checkpoint_segments trade time for memory: the outputs and
+    gradients must be the ones of the plain SRU.
+"""
+import pytest
+import torch
+
+import cuda_functional as MF
+
+CONFIGS = [
+    dict(),
+    dict(bidirectional=True),
+    dict(light=True, projection_size=3),
+    dict(bidirectional=True, batch_first=True, merge_mode='sum'),
+    dict(output='last'),
+]
+
+MODES = [
+    dict(recompute=True),
+    dict(checkpoint_segments=1),
+    dict(checkpoint_segments=2),
+    dict(checkpoint_segments=3),
+    dict(recompute=True, checkpoint_segments=2),
+]
+
+
+def run(model, x, lengths, reset):
+    x = x.clone().requires_grad_()
+    generator = torch.Generator().manual_seed(3)
+    output, hidden = model(x, lengths=lengths, reset=reset, generator=generator)
+    # weight every output differently, so that misplaced gradients show up
+    weight = torch.linspace(-1, 1, output.numel(), dtype=output.dtype).view_as(output)
+    ((output*weight).sum() + hidden.square().sum()).backward()
+    grads = [ x.grad ] + [ p.grad for p in model.parameters() ]
+    model.zero_grad()
+    return output.detach(), hidden.detach(), grads
+
+
+@pytest.mark.parametrize('backend', ['ext', 'torch'])
+@pytest.mark.parametrize('with_reset', [False, True])
+@pytest.mark.parametrize('mode', MODES, ids=str)
+@pytest.mark.parametrize('cfg', CONFIGS, ids=str)
+def test_same_gradients(backend, with_reset, mode, cfg):
+    if with_reset and cfg.get('output') == 'last':
+        pytest.skip("reset requires output='all'")
+    MF.set_cpu_backend(backend)
+    try:
+        try:
+            MF.get_backend('cpu')
+        except RuntimeError:
+            pytest.skip('the {} backend is not available'.format(backend))
+        torch.manual_seed(0)
+        model = MF.SRU(5, 4, 3, dropout=0.2, rnn_dropout=0.2, **cfg).double()
+        model.set_bias(0.5)
+        saving = MF.SRU(5, 4, 3, dropout=0.2, rnn_dropout=0.2, **cfg, **mode).double()
+        saving.load_state_dict(model.state_dict())
+        x = torch.randn(7, 3, 5, dtype=torch.double)
+        lengths = torch.tensor([7, 4, 1])
+        reset = (torch.rand(7, 3) < 0.3) if with_reset else None
+        if model.batch_first:
+            x = x.transpose(0, 1).contiguous()
+            reset = reset.t().contiguous() if reset is not None else None
+
+        out1, hid1, grads1 = run(model, x, lengths, reset)
+        out2, hid2, grads2 = run(saving, x, lengths, reset)
+        torch.testing.assert_close(out2, out1)
+        torch.testing.assert_close(hid2, hid1)
+        for g1, g2 in zip(grads1, grads2):
+            torch.testing.assert_close(g2, g1)
+    finally:
+        MF.set_cpu_backend(None)
@@ -0,0 +1,41 @@
+""" SRUEnsemble must match running its members one by one. """
+import pytest
+import torch
+
+import cuda_functional as MF
+
+
+def members(n, **cfg):
+    torch.manual_seed(0)
+    return [ MF.SRU(6, 8, 2, **cfg).eval() for i in range(n) ]
+
+
+@pytest.mark.parametrize('cfg', [
+    dict(),
+    dict(batch_first=True),
+    dict(batch_first=True, bidirectional=True, merge_mode='sum'),
+    dict(batch_first=True, output='last', light=True),
+], ids=str)
+@pytest.mark.parametrize('shared', [True, False])
+def test_ensemble_parity(cfg, shared):
+    models = members(3, **cfg)
+    ens = MF.SRUEnsemble(models)
+    size = (4, 7, 6) if cfg.get('batch_first') else (7, 4, 6)
+    x = torch.randn(size) if shared else torch.randn((3,) + size)
+    lengths = torch.tensor([7, 2, 5, 1])
+    output, hidden = ens(x, lengths=lengths)
+    with torch.no_grad():
+        expected = [ m(x if shared else x[i], lengths=lengths) for i, m in enumerate(models) ]
+    torch.testing.assert_close(output, torch.stack([ o for o, h in expected ]),
+        rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(hidden, torch.stack([ h for o, h in expected ]),
+        rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('cfg', [
+    dict(batch_first=True), dict(light=True), dict(bidirectional=True, merge_mode='mean'),
+], ids=str)
+def test_ensemble_rejects_mixed_members(cfg):
+    base = dict(bidirectional=True) if 'merge_mode' in cfg else {}
+    with pytest.raises(ValueError):
+        MF.SRUEnsemble(members(1, **base) + members(1, **cfg))
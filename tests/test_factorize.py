@@ -0,0 +1,95 @@
+""" factorize_sru must replace every weight by its truncated SVD. """
+import pytest
+import torch
+
+import cuda_functional as MF
+
+
+def with_spectrum(cell, spectrum):
+    """ Sets the weight of cell to a matrix with the given singular values. """
+    torch.manual_seed(1)
+    n_in, size = cell.weight.size()
+    U = torch.linalg.qr(torch.randn(n_in, n_in, dtype=torch.double))[0]
+    V = torch.linalg.qr(torch.randn(size, n_in, dtype=torch.double))[0]
+    S = torch.zeros(n_in, dtype=torch.double)
+    S[:len(spectrum)] = torch.tensor(spectrum, dtype=torch.double)
+    cell.weight.data.copy_((U*S).matmul(V.t()))
+
+
+def run(model, x):
+    with torch.no_grad():
+        return model(x)
+
+
+@pytest.mark.parametrize('cfg', [dict(), dict(bidirectional=True), dict(light=True)],
+    ids=str)
+def test_factorize_exact_rank(cfg):
+    torch.manual_seed(0)
+    model = MF.SRU(16, 8, 2, **cfg).double().eval()
+    model.set_bias(0.5)
+    for cell in model.rnn_lst:
+        with_spectrum(cell, [ 3, 2, 1 ])
+    factorized = MF.factorize_sru(model, rank=3)
+    for cell, f_cell in zip(model.rnn_lst, factorized.rnn_lst):
+        assert f_cell.weight is None and f_cell.rank == 3
+        assert f_cell.weight_u.size() == (cell.n_in, 3)
+        torch.testing.assert_close(f_cell.weight_u.matmul(f_cell.weight_v), cell.weight)
+    # the original is left as it was
+    assert all(cell.weight is not None for cell in model.rnn_lst)
+    x = torch.randn(7, 4, 16, dtype=torch.double)
+    output, hidden = run(model, x)
+    f_output, f_hidden = run(factorized, x)
+    torch.testing.assert_close(f_output, output)
+    torch.testing.assert_close(f_hidden, hidden)
+
+
+def test_factorize_truncation_error():
+    cell = MF.SRUCell(16, 8).double()
+    spectrum = [ 5, 4, 3, 2, 1, 0.5 ]
+    with_spectrum(cell, spectrum)
+    factorized = MF.factorize_sru(cell, rank=2)
+    error = cell.weight - factorized.weight_u.matmul(factorized.weight_v)
+    # the best rank 2 approximation (Eckart-Young)
+    expected = sum(s*s for s in spectrum[2:])**0.5
+    torch.testing.assert_close(error.norm().item(), expected)
+
+
+@pytest.mark.parametrize('energy, rank', [(0.4, 1), (0.5, 2), (0.9, 3), (0.99, 5)])
+def test_factorize_energy(energy, rank):
+    cell = MF.SRUCell(16, 8).double()
+    # cumulated shares of the squares: 0.45, 0.74, 0.91, 0.98, 0.995, 1
+    with_spectrum(cell, [ 5, 4, 3, 2, 1, 0.5 ])
+    factorized = MF.factorize_sru(cell, energy=energy)
+    assert factorized.rank == rank
+
+
+def test_factorize_keeps_small_weights():
+    # rank 12 factors of the 16 x 32 weight, and rank 8 ones of the 8 x 24
+    # weight, hold more than the weights
+    model = MF.SRU(16, 8, 2)
+    factorized = MF.factorize_sru(model, rank=12)
+    for cell in factorized.rnn_lst:
+        assert cell.weight is not None and cell.rank == 0
+    with pytest.raises(ValueError):
+        MF.factorize_sru(model)
+    with pytest.raises(ValueError):
+        MF.factorize_sru(model, rank=2, energy=0.9)
+
+
+def test_factorized_training():
+    torch.manual_seed(0)
+    model = MF.factorize_sru(MF.SRU(16, 8, 2), rank=4)
+    output, hidden = model(torch.randn(7, 4, 16))
+    output.sum().backward()
+    for cell in model.rnn_lst:
+        assert cell.weight_u.grad is not None and cell.weight_v.grad is not None
+
+
+def test_low_rank_init():
+    # the product of the factors has the scale of a full weight
+    torch.manual_seed(0)
+    full = MF.SRUCell(256, 256)
+    low_rank = MF.SRUCell(256, 256, rank=64)
+    product = low_rank.weight_u.matmul(low_rank.weight_v)
+    assert product.size() == full.weight.size()
+    assert abs(product.std().item()/full.weight.std().item() - 1) < 0.1
@@ -0,0 +1,70 @@
+""" A light cell ties its highway gate to its forget gate: it must compute
+    what a full cell computes when the highway columns of its weight are
+    copies of the forget gate columns.
+"""
+import pytest
+import torch
+
+import cuda_functional as MF
+
+
+def tied(cell):
+    """ Full cell whose u2 columns (the highway gate) are copies of u1. """
+    k = cell.size_per_dir // cell.n_out
+    bidir = 2 if cell.bidirectional else 1
+    full = MF.SRUCell(cell.n_in, cell.n_out, bidirectional=cell.bidirectional,
+        use_tanh=cell.activation_type == 1, use_relu=cell.activation_type == 2,
+        highway_projection=k == 3).double()
+    # u is (bidir, n_out, k): light has [u0, u1(, x)], full [u0, u1, u2(, x)]
+    weight = cell.weight.detach().view(cell.n_in, bidir, cell.n_out, k)
+    parts = [ weight[..., :2], weight[..., 1:2], weight[..., 2:] ]
+    full.weight.data.copy_(torch.cat(parts, -1).view(cell.n_in, -1))
+    full.bias.data.copy_(cell.bias.detach())
+    return full
+
+
+@pytest.mark.parametrize('backend', ['ext', 'torch'])
+@pytest.mark.parametrize('cfg', [
+    dict(),
+    dict(bidirectional=True),
+    dict(n_in=5),
+    dict(bidirectional=True, n_in=5, use_relu=1),
+], ids=str)
+def test_light_is_tied_full_cell(backend, cfg):
+    MF.set_cpu_backend(backend)
+    try:
+        try:
+            MF.get_backend('cpu')
+        except RuntimeError:
+            pytest.skip('the {} backend is not available'.format(backend))
+        cfg = dict(cfg)
+        n_in = cfg.pop('n_in', 4)
+        torch.manual_seed(0)
+        light = MF.SRUCell(n_in, 4, light=True, **cfg).double()
+        light.set_bias(0.5)
+        light.bias.data.add_(0.1*torch.randn_like(light.bias))
+        full = tied(light)
+        # one projection less per unit
+        assert light.size_per_dir == full.size_per_dir - 4
+
+        x = torch.randn(7, 3, n_in, dtype=torch.double)
+        c0 = torch.randn(3, light.bias.numel()//2, dtype=torch.double)
+        lengths = torch.tensor([7, 4, 1])
+        h1, c1 = light(x, c0, lengths=lengths)
+        h2, c2 = full(x, c0, lengths=lengths)
+        torch.testing.assert_close(h1, h2)
+        torch.testing.assert_close(c1, c2)
+
+        # the tied columns get the sum of the gradients of both gates
+        weight = torch.randn_like(h1)
+        (h1*weight).sum().backward()
+        (h2*weight).sum().backward()
+        k = full.size_per_dir // full.n_out
+        bidir = 2 if full.bidirectional else 1
+        grad = full.weight.grad.view(n_in, bidir, 4, k)
+        expected = torch.cat([ grad[..., :1], grad[..., 1:2] + grad[..., 2:3],
+            grad[..., 3:] ], -1).view(n_in, -1)
+        torch.testing.assert_close(light.weight.grad, expected)
+        torch.testing.assert_close(light.bias.grad, full.bias.grad)
+    finally:
+        MF.set_cpu_backend(None)
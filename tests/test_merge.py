@@ -0,0 +1,88 @@
+""" With merge_mode 'sum' or 'mean', a bidirectional cell must output the sum
+    (or the mean) of what its two directions output with 'concat'.
+"""
+import pytest
+import torch
+
+import cuda_functional as MF
+
+
+def run(cell, x, c0, lengths):
+    x = x.clone().requires_grad_()
+    generator = torch.Generator().manual_seed(3)
+    h, c = cell(x, c0, lengths=lengths, generator=generator)
+    return x, h, c
+
+
+@pytest.mark.parametrize('backend', ['ext', 'torch'])
+@pytest.mark.parametrize('merge_mode', ['sum', 'mean'])
+@pytest.mark.parametrize('cfg', [
+    dict(),
+    dict(n_in=5),
+    dict(light=True),
+    dict(batch_first=True),
+], ids=str)
+def test_merge_matches_concat(backend, merge_mode, cfg):
+    MF.set_cpu_backend(backend)
+    try:
+        try:
+            MF.get_backend('cpu')
+        except RuntimeError:
+            pytest.skip('the {} backend is not available'.format(backend))
+        cfg = dict(cfg)
+        n_in = cfg.pop('n_in', 4)
+        torch.manual_seed(0)
+        # the highway connection of a concat cell only reads x without a
+        # projection when n_in is 2*hidden_size, and that of a merged one
+        # when n_in is hidden_size, so both project it here
+        concat = MF.SRUCell(n_in, 4, dropout=0.2, rnn_dropout=0.2, bidirectional=True,
+            highway_projection=True, **cfg).double()
+        concat.set_bias(0.5)
+        merged = MF.SRUCell(n_in, 4, dropout=0.2, rnn_dropout=0.2, bidirectional=True,
+            merge_mode=merge_mode, highway_projection=True, **cfg).double()
+        merged.load_state_dict(concat.state_dict())
+
+        x = torch.randn(7, 3, n_in, dtype=torch.double)
+        if concat.batch_first:
+            x = x.transpose(0, 1).contiguous()
+        c0 = torch.randn(3, 8, dtype=torch.double)
+        lengths = torch.tensor([7, 4, 1])
+        x1, h1, c1 = run(concat, x, c0, lengths)
+        x2, h2, c2 = run(merged, x, c0, lengths)
+        expected = h1[..., :4] + h1[..., 4:]
+        if merge_mode == 'mean':
+            expected = expected/2
+        assert h2.size()[-1] == 4
+        torch.testing.assert_close(h2, expected)
+        torch.testing.assert_close(c2, c1)
+
+        # the gradient of the merged output is that of both directions
+        weight = torch.randn_like(h2)
+        (h2*weight).sum().backward()
+        (expected*weight).sum().backward()
+        torch.testing.assert_close(x2.grad, x1.grad)
+        for p1, p2 in zip(concat.parameters(), merged.parameters()):
+            torch.testing.assert_close(p2.grad, p1.grad)
+    finally:
+        MF.set_cpu_backend(None)
+
+
+@pytest.mark.parametrize('merge_mode', ['sum', 'mean'])
+def test_merged_sru(merge_mode):
+    # the layers above the first read hidden_size features
+    torch.manual_seed(0)
+    model = MF.SRU(6, 4, 3, bidirectional=True, merge_mode=merge_mode)
+    assert model.out_size == 4
+    assert [ cell.n_in for cell in model.rnn_lst ] == [ 6, 4, 4 ]
+    # so their highway connection reads x without a projection
+    assert [ cell.size_per_dir for cell in model.rnn_lst ] == [ 16, 12, 12 ]
+    concat = MF.SRU(6, 4, 3, bidirectional=True)
+    count = lambda m: sum(p.numel() for p in m.parameters())
+    assert count(model) < count(concat)
+    output, hidden = model(torch.randn(7, 3, 6))
+    assert output.size() == (7, 3, 4) and hidden.size() == (3, 3, 8)
+
+
+def test_merge_mode_errors():
+    with pytest.raises(ValueError):
+        MF.SRUCell(4, 4, bidirectional=True, merge_mode='max')
@@ -0,0 +1,103 @@
+""" sru.numpy_runtime must match cuda_functional.SRU / SRUCell in eval mode. """
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+import torch
+
+import cuda_functional as MF
+from conftest import ROOT
+
+# loaded from its file: the sru package imports the (installed) copy of
+# cuda_functional
+_spec = importlib.util.spec_from_file_location('numpy_runtime',
+    os.path.join(ROOT, 'sru', 'numpy_runtime.py'))
+NR = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(NR)
+
+CONFIGS = [
+    dict(),
+    dict(bidirectional=True),
+    dict(light=True),
+    dict(bidirectional=True, light=True),
+    dict(bidirectional=True, merge_mode='sum'),
+    dict(bidirectional=True, merge_mode='mean', light=True),
+    dict(projection_size=5),
+    dict(bidirectional=True, projection_size=5),
+    dict(bidirectional=True, merge_mode='mean', projection_size=5),
+    dict(light=True, projection_size=5),
+    dict(bidirectional=True, light=True, use_tanh=0, use_relu=1),
+    dict(rank=4),
+    dict(bidirectional=True, rank=4, light=True),
+    dict(use_tanh=0, use_relu=1),
+    dict(use_tanh=0),
+]
+
+
+def build(cfg, n_in):
+    torch.manual_seed(0)
+    model = MF.SRU(n_in, 8, 2, **cfg).eval()
+    for p in model.parameters():
+        p.data.add_(0.1*torch.randn_like(p))
+    activation = 2 if cfg.get('use_relu') else (1 if cfg.get('use_tanh', 1) else 0)
+    state = { k: v.numpy() for k, v in model.state_dict().items() }
+    runtime = NR.SRU.from_state_dict(state, bidirectional=cfg.get('bidirectional', False),
+        activation_type=activation, light=cfg.get('light', False),
+        merge_mode=cfg.get('merge_mode', 'concat'))
+    return model, runtime
+
+
+def assert_close(actual, expected):
+    np.testing.assert_allclose(actual, expected.numpy(), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('cfg', CONFIGS, ids=str)
+@pytest.mark.parametrize('n_in', [8, 11])
+def test_sru_parity(cfg, n_in):
+    model, runtime = build(cfg, n_in)
+    x = torch.randn(6, 3, n_in)
+    dir_ = 2 if cfg.get('bidirectional') else 1
+    c0 = torch.randn(2, 3, 8*dir_)
+    lengths = torch.tensor([6, 2, 4])
+    with torch.no_grad():
+        y, h = model(x, c0)
+        y_len, h_len = model(x, lengths=lengths)
+    y2, h2 = runtime(x.numpy(), c0.numpy())
+    assert_close(y2, y)
+    assert_close(h2, h)
+    y2, h2 = runtime(x.numpy(), lengths=lengths.numpy())
+    assert_close(y2, y_len)
+    assert_close(h2, h_len)
+
+
+@pytest.mark.parametrize('cfg', CONFIGS[:6], ids=str)
+def test_sru_reset_parity(cfg):
+    model, runtime = build(cfg, 8)
+    sequences = [ torch.randn(n, 8) for n in (5, 1, 3, 7, 2, 4) ]
+    x, reset, lengths, spans = MF.pack_streams(sequences)
+    with torch.no_grad():
+        y, h = model(x, lengths=lengths, reset=reset)
+    y2, h2 = runtime(x.numpy(), lengths=lengths.numpy(), reset=reset.numpy())
+    assert_close(y2, y)
+    assert_close(h2, h)
+
+
+@pytest.mark.parametrize('cfg', CONFIGS, ids=str)
+def test_cell_parity(cfg):
+    model, _ = build(cfg, 11)
+    cell = model.rnn_lst[0]
+    state = { k: v.numpy() for k, v in cell.state_dict().items() }
+    runtime = NR.SRUCell.from_state_dict(state, bidirectional=cell.bidirectional,
+        activation_type=cell.activation_type, light=cell.light, merge_mode=cell.merge_mode)
+    x = torch.randn(6, 3, 11)
+    with torch.no_grad():
+        h, c = cell(x)
+        h1, c1 = cell(x[0])
+    h2, c2 = runtime(x.numpy())
+    assert_close(h2, h)
+    assert_close(c2, c)
+    # a single step, (batch, n_in)
+    h2, c2 = runtime(x[0].numpy())
+    assert_close(h2, h1)
+    assert_close(c2, c1)
@@ -0,0 +1,73 @@
+""" export_onnx: the ONNX Runtime output must match the module in eval mode,
+    on shapes other than the ones used for tracing.
+"""
+import pytest
+import torch
+
+import cuda_functional as MF
+
+onnx = pytest.importorskip('onnx')
+pytest.importorskip('onnxscript')
+ort = pytest.importorskip('onnxruntime')
+
+# (use_tanh, use_relu): tanh, identity, relu
+ACTIVATIONS = [(1, 0), (0, 0), (0, 1)]
+DROPOUT_OPS = {'Dropout', 'RandomUniform', 'RandomUniformLike', 'RandomNormal',
+               'RandomNormalLike', 'Bernoulli'}
+
+
+class WithLengths(torch.nn.Module):
+    def __init__(self, rnn):
+        super(WithLengths, self).__init__()
+        self.rnn = rnn
+
+    def forward(self, x, lengths):
+        return self.rnn(x, lengths=lengths)
+
+
+@pytest.mark.parametrize('bidirectional', [False, True])
+@pytest.mark.parametrize('k4', [False, True])
+@pytest.mark.parametrize('activation', ACTIVATIONS)
+@pytest.mark.parametrize('with_lengths', [False, True])
+def test_export_onnx_parity(tmp_path, bidirectional, k4, activation, with_lengths):
+    torch.manual_seed(0)
+    d = 8
+    dir_ = 2 if bidirectional else 1
+    # k=4 when the input size differs from the output size
+    n_in = d*dir_ + 3 if k4 else d*dir_
+    rnn = MF.SRU(n_in, d, 2, dropout=0.3, rnn_dropout=0.2, bidirectional=bidirectional,
+                 use_tanh=activation[0], use_relu=activation[1])
+    assert (rnn.rnn_lst[0].size_per_dir == 4*d) == k4
+    rnn.set_bias(-1)
+    for p in rnn.parameters():
+        p.data.add_(0.1*torch.randn_like(p))
+    module = WithLengths(rnn) if with_lengths else rnn
+
+    T, B = torch.export.Dim('T', min=2), torch.export.Dim('B', min=2)
+    x = torch.randn(5, 3, n_in)
+    lengths = torch.tensor([5, 2, 4])
+    if with_lengths:
+        args, names, shapes = (x, lengths), ['x', 'lengths'], ({0: T, 1: B}, {0: B})
+    else:
+        args, names, shapes = (x,), ['x'], ({0: T, 1: B},)
+    path = str(tmp_path / 'sru.onnx')
+    MF.export_onnx(module, args, path, input_names=names, dynamic_shapes=shapes)
+    # the training flag is restored
+    assert module.training
+
+    ops = set(node.op_type for node in onnx.load(path).graph.node)
+    assert 'Scan' in ops and 'MatMul' in ops
+    assert not ops & DROPOUT_OPS
+
+    # other sizes than the traced ones
+    x2 = torch.randn(9, 4, n_in)
+    lengths2 = torch.tensor([9, 3, 1, 7])
+    feeds = [x2, lengths2] if with_lengths else [x2]
+    session = ort.InferenceSession(path)
+    outputs = session.run(None, { n: t.numpy() for n, t in zip(names, feeds) })
+    module.eval()
+    with torch.no_grad():
+        expected = module(*feeds)
+    assert len(outputs) == len(expected)
+    for out, ref in zip(outputs, expected):
+        torch.testing.assert_close(torch.from_numpy(out), ref, rtol=1e-4, atol=1e-5)
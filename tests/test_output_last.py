@@ -0,0 +1,81 @@
+""" SRU(output='last') must return the output that output='all' has at the
+    last valid step of every example (output[-1], in both directions), with
+    the same final states and gradients.
+"""
+import pytest
+import torch
+from torch.nn.utils.rnn import pack_padded_sequence
+
+import cuda_functional as MF
+
+LENGTHS = [7, 3, 1, 7]
+
+
+def last_step(output, lengths, batch_first):
+    """ output[-1] of every example, at its own length (in both directions). """
+    if batch_first:
+        output = output.transpose(0, 1)
+    return output[lengths-1, torch.arange(output.size(1))]
+
+
+def run(model, x, lengths):
+    x = x.clone().requires_grad_()
+    generator = torch.Generator().manual_seed(3)
+    output, hidden = model(x, lengths=lengths, generator=generator)
+    if model.output == 'all':
+        output = last_step(output, lengths, model.batch_first)
+    weight = torch.linspace(-1, 1, output.numel(), dtype=output.dtype).view_as(output)
+    ((output*weight).sum() + hidden.square().sum()).backward()
+    grads = [ x.grad ] + [ p.grad for p in model.parameters() ]
+    model.zero_grad()
+    return output.detach(), hidden.detach(), grads
+
+
+@pytest.mark.parametrize('cfg', [
+    dict(),
+    dict(bidirectional=True),
+    dict(light=True, projection_size=3),
+    dict(bidirectional=True, batch_first=True),
+    dict(num_layers=1),
+], ids=str)
+@pytest.mark.parametrize('training', [False, True])
+def test_output_last(cfg, training):
+    cfg = dict(cfg)
+    depth = cfg.pop('num_layers', 3)
+    torch.manual_seed(0)
+    full = MF.SRU(5, 4, depth, dropout=0.2, rnn_dropout=0.2, **cfg).double()
+    full.set_bias(0.5)
+    last = MF.SRU(5, 4, depth, dropout=0.2, rnn_dropout=0.2, output='last', **cfg).double()
+    last.load_state_dict(full.state_dict())
+    full.train(training)
+    last.train(training)
+    x = torch.randn(7, 4, 5, dtype=torch.double)
+    if full.batch_first:
+        x = x.transpose(0, 1).contiguous()
+    lengths = torch.tensor(LENGTHS)
+
+    out1, hid1, grads1 = run(full, x, lengths)
+    out2, hid2, grads2 = run(last, x, lengths)
+    assert out2.size() == (4, full.out_size)
+    torch.testing.assert_close(out2, out1)
+    torch.testing.assert_close(hid2, hid1)
+    for g1, g2 in zip(grads1, grads2):
+        torch.testing.assert_close(g2, g1)
+
+    # a PackedSequence instead of lengths
+    packed = pack_padded_sequence(x, lengths, batch_first=full.batch_first,
+        enforce_sorted=False)
+    with torch.no_grad():
+        output, hidden = full(x, lengths=lengths, generator=torch.Generator().manual_seed(3))
+        out3, hid3 = last(packed, generator=torch.Generator().manual_seed(3))
+    torch.testing.assert_close(out3, last_step(output, lengths, full.batch_first))
+    torch.testing.assert_close(hid3, hidden)
+
+
+def test_output_last_errors():
+    with pytest.raises(ValueError):
+        MF.SRU(5, 4, output='first')
+    model = MF.SRU(5, 4, output='last')
+    x = torch.randn(7, 2, 5)
+    with pytest.raises(ValueError):
+        model(x, reset=torch.zeros(7, 2, dtype=torch.bool))
@@ -0,0 +1,88 @@
+""" Sequences packed by pack_streams must give the outputs, final states and
+    gradients they get when run one by one.
+"""
+import pytest
+import torch
+
+import cuda_functional as MF
+
+LENGTHS = [3, 7, 2, 5, 1, 4]
+
+
+def run_packed(model, seqs, weight, batch_first):
+    input, reset, lengths, spans = MF.pack_streams(seqs, length=8,
+        batch_first=batch_first)
+    output, hidden = model(input, lengths=lengths, reset=reset, spans=spans)
+    last = MF.gather_last(output, spans, model.bidirectional, batch_first)
+    (last.sum() + (hidden*weight).sum()).backward()
+    grads = [ p.grad.clone() for p in model.parameters() ]
+    model.zero_grad()
+    return last.detach(), hidden.detach(), grads
+
+
+def run_alone(model, seqs, weight, batch_first):
+    last, hidden = [], []
+    for seq in seqs:
+        output, h = model(seq.unsqueeze(0 if batch_first else 1))
+        output = output[0] if batch_first else output[:, 0]
+        if model.bidirectional:
+            d = output.size(-1)//2
+            last.append(torch.cat([ output[-1, :d], output[0, d:] ]))
+        else:
+            last.append(output[-1])
+        hidden.append(h[:, 0])
+    last, hidden = torch.stack(last), torch.stack(hidden, 1)
+    (last.sum() + (hidden*weight).sum()).backward()
+    grads = [ p.grad.clone() for p in model.parameters() ]
+    model.zero_grad()
+    return last.detach(), hidden.detach(), grads
+
+
+@pytest.mark.parametrize('backend', ['ext', 'torch'])
+@pytest.mark.parametrize('bidirectional', [False, True])
+@pytest.mark.parametrize('batch_first', [False, True])
+@pytest.mark.parametrize('recompute', [False, True])
+def test_packed_states(backend, bidirectional, batch_first, recompute):
+    MF.set_cpu_backend(backend)
+    try:
+        try:
+            MF.get_backend('cpu')
+        except RuntimeError:
+            pytest.skip('the {} backend is not available'.format(backend))
+        torch.manual_seed(0)
+        model = MF.SRU(5, 4, 2, bidirectional=bidirectional, batch_first=batch_first,
+            recompute=recompute).double()
+        model.set_bias(0.5)
+        seqs = [ torch.randn(n, 5, dtype=torch.double) for n in LENGTHS ]
+        # weight every state differently, so that misplaced gradients show up
+        bidir = 2 if bidirectional else 1
+        weight = torch.randn(2, len(seqs), 4*bidir, dtype=torch.double)
+
+        last1, hidden1, grads1 = run_alone(model, seqs, weight, batch_first)
+        last2, hidden2, grads2 = run_packed(model, seqs, weight, batch_first)
+        torch.testing.assert_close(last2, last1)
+        torch.testing.assert_close(hidden2, hidden1)
+        for g1, g2 in zip(grads1, grads2):
+            torch.testing.assert_close(g2, g1)
+
+        # the inference path gathers the same states
+        model.eval()
+        input, reset, lengths, spans = MF.pack_streams(seqs, length=8,
+            batch_first=batch_first)
+        with torch.no_grad():
+            _, hidden3 = model(input, lengths=lengths, reset=reset, spans=spans)
+        torch.testing.assert_close(hidden3, hidden1)
+    finally:
+        MF.set_cpu_backend(None)
+
+
+def test_packed_states_script():
+    torch.manual_seed(0)
+    model = MF.SRU(5, 4, 2, bidirectional=True).eval()
+    seqs = [ torch.randn(n, 5) for n in LENGTHS ]
+    input, reset, lengths, spans = MF.pack_streams(seqs)
+    expected = model(input, lengths=lengths, reset=reset, spans=spans)[1]
+    scripted = torch.jit.script(model)
+    hidden = scripted(input, lengths=lengths, reset=reset, spans=spans)[1]
+    assert hidden.size() == (2, len(seqs), 8)
+    torch.testing.assert_close(hidden, expected)
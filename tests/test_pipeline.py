@@ -0,0 +1,129 @@
+""" The pipelined schedule (pipeline_chunk) must give the outputs, final
+    states and gradients of the layer by layer one, and keep its threads from
+    one call to the next.
+"""
+import copy
+import pickle
+
+import pytest
+import torch
+
+import cuda_functional as MF
+
+
+def run(model, x, lengths):
+    x = x.clone().requires_grad_()
+    generator = torch.Generator().manual_seed(3)
+    output, hidden = model(x, lengths=lengths, generator=generator)
+    if not torch.is_grad_enabled():
+        return output, hidden, []
+    weight = torch.linspace(-1, 1, output.numel(), dtype=output.dtype).view_as(output)
+    ((output*weight).sum() + hidden.square().sum()).backward()
+    grads = [ x.grad ] + [ p.grad for p in model.parameters() ]
+    model.zero_grad()
+    return output.detach(), hidden.detach(), grads
+
+
+@pytest.mark.parametrize('backend', ['ext', 'torch'])
+@pytest.mark.parametrize('cfg', [
+    dict(),
+    dict(light=True, projection_size=3),
+    dict(batch_first=True),
+    dict(output='last'),
+], ids=str)
+@pytest.mark.parametrize('chunk', [1, 3, 4])
+@pytest.mark.parametrize('training', [False, True])
+def test_pipeline_parity(backend, cfg, chunk, training):
+    MF.set_cpu_backend(backend)
+    try:
+        try:
+            MF.get_backend('cpu')
+        except RuntimeError:
+            pytest.skip('the {} backend is not available'.format(backend))
+        torch.manual_seed(0)
+        model = MF.SRU(5, 4, 3, dropout=0.2, rnn_dropout=0.2, **cfg).double()
+        model.set_bias(0.5)
+        pipelined = MF.SRU(5, 4, 3, dropout=0.2, rnn_dropout=0.2, pipeline_chunk=chunk,
+            **cfg).double()
+        pipelined.load_state_dict(model.state_dict())
+        model.train(training)
+        pipelined.train(training)
+        x = torch.randn(9, 3, 5, dtype=torch.double)
+        if model.batch_first:
+            x = x.transpose(0, 1).contiguous()
+        lengths = torch.tensor([9, 5, 1])
+
+        with torch.set_grad_enabled(training):
+            out1, hid1, grads1 = run(model, x, lengths)
+            out2, hid2, grads2 = run(pipelined, x, lengths)
+        torch.testing.assert_close(out2, out1)
+        torch.testing.assert_close(hid2, hid1)
+        for g1, g2 in zip(grads1, grads2):
+            torch.testing.assert_close(g2, g1)
+    finally:
+        MF.set_cpu_backend(None)
+
+
+def test_pipeline_pool_is_kept():
+    torch.manual_seed(0)
+    model = MF.SRU(5, 4, 3, pipeline_chunk=2).eval()
+    x = torch.randn(8, 2, 5)
+    with torch.no_grad():
+        model(x)
+    executor = model.pipeline_pool._executor
+    # (an idle worker takes the next layer, so there may be fewer threads)
+    threads = set(executor._threads)
+    assert 0 < len(threads) <= model.depth
+    for _ in range(5):
+        with torch.no_grad():
+            model(x)
+    assert model.pipeline_pool._executor is executor
+    assert threads <= set(executor._threads)
+    assert all(t.is_alive() for t in threads)
+    assert len(executor._threads) <= model.depth
+
+
+def test_pipeline_shared_pool():
+    # a single worker for both models: the layers take turns
+    pool = MF.SRUPipelinePool(1)
+    torch.manual_seed(0)
+    models = [ MF.SRU(5, 4, depth, pipeline_chunk=2, pipeline_pool=pool).eval()
+        for depth in (2, 4) ]
+    x = torch.randn(8, 2, 5)
+    for model in models:
+        assert model.pipeline_pool is pool
+        expected = MF.SRU(5, 4, model.depth).eval()
+        expected.load_state_dict(model.state_dict())
+        with torch.no_grad():
+            torch.testing.assert_close(model(x)[0], expected(x)[0])
+    assert len(pool._executor._threads) == 1
+
+
+def test_pipeline_worker_threads():
+    try:
+        MF.load_cpu_extension()
+    except Exception:
+        pytest.skip('the compiled CPU kernels are not available')
+    own = torch.get_num_threads()
+    pool = MF.SRUPipelinePool(2, num_threads=3)
+    assert pool.submit(torch.get_num_threads).result() == 3
+    assert torch.get_num_threads() == own
+    pool.num_threads = None
+    expected = max(1, torch.get_num_threads()//2)
+    assert pool.submit(torch.get_num_threads).result() == expected
+
+
+def test_pipeline_pool_copies():
+    torch.manual_seed(0)
+    model = MF.SRU(5, 4, 2, pipeline_chunk=2).eval()
+    x = torch.randn(8, 2, 5)
+    with torch.no_grad():
+        expected = model(x)[0]
+    for clone in [ copy.deepcopy(model), pickle.loads(pickle.dumps(model)) ]:
+        assert clone.pipeline_pool is not model.pipeline_pool
+        assert clone.pipeline_pool._executor is None
+        with torch.no_grad():
+            torch.testing.assert_close(clone(x)[0], expected)
+    model.pipeline_pool.shutdown()
+    with torch.no_grad():
+        torch.testing.assert_close(model(x)[0], expected)
@@ -0,0 +1,84 @@
+""" An SRU with projection_size (SRUP) must compute what a stack of plain
+    cells computes with the projection applied between them.
+"""
+import pytest
+import torch
+
+import cuda_functional as MF
+
+
+def project(h, weight_proj, bidirectional):
+    """ One (d, p) block of weight_proj per direction. """
+    if not bidirectional:
+        return h.matmul(weight_proj)
+    d = weight_proj.size(0)//2
+    return torch.cat([ h[..., :d].matmul(weight_proj[:d]),
+        h[..., d:].matmul(weight_proj[d:]) ], -1)
+
+
+def reference(model):
+    """ Unprojected copies of the cells of model, with their projections. """
+    cells = []
+    for cell in model.rnn_lst:
+        k = cell.size_per_dir // cell.n_out
+        ref = MF.SRUCell(cell.n_in, cell.n_out, bidirectional=cell.bidirectional,
+            light=cell.light, merge_mode=model.merge_mode,
+            highway_projection=k == MF._sru_gate_parts(cell.light)+1).double()
+        ref.load_state_dict({ 'weight': cell.weight, 'bias': cell.bias })
+        cells.append((ref, cell.weight_proj))
+    return cells
+
+
+@pytest.mark.parametrize('cfg', [
+    dict(),
+    dict(bidirectional=True),
+    dict(bidirectional=True, merge_mode='sum'),
+    dict(light=True),
+    dict(n_in=6),
+    # the projected input of the upper layers has hidden_size features, and
+    # their highway connection still reads the projected (k=4) part of u
+    dict(bidirectional=True, projection_size=3),
+], ids=str)
+def test_projection(cfg):
+    cfg = dict(cfg)
+    n_in = cfg.pop('n_in', 5)
+    projection_size = cfg.pop('projection_size', 2)
+    torch.manual_seed(0)
+    model = MF.SRU(n_in, 6, 3, projection_size=projection_size, **cfg).double()
+    model.set_bias(0.5)
+    bidirectional = model.bidirectional and model.merge_mode == 'concat'
+    assert model.out_size == projection_size*(2 if bidirectional else 1)
+    for cell in model.rnn_lst[1:]:
+        assert cell.n_in == model.out_size
+    cells = reference(model)
+
+    x = torch.randn(7, 4, n_in, dtype=torch.double)
+    lengths = torch.tensor([7, 3, 1, 6])
+    output, hidden = model(x, lengths=lengths)
+    assert output.size() == (7, 4, model.out_size)
+    assert hidden.size() == (3, 4, 6*(2 if model.bidirectional else 1))
+
+    h = x
+    states = []
+    for ref, weight_proj in cells:
+        h, c = ref(h, lengths=lengths)
+        h = project(h, weight_proj, bidirectional)
+        states.append(c)
+    torch.testing.assert_close(output, h)
+    torch.testing.assert_close(hidden, torch.stack(states))
+
+    # the gradients reach the weights, biases and projections alike
+    weight = torch.randn_like(output)
+    grads = torch.autograd.grad((output*weight).sum(), list(model.parameters()))
+    expected = torch.autograd.grad((h*weight).sum(),
+        [ p for ref, weight_proj in cells for p in (ref.weight, ref.bias, weight_proj) ])
+    for g1, g2 in zip(grads, expected):
+        torch.testing.assert_close(g1, g2)
+
+
+def test_projection_parameters():
+    # the projection narrows the input of every layer but the first
+    count = lambda m: sum(p.numel() for p in m.parameters())
+    d, p = 1024, 256
+    assert count(MF.SRU(p, d, 3)) == p*d*4 + 2*d*d*3 + 3*2*d
+    assert count(MF.SRU(p, d, 3, projection_size=p)) == 3*(p*d*4 + d*p + 2*d)
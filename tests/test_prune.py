@@ -0,0 +1,144 @@
+""" prune_sru must remove hidden units exactly: the pruned SRU computes what
+    the original one computes once the removed units are disconnected.
+"""
+import copy
+
+import pytest
+import torch
+
+import cuda_functional as MF
+
+CONFIGS = [
+    dict(),
+    dict(bidirectional=True),
+    dict(light=True),
+    dict(n_in=8),
+    dict(bidirectional=True, projection_size=3),
+    dict(projection_size=3, n_in=3),
+    dict(rank=3),
+]
+
+
+def make_model(cfg, n_out=8, depth=3):
+    cfg = dict(cfg)
+    n_in = cfg.pop('n_in', 6)
+    torch.manual_seed(0)
+    model = MF.SRU(n_in, n_out, depth, **cfg).double().eval()
+    for p in model.parameters():
+        p.data.normal_(0, 0.5)
+    return model
+
+
+def run(model, x):
+    with torch.no_grad():
+        return model(x)
+
+
+def disconnected(model, keep):
+    """ Copy of model in which the units that are not in keep (one index
+        tensor per layer) no longer reach the output or the next layer.
+    """
+    ref = copy.deepcopy(model)
+    cells = list(ref.rnn_lst)
+    for i, cell in enumerate(cells):
+        dropped = torch.ones(cell.bias.numel()//2, dtype=torch.bool)
+        dropped[keep[i]] = False
+        if cell.weight_proj is not None:
+            cell.weight_proj.data[dropped] = 0
+        elif i+1 < len(cells):
+            below = cells[i+1]
+            weight = below.weight if below.weight is not None else below.weight_u
+            weight.data[dropped] = 0
+    return ref
+
+
+def kept_units(score, size, bidir):
+    score = score.view(bidir, -1)
+    return torch.cat([ score[i].topk(size)[1].sort()[0] + i*score.size(1)
+        for i in range(bidir) ])
+
+
+@pytest.mark.parametrize('cfg', CONFIGS, ids=str)
+def test_prune_is_exact(cfg):
+    model = make_model(cfg)
+    bidir = 2 if model.bidirectional else 1
+    size = 5
+    # the same scores in every layer: the layers that read x from the layer
+    # below must keep the same units, and these do by construction
+    score = torch.rand(8*bidir)
+    pruned, out_keep = MF.prune_sru(model, size, [ score ]*model.depth)
+    keep = kept_units(score, size, bidir)
+    assert pruned.n_out == size
+    assert all(cell.n_out == size for cell in pruned.rnn_lst)
+
+    x = torch.randn(7, 4, model.n_in, dtype=torch.double)
+    output, hidden = run(disconnected(model, [ keep ]*model.depth), x)
+    p_output, p_hidden = run(pruned, x)
+    if model.projection_size > 0:
+        assert out_keep is None
+    else:
+        torch.testing.assert_close(out_keep, keep)
+        output = output[..., keep]
+    torch.testing.assert_close(p_output, output)
+    torch.testing.assert_close(p_hidden, hidden[..., keep])
+
+
+@pytest.mark.parametrize('cfg', CONFIGS, ids=str)
+def test_prune_to_same_size_is_identity(cfg):
+    model = make_model(cfg)
+    bidir = 2 if model.bidirectional else 1
+    pruned, keep = MF.prune_sru(model, model.n_out)
+    if keep is not None:
+        torch.testing.assert_close(keep, torch.arange(8*bidir))
+    x = torch.randn(7, 4, model.n_in, dtype=torch.double)
+    output, hidden = run(model, x)
+    p_output, p_hidden = run(pruned, x)
+    torch.testing.assert_close(p_output, output)
+    torch.testing.assert_close(p_hidden, hidden)
+
+
+def test_prune_keeps_projected_highway():
+    # hidden size 3*2 matches the projected input of the upper layers after
+    # pruning: their x must stay projected
+    model = make_model(dict(bidirectional=True, projection_size=3))
+    pruned, _ = MF.prune_sru(model, 3)
+    x = torch.randn(7, 4, model.n_in, dtype=torch.double)
+    assert run(pruned, x)[0].size() == (7, 4, 6)
+    for cell, p_cell in zip(model.rnn_lst, pruned.rnn_lst):
+        assert p_cell.size_per_dir // p_cell.n_out == cell.size_per_dir // cell.n_out
+
+
+@pytest.mark.parametrize('score', ['magnitude', 'activation', 'gradient'])
+def test_prune_scores_drop_dead_units(score):
+    model = make_model(dict(), depth=2)
+    dead = torch.tensor([ 1, 4, 6 ])
+    # units with no weights and no bias: no weight norm, a constant output
+    # (zero) and no gradient
+    for cell in model.rnn_lst:
+        k = cell.size_per_dir // cell.n_out
+        cell.weight.data.view(cell.n_in, -1, k)[:, dead] = 0
+        cell.bias.data.view(2, -1)[:, dead] = 0
+    x = torch.randn(7, 4, 6, dtype=torch.double)
+
+    def feed():
+        if score == 'gradient':
+            output, _ = model(x)
+            output.square().sum().backward()
+        else:
+            with torch.no_grad():
+                model(x)
+
+    pruned, keep = MF.prune_sru(model, 5, score, feed)
+    torch.testing.assert_close(keep, torch.tensor([ 0, 2, 3, 5, 7 ]))
+    assert run(pruned, x)[0].size() == (7, 4, 5)
+    assert all(p.grad is None for p in model.parameters())
+
+
+def test_prune_score_errors():
+    model = make_model(dict(projection_size=3))
+    with pytest.raises(ValueError):
+        MF.prune_sru(model, 4, 'activation')
+    with pytest.raises(ValueError):
+        MF.prune_sru(model, 4, 'activation', lambda: None)
+    with pytest.raises(ValueError):
+        MF.prune_sru(model, 9)
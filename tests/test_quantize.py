@@ -0,0 +1,59 @@
+""" quantize_sru must stay close to the float32 model it was built from. """
+import warnings
+
+import pytest
+import torch
+
+import cuda_functional as MF
+
+# relative error of the outputs and of the final states, measured at 2 to
+# 3.5% on these models
+MAX_ERROR = 0.05
+
+
+def relative_error(a, b):
+    return ((a-b).norm()/b.norm()).item()
+
+
+@pytest.mark.parametrize('cfg', [
+    dict(),
+    dict(bidirectional=True),
+    dict(light=True),
+    dict(projection_size=6),
+    dict(rank=4),
+    dict(bidirectional=True, merge_mode='sum', batch_first=True),
+    dict(output='last'),
+], ids=str)
+def test_quantized_error(cfg):
+    torch.manual_seed(0)
+    model = MF.SRU(16, 12, 2, **cfg).eval()
+    model.set_bias(0.5)
+    with warnings.catch_warnings():
+        # (quantized tensor creation is deprecated in recent PyTorch)
+        warnings.simplefilter('ignore')
+        qmodel = MF.quantize_sru(model)
+    assert all(not isinstance(m, MF.SRUCell) for m in qmodel.modules())
+    x = torch.randn(10, 8, 16)
+    if model.batch_first:
+        x = x.transpose(0, 1)
+    lengths = torch.tensor([10, 4, 7, 1, 10, 3, 9, 6])
+    with torch.no_grad():
+        output, hidden = model(x, lengths=lengths)
+        qoutput, qhidden = qmodel(x, lengths=lengths)
+    assert qoutput.size() == output.size() and qhidden.size() == hidden.size()
+    assert relative_error(qoutput, output) < MAX_ERROR
+    assert relative_error(qhidden, hidden) < MAX_ERROR
+
+
+def test_quantized_cell_error():
+    torch.manual_seed(0)
+    cell = MF.SRUCell(16, 12, bidirectional=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        qcell = MF.quantize_sru(cell)
+    x = torch.randn(10, 8, 16)
+    with torch.no_grad():
+        output, c = cell(x)
+        qoutput, qc = qcell(x)
+    assert relative_error(qoutput, output) < MAX_ERROR
+    assert relative_error(qc, c) < MAX_ERROR
@@ -0,0 +1,75 @@
+""" The parallel scan must compute the same outputs and gradients as the
+    sequential recurrence.
+"""
+import pytest
+import torch
+
+import cuda_functional as MF
+
+CONFIGS = [
+    dict(),
+    dict(bidirectional=True),
+    dict(light=True, use_relu=1),
+    dict(bidirectional=True, merge_mode='mean'),
+    dict(bidirectional=True, batch_first=True),
+    dict(output='last'),
+]
+
+
+def run(model, x, scan, lengths, reset):
+    x = x.clone().requires_grad_()
+    batch = x.size(0 if model.batch_first else 1)
+    size = model.n_out*(2 if model.bidirectional else 1)
+    c0 = torch.linspace(-1, 1, model.depth*batch*size, dtype=x.dtype)
+    c0 = c0.view(model.depth, batch, size)
+    output, hidden = model(x, c0, scan=scan, lengths=lengths, reset=reset)
+    weight = torch.linspace(-1, 1, output.numel(), dtype=output.dtype).view_as(output)
+    ((output*weight).sum() + hidden.square().sum()).backward()
+    grads = [ x.grad ] + [ p.grad for p in model.parameters() ]
+    model.zero_grad()
+    return output.detach(), hidden.detach(), grads
+
+
+@pytest.mark.parametrize('cfg', CONFIGS, ids=str)
+@pytest.mark.parametrize('with_lengths', [False, True])
+@pytest.mark.parametrize('with_reset', [False, True])
+@pytest.mark.parametrize('length', [1, 13])
+def test_scan_parity(cfg, with_lengths, with_reset, length):
+    if with_reset and cfg.get('output') == 'last':
+        pytest.skip("reset requires output='all'")
+    torch.manual_seed(0)
+    model = MF.SRU(5, 4, 2, **cfg).double()
+    model.set_bias(0.5)
+    batch = 3
+    x = torch.randn(length, batch, 5, dtype=torch.double)
+    lengths = torch.tensor([length, max(length-4, 1), 0]) if with_lengths else None
+    reset = (torch.rand(length, batch) < 0.3) if with_reset else None
+    if model.batch_first:
+        x = x.transpose(0, 1).contiguous()
+        reset = reset.t().contiguous() if reset is not None else None
+
+    out1, hid1, grads1 = run(model, x, False, lengths, reset)
+    out2, hid2, grads2 = run(model, x, True, lengths, reset)
+    torch.testing.assert_close(out2, out1)
+    torch.testing.assert_close(hid2, hid1)
+    for g1, g2 in zip(grads1, grads2):
+        torch.testing.assert_close(g2, g1)
+
+
+def test_scan_threshold():
+    torch.manual_seed(0)
+    model = MF.SRU(5, 4, 2, scan_threshold=8).double()
+    calls = []
+    scan = MF._sru_cpu_scan
+    def counted(*args, **kwargs):
+        calls.append(args[0].size(0))
+        return scan(*args, **kwargs)
+    MF._sru_cpu_scan = counted
+    try:
+        with torch.no_grad():
+            model(torch.randn(7, 2, 5, dtype=torch.double))
+            assert calls == []
+            model(torch.randn(8, 2, 5, dtype=torch.double))
+    finally:
+        MF._sru_cpu_scan = scan
+    assert calls and all(n == 8 for n in calls)
@@ -0,0 +1,44 @@
+""" Decoding step by step with SRU.step must give the outputs and states of a
+    forward pass over the whole sequence.
+"""
+import pytest
+import torch
+
+import cuda_functional as MF
+
+
+@pytest.mark.parametrize('cfg', [
+    dict(),
+    dict(light=True),
+    dict(use_relu=1),
+    dict(use_tanh=0),
+    dict(projection_size=3),
+    dict(rank=2),
+    dict(n_in=4),
+], ids=str)
+@pytest.mark.parametrize('with_c0', [False, True])
+def test_step_parity(cfg, with_c0):
+    cfg = dict(cfg)
+    n_in = cfg.pop('n_in', 6)
+    torch.manual_seed(0)
+    model = MF.SRU(n_in, 6, 3, dropout=0.2, rnn_dropout=0.2, **cfg).double().eval()
+    model.set_bias(0.5)
+    x = torch.randn(9, 4, n_in, dtype=torch.double)
+    c0 = torch.randn(3, 4, 6, dtype=torch.double) if with_c0 else None
+    with torch.no_grad():
+        output, hidden = model(x, c0)
+
+    c = c0
+    steps = []
+    for t in range(x.size(0)):
+        h, c = model.step(x[t], c)
+        steps.append(h)
+    assert not h.requires_grad and not c.requires_grad
+    torch.testing.assert_close(torch.stack(steps), output)
+    torch.testing.assert_close(c, hidden)
+
+
+def test_step_rejects_bidirectional():
+    model = MF.SRU(6, 6, 2, bidirectional=True)
+    with pytest.raises(AssertionError):
+        model.step(torch.randn(4, 6))
@@ -0,0 +1,50 @@
+""" One SRU in eval mode serving many threads at once. """
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+import cuda_functional as MF
+
+N_THREADS = 8
+N_CALLS = 200
+
+
+@pytest.mark.parametrize('backend', ['ext', 'torch'])
+@pytest.mark.parametrize('cfg', [
+    dict(),
+    dict(bidirectional=True, projection_size=6),
+    dict(output='last', light=True),
+], ids=str)
+def test_concurrent_inference(backend, cfg):
+    MF.set_cpu_backend(backend)
+    try:
+        try:
+            MF.get_backend('cpu')
+        except RuntimeError:
+            pytest.skip('the {} backend is not available'.format(backend))
+        torch.manual_seed(0)
+        model = MF.SRU(10, 8, 3, dropout=0.3, rnn_dropout=0.2, **cfg).eval()
+        # inputs of different shapes
+        inputs = []
+        for i in range(24):
+            L, B = 3 + i % 7, 1 + i % 5
+            lengths = torch.randint(1, L+1, (B,))
+            lengths[0] = L
+            inputs.append((torch.randn(L, B, 10), lengths))
+        with torch.no_grad():
+            expected = [ model(x, lengths=l) for x, l in inputs ]
+
+        def work(i):
+            x, lengths = inputs[i % len(inputs)]
+            with torch.no_grad():
+                return i, model(x, lengths=lengths)
+
+        with ThreadPoolExecutor(N_THREADS) as pool:
+            results = list(pool.map(work, range(N_CALLS)))
+        for i, (output, hidden) in results:
+            torch.testing.assert_close(output, expected[i % len(inputs)][0], rtol=0, atol=1e-6)
+            torch.testing.assert_close(hidden, expected[i % len(inputs)][1], rtol=0, atol=1e-6)
+    finally:
+        MF.set_cpu_backend(None)
+